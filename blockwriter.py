@@ -0,0 +1,196 @@
+# blockwriter.py (MicroPython)
+# Write-behind block writer for flash and SD. Small writes are gathered in one
+# reusable buffer and reach the file only as whole, aligned blocks (FAT on SD
+# is slow with small or unaligned writes), plus an explicit flush()/sync() at
+# the points where data must be on the card. Every block write is timed, so
+# the real write throughput per storage can be reported (see summary()).
+#
+#   w = open_writer("/sd/logs/data.csv", "ab")
+#   w.write(b"...")
+#   w.close()            # flush + sync + close the file
+import os
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    import time
+
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+# Block sizes: littlefs on the Pico's flash uses 4 KB erase blocks; on SD a
+# block of several 512-byte sectors (ideally one cluster) is much faster.
+BLOCK_SIZE_INTERNAL = 4096
+BLOCK_SIZE_SD = 8192
+SD_PREFIX = "/sd"
+# Buffers kept for reuse, so uploads do not fragment the heap
+POOL_MAX = 4
+
+_pool = []
+# label -> [bytes, microseconds, writes, syncs]
+_stats = {}
+
+
+def label_for(path):
+    return "sd" if path == SD_PREFIX or path.startswith(SD_PREFIX + "/") else "internal"
+
+
+def block_size_for(path):
+    return BLOCK_SIZE_SD if label_for(path) == "sd" else BLOCK_SIZE_INTERNAL
+
+
+def _get_buf(size):
+    for i, buf in enumerate(_pool):
+        if len(buf) == size:
+            return _pool.pop(i)
+    return bytearray(size)
+
+
+def _put_buf(buf):
+    if len(_pool) < POOL_MAX:
+        _pool.append(buf)
+
+
+def _record(label, nbytes, us, sync=False):
+    rec = _stats.get(label)
+    if rec is None:
+        rec = _stats[label] = [0, 0, 0, 0]
+    rec[0] += nbytes
+    rec[1] += us
+    if sync:
+        rec[3] += 1
+    else:
+        rec[2] += 1
+
+
+def summary():
+    """Measured write throughput per storage ("internal", "sd") since boot."""
+    out = {}
+    for label, (nbytes, us, writes, syncs) in _stats.items():
+        out[label] = {
+            "bytes": nbytes,
+            "writes": writes,
+            "syncs": syncs,
+            "ms": us // 1000,
+            "avg_write": nbytes // writes if writes else 0,
+            "bytes_per_sec": int(nbytes * 1000000 // us) if us else None,
+        }
+    return out
+
+
+def reset_stats():
+    _stats.clear()
+
+
+class BlockWriter:
+    """Buffered writer that writes f in whole blocks of block_size.
+
+    offset is the file position the first write lands at (append/resume); the
+    first block is shortened so that every later write starts on a block
+    boundary. space()/commit() let a caller read (e.g. recv_into) straight
+    into the buffer; write() copies.
+    """
+
+    def __init__(self, f, block_size=BLOCK_SIZE_INTERNAL, offset=0, label="internal", owns_file=False):
+        self.f = f
+        self.label = label
+        self.owns_file = owns_file
+        self.buf = _get_buf(block_size)
+        self.mv = memoryview(self.buf)
+        self.fill = 0
+        self.limit = block_size - (offset % block_size)
+        self.pos = offset
+
+    def space(self, most=None):
+        """Free buffer space up to the next block boundary (at most most bytes)."""
+        n = self.limit - self.fill
+        if most is not None and most < n:
+            n = most
+        return self.mv[self.fill:self.fill + n]
+
+    def commit(self, n):
+        """Account for n bytes placed in the view returned by space()."""
+        self.fill += n
+        if self.fill >= self.limit:
+            self._write_block()
+
+    def write(self, data):
+        data = memoryview(data)
+        while len(data):
+            view = self.space(len(data))
+            n = len(view)
+            view[:] = data[:n]
+            self.commit(n)
+            data = data[n:]
+
+    def _write_block(self):
+        if not self.fill:
+            return
+        t0 = ticks_us()
+        self.f.write(self.mv[:self.fill])
+        _record(self.label, self.fill, ticks_diff(ticks_us(), t0))
+        self.pos += self.fill
+        self.fill = 0
+        # A flush of a partial block moves the next boundary closer
+        self.limit = len(self.buf) - (self.pos % len(self.buf))
+
+    def flush(self):
+        """Write out buffered bytes (a partial block if need be)."""
+        self._write_block()
+
+    def sync(self):
+        """flush() and push the file's data to the card."""
+        self._write_block()
+        t0 = ticks_us()
+        try:
+            self.f.flush()
+        except AttributeError:
+            pass
+        if hasattr(os, "fsync"):
+            try:
+                os.fsync(self.f.fileno())
+            except (AttributeError, OSError):
+                pass
+        elif hasattr(os, "sync"):
+            os.sync()
+        _record(self.label, 0, ticks_diff(ticks_us(), t0), sync=True)
+
+    def discard(self):
+        """Drop buffered bytes that were not written yet."""
+        self.fill = 0
+
+    def close(self, sync=True):
+        """Flush (and sync), give the buffer back, and close the file if owned."""
+        if self.buf is None:
+            return
+        if sync:
+            self.sync()
+        else:
+            self._write_block()
+        _put_buf(self.buf)
+        self.buf = self.mv = None
+        if self.owns_file:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_writer(path, mode="wb", block_size=None, offset=None):
+    """Open path and return a BlockWriter that owns it; block size and stats
+    label follow the storage (SD or flash). In append mode the current size
+    is used as the offset so blocks stay aligned."""
+    if offset is None:
+        offset = 0
+        if "a" in mode:
+            try:
+                offset = os.stat(path)[6]
+            except OSError:
+                pass
+    f = open(path, mode)
+    return BlockWriter(f, block_size or block_size_for(path), offset, label_for(path), owns_file=True)
@@ -0,0 +1,249 @@
+# kvstore.py (MicroPython)
+# Log-structured key-value store for runtime settings. settings.kv is a
+# magic header followed by records appended one per change:
+#
+#   key length (u8), value length (u16 BE, 0xFFFF = deleted), key, value
+#   (JSON), CRC32 of everything before it (u32 BE)
+#
+# The last record of a key wins. The file is read in one go at the first
+# lookup and kept as a dict, so get() never touches flash. A change appends
+# one short record instead of rewriting a file; once the log passes
+# MAX_BYTES it is compacted (live records copied to a new file that is
+# renamed over the old one). A record torn by a reset fails its CRC and is
+# ignored along with anything after it.
+#
+# define() declares a setting with its default and an optional check, so BLE
+# and HTTP updates (update()) are validated the same way:
+#
+#   RELAY_DURATION_MIN = kvstore.define("RELAY_DURATION_MIN", 2, positive)
+import os
+import struct
+try:
+    import ujson as json
+except ImportError:
+    import json
+try:
+    import ubinascii as binascii
+except ImportError:
+    import binascii
+
+KV_FILE = "settings.kv"
+MAGIC = b"PKV1"
+MAX_BYTES = 4096      # One flash erase block; compact when an append would pass it
+DELETED = 0xFFFF
+
+_data = None          # key -> value, loaded lazily
+_size = 0             # Bytes of valid log in KV_FILE
+_torn = False         # Garbage after the last valid record: rewrite before appending
+_compactions = 0
+_schema = {}          # key -> [default, check, on_change, value in effect, secret], see define()
+
+
+def _record(key, value):
+    k = key.encode()
+    if value is None:
+        v = b""
+        vlen = DELETED
+    else:
+        v = json.dumps(value).encode()
+        vlen = len(v)
+    if len(k) > 255 or len(v) >= DELETED:
+        raise ValueError("setting too large")
+    rec = struct.pack(">BH", len(k), vlen) + k + v
+    return rec + struct.pack(">I", binascii.crc32(rec) & 0xFFFFFFFF)
+
+
+def load():
+    """(Re)read KV_FILE; returns the number of keys."""
+    global _data, _size, _torn
+    _data = {}
+    _size = 0
+    _torn = False
+    try:
+        with open(KV_FILE, "rb") as f:
+            buf = f.read()
+    except OSError:
+        return 0
+    if buf[:4] != MAGIC:
+        _torn = bool(buf)
+        return 0
+    pos = 4
+    while pos + 7 <= len(buf):
+        klen, vlen = struct.unpack(">BH", buf[pos:pos + 3])
+        end = pos + 3 + klen + (0 if vlen == DELETED else vlen)
+        if end + 4 > len(buf):
+            break
+        if struct.unpack(">I", buf[end:end + 4])[0] != binascii.crc32(buf[pos:end]) & 0xFFFFFFFF:
+            break
+        try:
+            key = buf[pos + 3:pos + 3 + klen].decode()
+            if vlen == DELETED:
+                _data.pop(key, None)
+            else:
+                _data[key] = json.loads(buf[pos + 3 + klen:end].decode())
+        except ValueError:
+            break
+        pos = end + 4
+    _size = pos
+    if pos < len(buf):
+        _torn = True
+        print("Settings: ignored {} bytes after the last valid record".format(len(buf) - pos))
+    return len(_data)
+
+
+def _loaded():
+    if _data is None:
+        load()
+    return _data
+
+
+def compact():
+    """Rewrite KV_FILE with one record per live key."""
+    global _size, _torn, _compactions
+    data = _loaded()
+    tmp = KV_FILE + ".tmp"
+    size = len(MAGIC)
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        for key in data:
+            rec = _record(key, data[key])
+            f.write(rec)
+            size += len(rec)
+    try:
+        os.rename(tmp, KV_FILE)
+    except OSError:
+        os.remove(KV_FILE)
+        os.rename(tmp, KV_FILE)
+    _size = size
+    _torn = False
+    _compactions += 1
+
+
+def _append(key, value):
+    global _size
+    rec = _record(key, value)
+    if _torn or _size + len(rec) > MAX_BYTES:
+        # Compaction writes the new value along with the rest
+        compact()
+        return
+    with open(KV_FILE, "ab") as f:
+        if _size == 0:
+            f.write(MAGIC)
+            _size = len(MAGIC)
+        f.write(rec)
+    _size += len(rec)
+
+
+def get(key, default=None):
+    return _loaded().get(key, default)
+
+
+def put(key, value):
+    """Store value (anything JSON can encode); unchanged values are not written."""
+    data = _loaded()
+    if key in data and data[key] == value:
+        return False
+    old = data.get(key)
+    had = key in data
+    data[key] = value
+    try:
+        _append(key, value)
+    except Exception:
+        if had:
+            data[key] = old
+        else:
+            data.pop(key, None)
+        raise
+    return True
+
+
+def delete(key):
+    data = _loaded()
+    if key not in data:
+        return False
+    old = data.pop(key)
+    try:
+        _append(key, None)
+    except Exception:
+        data[key] = old
+        raise
+    return True
+
+
+def stats():
+    data = _loaded()
+    return {"file": KV_FILE, "bytes": _size, "keys": len(data), "max_bytes": MAX_BYTES,
+            "compactions": _compactions}
+
+
+def define(key, default, check=None, on_change=None, secret=False):
+    """Declare a setting; returns its stored value, or default if there is none
+    or the stored one no longer passes the type/check test. on_change(value)
+    is called when update()/reset() change it; secret values are masked in
+    settings()."""
+    entry = _schema[key] = [default, check, on_change, default, secret]
+    value = get(key)
+    if value is not None:
+        try:
+            entry[3] = _validate(key, value)
+        except ValueError as e:
+            print("Settings: ignoring stored {}: {}".format(key, e))
+    return entry[3]
+
+
+def _validate(key, value):
+    if key not in _schema:
+        raise ValueError("unknown setting " + key)
+    default, check = _schema[key][:2]
+    if type(value) is not type(default):
+        raise ValueError("{} must be {}".format(key, type(default).__name__))
+    if check:
+        try:
+            check(value)
+        except ValueError as e:
+            raise ValueError("{} {}".format(key, e))
+    return value
+
+
+def update(key, value):
+    """Validate, store and apply a defined setting (raises ValueError)."""
+    _validate(key, value)
+    changed = put(key, value)
+    entry = _schema[key]
+    entry[3] = value
+    if entry[2]:
+        entry[2](value)
+    return changed
+
+
+def reset(key):
+    """Forget the stored value of a defined setting and apply its default."""
+    if key not in _schema:
+        raise ValueError("unknown setting " + key)
+    delete(key)
+    entry = _schema[key]
+    entry[3] = entry[0]
+    if entry[2]:
+        entry[2](entry[0])
+    return entry[0]
+
+
+def settings(reveal=False):
+    """The value in effect of every defined setting."""
+    out = {}
+    for key, entry in _schema.items():
+        out[key] = "********" if entry[4] and not reveal else entry[3]
+    return out
+
+
+def parse(key, text):
+    """BLE/HTTP text to a value for key: as is for text settings, JSON for the
+    rest ("5", '{"year": 2035, ...}')."""
+    if key not in _schema:
+        raise ValueError("unknown setting " + key)
+    if type(_schema[key][0]) is str:
+        return text
+    try:
+        return json.loads(text)
+    except ValueError:
+        raise ValueError("{} is not valid JSON: {}".format(key, text))
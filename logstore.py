@@ -0,0 +1,407 @@
+# logstore.py (MicroPython)
+# Tiered relay log. New entries are appended to relay_log.txt (the active
+# segment, same "YYYY-MM-DD HH:MM:SS — action (Duration: N min)" lines as
+# before). When the day changes or the segment reaches SEGMENT_MAX_BYTES it is
+# rotated into logs/ on flash and, whenever the SD card is mounted, moved on to
+# /sd/logs/ (deflate-compressed if the firmware has the deflate module).
+# Each tier keeps an index.txt with one line per segment:
+#
+#   first timestamp|last timestamp|entries|segment file
+#
+# so a query for a date range opens only the segments that overlap it.
+import os
+try:
+    import deflate
+except ImportError:
+    deflate = None
+# CPython has no deflate module; zlib writes the same zlib-wrapped stream
+try:
+    import zlib
+except ImportError:
+    zlib = None
+from blockwriter import open_writer
+
+ACTIVE_LOG = "relay_log.txt"
+LOCAL_DIR = "logs"
+SD_DIR = "/sd/logs"
+INDEX_NAME = "index.txt"
+SEGMENT_MAX_BYTES = 8192
+LOCAL_MAX_SEGMENTS = 16   # Oldest flash segments are dropped beyond this while there is no SD
+COMPRESS = True           # Deflate segments moved to SD (when a codec is available)
+TS_LEN = 19               # len("YYYY-MM-DD HH:MM:SS")
+READ_CHUNK = 512
+
+_active = None  # [first timestamp or None, size] of ACTIVE_LOG, read lazily
+
+
+def _exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+def _ensure_dir(path):
+    if not _exists(path):
+        os.mkdir(path)
+
+
+def _can_compress():
+    return COMPRESS and (deflate is not None or zlib is not None)
+
+
+def _read_chunks(path):
+    """Yield the (decompressed) contents of a segment in pieces."""
+    with open(path, "rb") as f:
+        if not path.endswith(".z"):
+            while True:
+                chunk = f.read(READ_CHUNK)
+                if not chunk:
+                    return
+                yield chunk
+        elif deflate is not None:
+            d = deflate.DeflateIO(f, deflate.ZLIB)
+            while True:
+                chunk = d.read(READ_CHUNK)
+                if not chunk:
+                    return
+                yield chunk
+        else:
+            d = zlib.decompressobj()
+            while True:
+                chunk = f.read(READ_CHUNK)
+                if not chunk:
+                    yield d.flush()
+                    return
+                yield d.decompress(chunk)
+
+
+def read_lines(path):
+    """Yield the lines of a segment (compressed or not) without their newline."""
+    rest = b""
+    for chunk in _read_chunks(path):
+        rest += chunk
+        lines = rest.split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            if line:
+                yield line.decode()
+    if rest:
+        yield rest.decode()
+
+
+def _active_info():
+    global _active
+    if _active is None:
+        first = None
+        size = 0
+        try:
+            size = os.stat(ACTIVE_LOG)[6]
+            with open(ACTIVE_LOG) as f:
+                line = f.readline()
+            if len(line) >= TS_LEN:
+                first = line[:TS_LEN]
+        except OSError:
+            pass
+        _active = [first, size]
+    return _active
+
+
+def _read_index(d):
+    entries = []
+    try:
+        with open(f"{d}/{INDEX_NAME}") as f:
+            for line in f:
+                parts = line.rstrip("\n").split("|")
+                if len(parts) == 4:
+                    entries.append((parts[0], parts[1], int(parts[2]), f"{d}/{parts[3]}"))
+    except (OSError, ValueError):
+        pass
+    return entries
+
+
+def _write_index(d, entries):
+    tmp = f"{d}/{INDEX_NAME}.tmp"
+    with open(tmp, "w") as f:
+        for first, last, count, path in entries:
+            f.write("%s|%s|%d|%s\n" % (first, last, count, path.rsplit("/", 1)[-1]))
+    try:
+        os.rename(tmp, f"{d}/{INDEX_NAME}")
+    except OSError:
+        os.remove(f"{d}/{INDEX_NAME}")
+        os.rename(tmp, f"{d}/{INDEX_NAME}")
+
+
+def _add_index(d, entry):
+    with open(f"{d}/{INDEX_NAME}", "a") as f:
+        f.write("%s|%s|%d|%s\n" % (entry[0], entry[1], entry[2], entry[3].rsplit("/", 1)[-1]))
+
+
+def _segment_name(d, first, suffix):
+    base = first.replace("-", "").replace(":", "").replace(" ", "-")
+    name = f"{d}/{base}{suffix}"
+    n = 1
+    while _exists(name):
+        name = f"{d}/{base}_{n}{suffix}"
+        n += 1
+    return name
+
+
+def append(timestamp, line):
+    """Append one log line (timestamp is its "YYYY-MM-DD HH:MM:SS" prefix)."""
+    info = _active_info()
+    if info[0] and (info[0][:10] != timestamp[:10] or info[1] >= SEGMENT_MAX_BYTES):
+        rotate()
+        info = _active_info()
+    data = (line.rstrip("\n") + "\n").encode()
+    with open_writer(ACTIVE_LOG, "ab") as w:
+        w.write(data)
+    if info[0] is None:
+        info[0] = timestamp
+    info[1] += len(data)
+
+
+def rotate():
+    """Close the active segment: move it into logs/ and offload to SD if possible."""
+    global _active
+    first = last = None
+    count = 0
+    try:
+        for line in read_lines(ACTIVE_LOG):
+            if len(line) >= TS_LEN:
+                first = first or line[:TS_LEN]
+                last = line[:TS_LEN]
+                count += 1
+    except OSError:
+        pass
+    _active = None
+    if not count:
+        return None
+    _ensure_dir(LOCAL_DIR)
+    path = _segment_name(LOCAL_DIR, first, ".log")
+    os.rename(ACTIVE_LOG, path)
+    _add_index(LOCAL_DIR, (first, last, count, path))
+    print(f"Log segment {path}: {count} entries {first} .. {last}")
+    offload()
+    return path
+
+
+def _sd_ready():
+    try:
+        os.stat(SD_DIR.rsplit("/", 1)[0] or "/")
+    except OSError:
+        return False
+    try:
+        _ensure_dir(SD_DIR)
+        return True
+    except OSError:
+        return False
+
+
+def _copy_segment(src, dst):
+    if dst.endswith(".z"):
+        with open(dst, "wb") as fo:
+            if deflate is not None:
+                with deflate.DeflateIO(fo, deflate.ZLIB) as d:
+                    for chunk in _read_chunks(src):
+                        d.write(chunk)
+            else:
+                c = zlib.compressobj()
+                for chunk in _read_chunks(src):
+                    fo.write(c.compress(chunk))
+                fo.write(c.flush())
+    else:
+        with open_writer(dst) as w:
+            for chunk in _read_chunks(src):
+                w.write(chunk)
+
+
+def offload():
+    """Move flash segments to the SD card; returns how many were moved.
+
+    Without an SD card only the newest LOCAL_MAX_SEGMENTS are kept on flash.
+    """
+    local = _read_index(LOCAL_DIR)
+    if not local:
+        return 0
+    if not _sd_ready():
+        if len(local) > LOCAL_MAX_SEGMENTS:
+            for first, last, count, path in local[:-LOCAL_MAX_SEGMENTS]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            _write_index(LOCAL_DIR, local[-LOCAL_MAX_SEGMENTS:])
+        return 0
+    moved = 0
+    while local:
+        first, last, count, path = local[0]
+        dst = _segment_name(SD_DIR, first, ".log.z" if _can_compress() else ".log")
+        try:
+            _copy_segment(path, dst)
+            _add_index(SD_DIR, (first, last, count, dst))
+        except OSError as e:
+            print("Log offload failed:", e)
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        local.pop(0)
+        _write_index(LOCAL_DIR, local)
+        moved += 1
+    if moved:
+        print(f"Moved {moved} log segment(s) to {SD_DIR}")
+    return moved
+
+
+def segments():
+    """All closed segments, oldest first: [(first, last, entries, path)]."""
+    return _read_index(SD_DIR) + _read_index(LOCAL_DIR)
+
+
+def _bounds(start, end):
+    # "2026-03-01T08:00" -> "2026-03-01 08:00"; a partial end covers the whole
+    # month/day/minute it names ("2026-03" -> "2026-03-31 23:59:59")
+    if start:
+        start = start.replace("T", " ")
+    if end:
+        end = end.replace("T", " ")
+        end += "9999-12-31 23:59:59"[len(end):]
+    return start, end
+
+
+def _first_segment(segs, start):
+    """Index of the first segment that can hold start (binary search on the
+    index's last timestamps, which are in time order)."""
+    lo, hi = 0, len(segs)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if segs[mid][1] < start:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _seek_offset(path, start):
+    """Byte offset of the first line with timestamp >= start in an uncompressed
+    segment, found by bisecting over file offsets (O(log n) seeks)."""
+    key = start.encode()
+    with open(path, "rb") as f:
+        # lo is always a line start at or before the answer, hi at or after it
+        lo, hi = 0, os.stat(path)[6]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mid > lo:
+                f.seek(mid - 1)
+                f.readline()  # to the first line starting at or after mid
+                pos = f.tell()
+                if pos >= hi:
+                    pos = lo
+            else:
+                pos = lo
+            f.seek(pos)
+            line = f.readline()
+            if line[:TS_LEN] < key:
+                lo = pos + len(line)
+            else:
+                hi = pos
+        return lo
+
+
+def _lines_from(path, start):
+    if start and not path.endswith(".z"):
+        offset = _seek_offset(path, start)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                line = line.rstrip(b"\n")
+                if line:
+                    yield line.decode()
+        return
+    for line in read_lines(path):
+        yield line
+
+
+def query(start=None, end=None):
+    """Yield log lines with start <= timestamp <= end (either may be None).
+
+    The segment index is bisected to the first segment that can match, and
+    uncompressed segments are bisected by offset, so finding the start of a
+    range costs O(log n) seeks; reading stops at the first line past end.
+    """
+    start, end = _bounds(start, end)
+    segs = segments()
+    first = _first_segment(segs, start) if start else 0
+    paths = [s[3] for s in segs[first:]]
+    paths.append(ACTIVE_LOG)
+    for path in paths:
+        try:
+            for line in _lines_from(path, start):
+                ts = line[:TS_LEN]
+                if start and ts < start:
+                    continue
+                if end and ts > end:
+                    # Segments are in time order: nothing later can match
+                    return
+                yield line
+        except OSError:
+            pass
+
+
+def parse(line):
+    """Split a log line into (timestamp, action, duration minutes or None)."""
+    rest = line[TS_LEN:].lstrip(" -\u2014")
+    duration = None
+    idx = rest.find("(Duration:")
+    if idx >= 0:
+        try:
+            duration = int(rest[idx + 10:].split()[0])
+        except (ValueError, IndexError):
+            pass
+        rest = rest[:idx]
+    return line[:TS_LEN], rest.strip(), duration
+
+
+def history(start=None, end=None, action=None, limit=None):
+    """Yield (timestamp, action, duration) records in time order, optionally
+    only those whose action contains all words of action ("on", "off",
+    "manual timeout"), at most limit of them."""
+    words = action.lower().split() if action else None
+    count = 0
+    for line in query(start, end):
+        rec = parse(line)
+        if words:
+            have = rec[1].lower().replace("(", " ").replace(")", " ").split()
+            if [w for w in words if w not in have]:
+                continue
+        yield rec
+        count += 1
+        if limit and count >= limit:
+            return
+
+
+def tail(n):
+    """The last n log lines, reading older segments only when needed."""
+    lines = []
+    try:
+        lines = list(read_lines(ACTIVE_LOG))[-n:]
+    except OSError:
+        pass
+    older = segments()
+    while len(lines) < n and older:
+        try:
+            lines = list(read_lines(older.pop()[3]))[-(n - len(lines)):] + lines
+        except OSError:
+            pass
+    return lines
+
+
+def clear():
+    """Empty the active segment (closed segments and the SD archive are kept)."""
+    global _active
+    with open(ACTIVE_LOG, "w") as f:
+        f.write("")
+    _active = None
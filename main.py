@@ -1,3 +1,13 @@
-import water_main
+# Boot loader: runs the newest confirmed code slot (see ota.py), falling back
+# to the files at the root of the flash.
+try:
+    import ota
+except ImportError:
+    ota = None
 
-water_main.main()
\ No newline at end of file
+if ota:
+    ota.run()
+else:
+    import water_main
+
+    water_main.main()
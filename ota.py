@@ -0,0 +1,350 @@
+# ota.py (MicroPython)
+# A/B code slots for safe updates. New code is staged into slots/a or slots/b
+# (whichever is not running), hashed into a manifest and verified, and only
+# then marked pending in boot_slot.json. main.py calls run(), which boots the
+# pending slot as a trial: the runtime must call confirm() once it is healthy
+# (water_main does this when the scheduler has ticked and BLE is up) within
+# HEALTH_TIMEOUT_SEC, otherwise the previous slot is restored and the board
+# resets. A trial that crashes, hangs or resets before confirming also rolls
+# back, so a bad upload costs one reboot instead of a site visit.
+#
+# Files not in the active slot come from the root of the flash as before, so
+# a device that has never been updated (no boot_slot.json) runs unchanged.
+import os
+import sys
+import time
+try:
+    import ujson as json
+except ImportError:
+    import json
+try:
+    import hashlib
+except ImportError:
+    hashlib = None
+try:
+    import ubinascii as binascii
+except ImportError:
+    import binascii
+# machine only exists on the Pico; under CPython the module can still stage
+# and verify slots (useful for testing on a PC)
+try:
+    import machine
+except ImportError:
+    machine = None
+
+SLOTS_DIR = "slots"
+SLOTS = ("a", "b")
+BOOT_FILE = "boot_slot.json"
+MANIFEST = "manifest.json"
+HEALTH_TIMEOUT_SEC = 120   # Trial boots must confirm() within this time
+HEALTH_GRACE_SEC = 30      # Extra time before the backstop timer rolls back
+TRIAL_BOOTS = 1            # Boots a trial gets before it is rolled back
+ROOT_ONLY = ("ota.py", "boot.py", BOOT_FILE)  # Never staged: the loader itself
+
+_trial_timer = None
+_running = False
+
+
+def slot_dir(slot):
+    return f"{SLOTS_DIR}/{slot}"
+
+
+def _default_state():
+    return {"active": None, "previous": None, "pending": None, "trial": False,
+            "boots": 0, "last_rollback": None}
+
+
+def load_state():
+    state = _default_state()
+    try:
+        with open(BOOT_FILE) as f:
+            state.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    return state
+
+
+def _save_state(state):
+    tmp = BOOT_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    try:
+        os.rename(tmp, BOOT_FILE)
+    except OSError:
+        os.remove(BOOT_FILE)
+        os.rename(tmp, BOOT_FILE)
+
+
+def _is_dir(path):
+    try:
+        return os.stat(path)[0] & 0x4000 != 0
+    except OSError:
+        return False
+
+
+def _file_hash(path):
+    """Hex SHA-256 of a file (CRC32 where hashlib is missing)."""
+    if hashlib:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(1024)
+                if not chunk:
+                    break
+                h.update(chunk)
+        return binascii.hexlify(h.digest()).decode()
+    crc = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024)
+            if not chunk:
+                break
+            crc = binascii.crc32(chunk, crc)
+    return "%08x" % (crc & 0xFFFFFFFF)
+
+
+def _copy(src, dst):
+    with open(src, "rb") as fi, open(dst + ".tmp", "wb") as fo:
+        while True:
+            chunk = fi.read(1024)
+            if not chunk:
+                break
+            fo.write(chunk)
+    try:
+        os.rename(dst + ".tmp", dst)
+    except OSError:
+        os.remove(dst)
+        os.rename(dst + ".tmp", dst)
+
+
+def _slot_files(slot):
+    d = slot_dir(slot)
+    try:
+        names = os.listdir(d)
+    except OSError:
+        return []
+    return [n for n in names if n != MANIFEST and not n.endswith(".tmp") and not _is_dir(f"{d}/{n}")]
+
+
+def stage_begin():
+    """Return the slot to stage into, ready for files to be added.
+
+    A slot that is already pending (staged but not booted yet) is reused, so
+    several uploads before a reboot land in the same update. Otherwise the
+    inactive slot is emptied and seeded with the running slot's files, so every
+    slot holds a complete set of the code that was updated through it.
+    """
+    state = load_state()
+    if state["pending"]:
+        return state["pending"]
+    if state["trial"]:
+        # The inactive slot is what a rollback would return to
+        raise OSError("slot %s is still on trial" % state["active"])
+    slot = "b" if state["active"] == "a" else "a"
+    if state["previous"] == slot:
+        # Its old code is about to be wiped: rollback now goes to the root files
+        state["previous"] = None
+        _save_state(state)
+    for d in (SLOTS_DIR, slot_dir(slot)):
+        if not _is_dir(d):
+            os.mkdir(d)
+    for name in os.listdir(slot_dir(slot)):
+        try:
+            os.remove(f"{slot_dir(slot)}/{name}")
+        except OSError:
+            pass
+    if state["active"]:
+        for name in _slot_files(state["active"]):
+            _copy(f"{slot_dir(state['active'])}/{name}", f"{slot_dir(slot)}/{name}")
+    return slot
+
+
+def check_name(name):
+    """Raise ValueError unless name can go into a slot (flat file, not the loader)."""
+    if not name or "/" in name or name.startswith(".") or name in ROOT_ONLY:
+        raise ValueError(f"cannot stage {name}")
+
+
+def is_code(name):
+    """True for files that are staged into a slot rather than written to the
+    root: flat .py files (main.py included) other than the loader."""
+    return ("/" not in name and name.endswith(".py") and not name.startswith(".")
+            and name not in ROOT_ONLY)
+
+
+def stage_finish(slot):
+    """Hash the slot into its manifest, verify it and mark it pending.
+
+    Returns the manifest's file -> hash dict; raises OSError if the files read
+    back differently (the slot is then left unpending).
+    """
+    d = slot_dir(slot)
+    files = {}
+    for name in _slot_files(slot):
+        files[name] = _file_hash(f"{d}/{name}")
+    with open(f"{d}/{MANIFEST}", "w") as f:
+        json.dump({"algo": "sha256" if hashlib else "crc32", "files": files}, f)
+    bad = verify(slot)
+    state = load_state()
+    if bad:
+        state["pending"] = None
+        _save_state(state)
+        raise OSError("slot %s failed verification: %s" % (slot, ", ".join(bad)))
+    state["pending"] = slot
+    _save_state(state)
+    print(f"OTA: slot {slot} staged ({len(files)} files), boots on next reset")
+    return files
+
+
+def stage_file(name, src):
+    """Stage one file (copied from src) into the pending slot; returns the slot."""
+    check_name(name)
+    slot = stage_begin()
+    _copy(src, f"{slot_dir(slot)}/{name}")
+    stage_finish(slot)
+    return slot
+
+
+def verify(slot):
+    """Return the names whose hash does not match the slot's manifest ([] = good)."""
+    d = slot_dir(slot)
+    try:
+        with open(f"{d}/{MANIFEST}") as f:
+            files = json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        return [MANIFEST]
+    bad = []
+    for name, digest in files.items():
+        try:
+            if _file_hash(f"{d}/{name}") != digest:
+                bad.append(name)
+        except OSError:
+            bad.append(name)
+    return bad
+
+
+def cancel():
+    """Drop a staged (pending) slot before it is booted."""
+    state = load_state()
+    state["pending"] = None
+    _save_state(state)
+
+
+def in_trial():
+    return load_state()["trial"]
+
+
+def confirm():
+    """Keep the running trial slot: call once the new code is known to work."""
+    global _trial_timer
+    state = load_state()
+    if _trial_timer is not None:
+        _trial_timer.deinit()
+        _trial_timer = None
+    if not state["trial"]:
+        return False
+    state["trial"] = False
+    state["boots"] = 0
+    _save_state(state)
+    print(f"OTA: slot {state['active']} confirmed")
+    return True
+
+
+def rollback(reason):
+    """Switch back to the slot that ran before the current one (None = root files).
+    An update staged on top of the current slot is dropped as well."""
+    state = load_state()
+    print(f"OTA: rolling back from slot {state['active']} to {state['previous'] or 'root'}: {reason}")
+    state["active"] = state["previous"]
+    state["previous"] = None
+    state["pending"] = None
+    state["trial"] = False
+    state["boots"] = 0
+    state["last_rollback"] = reason
+    _save_state(state)
+
+
+def status():
+    state = load_state()
+    state["health_timeout_sec"] = HEALTH_TIMEOUT_SEC
+    return state
+
+
+def boot():
+    """Pick the slot to run at power-up; returns its directory or None for root."""
+    state = load_state()
+    if state["pending"]:
+        slot = state["pending"]
+        state["pending"] = None
+        bad = verify(slot)
+        if bad:
+            state["last_rollback"] = "slot %s failed verification: %s" % (slot, ", ".join(bad))
+            print("OTA:", state["last_rollback"])
+        else:
+            state["previous"] = state["active"]
+            state["active"] = slot
+            state["trial"] = True
+            state["boots"] = 0
+        _save_state(state)
+    if state["trial"]:
+        state["boots"] += 1
+        if state["boots"] > TRIAL_BOOTS:
+            # The last trial boot reset or hung before confirming
+            rollback("trial slot %s not confirmed" % state["active"])
+            state = load_state()
+        else:
+            _save_state(state)
+            print(f"OTA: trial boot of slot {state['active']}, "
+                  f"must confirm within {HEALTH_TIMEOUT_SEC} s")
+    return slot_dir(state["active"]) if state["active"] else None
+
+
+def _fail(reason):
+    rollback(reason)
+    if machine:
+        time.sleep(1)
+        machine.reset()
+
+
+def _on_trial_timeout(timer):
+    if in_trial():
+        _fail("health check timed out")
+
+
+def run():
+    """Entry point for main.py: boot the chosen slot and run the application."""
+    global _trial_timer, _running
+    if _running:
+        # A staged main.py that is itself the loader: just start the runtime
+        import water_main
+        water_main.main()
+        return
+    _running = True
+    path = boot()
+    if path:
+        sys.path.insert(0, path)
+    trial = in_trial()
+    if trial and machine:
+        # Backstop for a runtime that never gets as far as its own health check
+        _trial_timer = machine.Timer(mode=machine.Timer.ONE_SHOT,
+                                     period=(HEALTH_TIMEOUT_SEC + HEALTH_GRACE_SEC) * 1000,
+                                     callback=_on_trial_timeout)
+    try:
+        entry = None
+        if path:
+            # An uploaded main.py is the application entry point of its slot
+            try:
+                with open(f"{path}/main.py") as f:
+                    entry = f.read()
+            except OSError:
+                pass
+        if entry:
+            exec(entry, {"__name__": "__main__"})
+        else:
+            import water_main
+            water_main.main()
+    except Exception as e:
+        if not trial:
+            raise
+        print("OTA: trial slot crashed:", e)
+        _fail("crashed: %s" % e)
@@ -0,0 +1,198 @@
+# runstats.py (MicroPython)
+# Cumulative relay ON time per day, week and month, kept as counters so that
+# "how long did this unit water last week" needs no pass over the log.
+# runstats.bin is created once at its full size and holds three fixed-size
+# ring tables of 12-byte buckets after a 20-byte header:
+#
+#   header   "RST1", total seconds, total runs, table sizes
+#   days     DAY_BUCKETS   x (key + 1, seconds ON, runs, 0)
+#   weeks    WEEK_BUCKETS  x (key = day number of the Monday)
+#   months   MONTH_BUCKETS x (key = year * 12 + month - 1)
+#
+# A bucket sits at a fixed slot for its key; a slot holding another key is
+# from an older period and reads as zero. Each relay transition rewrites one
+# bucket per table plus the header, so an update costs the same however long
+# the unit has been running.
+import struct
+import time
+
+STATS_FILE = "runstats.bin"
+DAY_BUCKETS = 400     # A bit over a year of days
+WEEK_BUCKETS = 106    # Two years of weeks
+MONTH_BUCKETS = 36    # Three years of months
+MAX_RUN_SEC = 13 * 3600  # Longest run credited (manual mode stops at 12 h); guards clock jumps
+MAGIC = b"RST1"
+PERIODS = ("day", "week", "month")
+
+_HEADER = ">4sIIHHHH"
+_HEADER_SIZE = 20
+_REC = ">IIHH"
+_REC_SIZE = 12
+_SIZES = (DAY_BUCKETS, WEEK_BUCKETS, MONTH_BUCKETS)
+_STEPS = (1, 7, 1)    # Week keys are Monday day numbers, 7 apart
+
+# Seconds since the epoch; water_main points this at the DS3231 so the buckets
+# follow the RTC date
+clock = time.time
+
+_on_since = None  # Start of the current run (RAM only: a reset switches the relay off)
+
+
+def _keys(unix):
+    day = unix // 86400
+    t = time.localtime(day * 86400)
+    return day, day - t[6], t[0] * 12 + t[1] - 1
+
+
+def _slot(table, key):
+    offset = _HEADER_SIZE
+    for i in range(table):
+        offset += _SIZES[i] * _REC_SIZE
+    return offset + (key // _STEPS[table]) % _SIZES[table] * _REC_SIZE
+
+
+def _create():
+    zero = bytes(_REC_SIZE * 16)
+    with open(STATS_FILE, "wb") as f:
+        f.write(struct.pack(_HEADER, MAGIC, 0, 0, DAY_BUCKETS, WEEK_BUCKETS, MONTH_BUCKETS, 0))
+        for size in _SIZES:
+            left = size * _REC_SIZE
+            while left:
+                n = min(left, len(zero))
+                f.write(zero[:n])
+                left -= n
+
+
+def _open():
+    """runstats.bin opened for update, (re)created if missing or laid out for
+    other table sizes."""
+    try:
+        f = open(STATS_FILE, "r+b")
+        head = f.read(_HEADER_SIZE)
+        if len(head) == _HEADER_SIZE:
+            magic, _, _, days, weeks, months, _ = struct.unpack(_HEADER, head)
+            if magic == MAGIC and (days, weeks, months) == _SIZES:
+                return f
+        f.close()
+        print("Run stats: table sizes changed, starting a new", STATS_FILE)
+    except OSError:
+        pass
+    _create()
+    return open(STATS_FILE, "r+b")
+
+
+def _read(f, table, key):
+    f.seek(_slot(table, key))
+    k, seconds, runs, _ = struct.unpack(_REC, f.read(_REC_SIZE))
+    if k != key + 1:
+        return 0, 0
+    return seconds, runs
+
+
+def _bump(f, table, key, seconds, runs):
+    seconds_old, runs_old = _read(f, table, key)
+    f.seek(_slot(table, key))
+    f.write(struct.pack(_REC, key + 1, seconds_old + seconds, min(0xFFFF, runs_old + runs), 0))
+
+
+def _add(f, unix, seconds, runs):
+    keys = _keys(unix)
+    for table in range(3):
+        _bump(f, table, keys[table], seconds, runs)
+
+
+def _add_total(f, seconds, runs):
+    f.seek(4)
+    total, count = struct.unpack(">II", f.read(8))
+    f.seek(4)
+    f.write(struct.pack(">II", total + seconds, count + runs))
+
+
+def record_on(unix=None):
+    """The relay switched ON: count a run for today and start timing it."""
+    global _on_since
+    if _on_since is not None:
+        return
+    if unix is None:
+        unix = int(clock())
+    _on_since = unix
+    with _open() as f:
+        _add(f, unix, 0, 1)
+        _add_total(f, 0, 1)
+
+
+def record_off(unix=None):
+    """The relay switched OFF: credit the seconds since record_on(), split at
+    midnight so each day gets its own share. Returns the seconds credited."""
+    global _on_since
+    if _on_since is None:
+        return 0
+    start = _on_since
+    _on_since = None
+    if unix is None:
+        unix = int(clock())
+    start = max(start, unix - MAX_RUN_SEC)
+    if unix <= start:
+        return 0
+    with _open() as f:
+        t = start
+        while t < unix:
+            cut = min(unix, (t // 86400 + 1) * 86400)
+            _add(f, t, cut - t, 0)
+            t = cut
+        _add_total(f, unix - start, 0)
+    return unix - start
+
+
+def running(unix=None):
+    """Seconds the current run has lasted so far, or None while OFF."""
+    if _on_since is None:
+        return None
+    return max(0, (int(clock()) if unix is None else unix) - _on_since)
+
+
+def _label(table, key):
+    if table == 2:
+        return "%04d-%02d" % (key // 12, key % 12 + 1)
+    return "%04d-%02d-%02d" % time.localtime(key * 86400)[:3]
+
+
+def _entry(f, table, key):
+    seconds, runs = _read(f, table, key)
+    return {"start": _label(table, key), "seconds": seconds, "runs": runs}
+
+
+def summary(unix=None):
+    """ON time of today/yesterday, this/last week and month, and all time.
+    Each period is {"start", "seconds", "runs"}; the run in progress is not
+    in them yet (see "running")."""
+    if unix is None:
+        unix = int(clock())
+    day, week, month = _keys(unix)
+    with _open() as f:
+        f.seek(4)
+        total, count = struct.unpack(">II", f.read(8))
+        return {
+            "today": _entry(f, 0, day),
+            "yesterday": _entry(f, 0, day - 1),
+            "this_week": _entry(f, 1, week),
+            "last_week": _entry(f, 1, week - 7),
+            "this_month": _entry(f, 2, month),
+            "last_month": _entry(f, 2, month - 1),
+            "total": {"seconds": total, "runs": count},
+            "running": running(unix),
+        }
+
+
+def series(period="day", n=7, unix=None):
+    """The last n days, weeks or months (newest first), at most a table's size."""
+    table = PERIODS.index(period)
+    if unix is None:
+        unix = int(clock())
+    key = _keys(unix)[table]
+    out = []
+    with _open() as f:
+        for _ in range(max(0, min(n, _SIZES[table]))):
+            out.append(_entry(f, table, key))
+            key -= _STEPS[table]
+    return out
@@ -0,0 +1,330 @@
+# telemetry.py (MicroPython)
+# Timing instrumentation for the control loop. Measurements go into
+# fixed-size histograms (a count per bucket plus count/sum/min/max), so
+# recording costs a short scan and memory use never grows however long the
+# unit runs. Percentiles are read from the buckets: each is the upper edge of
+# the bucket the percentile falls in (the exact max is kept separately).
+#
+#   t0 = ticks_us()
+#   scheduler_step(...)
+#   telemetry.record("scheduler_step", ticks_diff(ticks_us(), t0))
+#   telemetry.report()   # {"histograms": {"scheduler_step": {"unit": "us", "p99": ...}}}
+#
+# The memory monitor (mem_*) samples the heap, keeps its low-water mark and
+# the MemoryErrors seen, and switches to a low-memory mode below MEM_FLOOR in
+# which uploads and large log reads are refused (low_memory()).
+#
+# The metrics registry (observe()) counts requests, errors and bytes per BLE
+# command verb and HTTP route, each with a latency histogram, and exports
+# everything as Prometheus text (prometheus()) for /api/metrics. Its counters
+# run from boot and are never reset, as a scraper expects of a counter.
+import gc
+try:
+    from time import ticks_us, ticks_ms, ticks_diff
+except ImportError:
+    import time
+
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+
+    def ticks_ms():
+        return int(time.perf_counter() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+# Bucket upper edges; values above the last edge land in an overflow bucket
+US_BOUNDS = (100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000,
+             100000, 200000, 500000, 1000000, 2000000, 5000000, 10000000)
+MS_BOUNDS = (0, 10, 50, 100, 250, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+S_BOUNDS = (0, 1, 2, 5, 10, 20, 30, 45, 60, 120, 300)
+PERCENTILES = (50, 90, 99)
+
+# Low-memory mode starts when free heap stays below MEM_FLOOR after a collect
+# and ends once it is back above MEM_RESUME
+MEM_FLOOR = 24 * 1024
+MEM_RESUME = 32 * 1024
+# Collect after this fraction of the free heap has been allocated (gc.threshold),
+# so garbage is reclaimed before a large buffer is needed, not when it fails
+GC_THRESHOLD_DIV = 4
+# Most names tracked per kind ("ble", "http"); later ones are counted as "other"
+METRICS_MAX_NAMES = 32
+_UNIT_SECONDS = {"us": 1000000, "ms": 1000, "s": 1}
+
+
+class Histogram:
+    """Fixed buckets over bounds (ascending upper edges) plus an overflow bucket."""
+
+    def __init__(self, bounds=US_BOUNDS, unit="us"):
+        self.bounds = bounds
+        self.unit = unit
+        self.counts = [0] * (len(bounds) + 1)
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        i = 0
+        bounds = self.bounds
+        n = len(bounds)
+        while i < n and value > bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Upper edge of the bucket holding the p-th percentile, clamped to the
+        observed min/max, or None when empty."""
+        if not self.count:
+            return None
+        rank = (self.count * p + 99) // 100
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                if i == len(self.bounds):
+                    return self.max
+                return min(max(self.bounds[i], self.min), self.max)
+        return self.max
+
+    def summary(self, buckets=True):
+        out = {"unit": self.unit, "count": self.count, "min": self.min, "max": self.max,
+               "mean": self.total // self.count if self.count else None}
+        for p in PERCENTILES:
+            out["p%d" % p] = self.percentile(p)
+        if buckets:
+            out["buckets"] = [[self.bounds[i] if i < len(self.bounds) else None, c]
+                              for i, c in enumerate(self.counts) if c]
+        return out
+
+
+_hists = {}
+_metrics = {}  # (kind, name) -> [requests, errors, bytes in, bytes out, Histogram]
+_since = ticks_ms()
+
+
+def histogram(name, bounds=US_BOUNDS, unit="us"):
+    """The histogram called name, created with bounds/unit on first use."""
+    h = _hists.get(name)
+    if h is None:
+        h = _hists[name] = Histogram(bounds, unit)
+    return h
+
+
+def record(name, value):
+    h = _hists.get(name)
+    if h is None:
+        h = histogram(name)
+    h.add(value)
+
+
+def report(buckets=True):
+    """{"since_ms": ms since the last reset, "histograms": {name: summary}}."""
+    return {"since_ms": ticks_diff(ticks_ms(), _since),
+            "histograms": {name: h.summary(buckets) for name, h in _hists.items()}}
+
+
+def reset():
+    """Clear the timing histograms (the request metrics keep counting)."""
+    global _since
+    for h in _hists.values():
+        h.reset()
+    _since = ticks_ms()
+
+
+_mem = {"min_free": None, "low": False, "low_entered": 0, "errors": 0,
+        "largest_failed": None, "last_error": None, "threshold": None, "largest_block": None}
+
+
+def _heap():
+    try:
+        return gc.mem_free(), gc.mem_alloc()
+    except AttributeError:
+        # CPython: no heap figures, never low on memory
+        return None, None
+
+
+def mem_setup(floor=None):
+    """Set gc.threshold from the current heap and optionally a new floor (bytes)."""
+    global MEM_FLOOR, MEM_RESUME
+    if floor is not None:
+        MEM_RESUME = MEM_RESUME - MEM_FLOOR + floor
+        MEM_FLOOR = floor
+    gc.collect()
+    free, alloc = _heap()
+    if free is not None:
+        try:
+            threshold = free // GC_THRESHOLD_DIV + alloc
+            gc.threshold(threshold)
+            _mem["threshold"] = threshold
+        except AttributeError:
+            pass
+    return mem_sample()
+
+
+def mem_sample():
+    """Read the heap, update the low-water mark and the low-memory mode;
+    returns the free bytes (None where the port cannot tell)."""
+    free = _heap()[0]
+    if free is None:
+        return None
+    if free < MEM_FLOOR and not _mem["low"]:
+        gc.collect()
+        free = _heap()[0]
+        if free < MEM_FLOOR:
+            _mem["low"] = True
+            _mem["low_entered"] += 1
+            print("Low memory: {} bytes free, refusing uploads and large reads".format(free))
+    elif _mem["low"] and free >= MEM_RESUME:
+        _mem["low"] = False
+        print("Memory recovered: {} bytes free".format(free))
+    if _mem["min_free"] is None or free < _mem["min_free"]:
+        _mem["min_free"] = free
+    return free
+
+
+def low_memory(sample=True):
+    """True while in low-memory mode (re-sampled first unless sample is False)."""
+    if sample:
+        mem_sample()
+    return _mem["low"]
+
+
+def mem_error(where, exc=None):
+    """Count a MemoryError caught at where; the allocation size is taken from
+    MicroPython's "memory allocation failed, allocating N bytes"."""
+    _mem["errors"] += 1
+    _mem["last_error"] = where
+    try:
+        size = int(str(exc).split("allocating ")[1].split()[0])
+        if _mem["largest_failed"] is None or size > _mem["largest_failed"]:
+            _mem["largest_failed"] = size
+    except (IndexError, ValueError):
+        pass
+    gc.collect()
+    mem_sample()
+
+
+def largest_block(limit=None):
+    """Largest single bytearray the heap can hand out right now (binary search
+    with real allocations), a measure of fragmentation; None on CPython.
+    Below MEM_FLOOR the probe could itself fail or fragment the heap, so the
+    last measurement is returned instead."""
+    free = _heap()[0]
+    if free is None:
+        return None
+    if _mem["low"] or free < MEM_FLOOR:
+        return _mem["largest_block"]
+    lo, hi = 0, limit or free
+    while hi - lo > 256:
+        mid = (lo + hi) // 2
+        try:
+            buf = bytearray(mid)
+            del buf
+            lo = mid
+        except MemoryError:
+            hi = mid
+    gc.collect()
+    _mem["largest_block"] = lo
+    return lo
+
+
+def mem_report(probe=False):
+    """Heap figures, low-water mark, low-memory mode and MemoryError counts;
+    with probe, the largest allocatable block is measured again (outside
+    low-memory mode), else the last measurement is reported."""
+    free, alloc = _heap()
+    out = {"free": free, "alloc": alloc, "floor": MEM_FLOOR, "resume": MEM_RESUME}
+    out.update(_mem)
+    if probe:
+        out["largest_block"] = largest_block()
+    return out
+
+
+def observe(kind, name, us, error=False, bytes_in=0, bytes_out=0):
+    """Count one request of kind ("ble", "http") and name (command verb,
+    "METHOD /route") that took us microseconds."""
+    m = _metrics.get((kind, name))
+    if m is None:
+        if sum(1 for k in _metrics if k[0] == kind) >= METRICS_MAX_NAMES:
+            name = "other"
+            m = _metrics.get((kind, name))
+        if m is None:
+            m = _metrics[(kind, name)] = [0, 0, 0, 0, Histogram()]
+    m[0] += 1
+    if error:
+        m[1] += 1
+    m[2] += bytes_in
+    m[3] += bytes_out
+    m[4].add(us)
+
+
+def metrics(kind=None):
+    """[(kind, name, requests, errors, bytes in, bytes out, Histogram)], busiest first."""
+    out = [(k[0], k[1], m[0], m[1], m[2], m[3], m[4]) for k, m in _metrics.items()
+           if kind is None or k[0] == kind]
+    out.sort(key=lambda r: -r[6].total)
+    return out
+
+
+def _esc(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _prom_hist(name, labels, h):
+    scale = _UNIT_SECONDS.get(h.unit, 1)
+    sep = labels + "," if labels else ""
+    tail = "{%s}" % labels if labels else ""
+    cum = 0
+    for i, bound in enumerate(h.bounds):
+        cum += h.counts[i]
+        yield '%s_bucket{%sle="%s"} %d\n' % (name, sep, bound / scale, cum)
+    yield '%s_bucket{%sle="+Inf"} %d\n' % (name, sep, h.count)
+    yield "%s_sum%s %s\n" % (name, tail, h.total / scale)
+    yield "%s_count%s %d\n" % (name, tail, h.count)
+
+
+def prometheus(prefix="pico"):
+    """Yield the registry, the timing histograms and the heap figures as
+    Prometheus text exposition lines (durations in seconds)."""
+    rows = metrics()
+    for field, idx, help_text in (("requests_total", 2, "Requests handled"),
+                                  ("errors_total", 3, "Requests that failed"),
+                                  ("received_bytes_total", 4, "Bytes received with requests"),
+                                  ("sent_bytes_total", 5, "Bytes sent in replies")):
+        yield "# HELP %s_%s %s, per BLE command verb or HTTP route.\n" % (prefix, field, help_text)
+        yield "# TYPE %s_%s counter\n" % (prefix, field)
+        for row in rows:
+            yield '%s_%s{kind="%s",name="%s"} %d\n' % (prefix, field, row[0], _esc(row[1]), row[idx])
+    yield "# HELP %s_request_duration_seconds Time to handle a request.\n" % prefix
+    yield "# TYPE %s_request_duration_seconds histogram\n" % prefix
+    for row in rows:
+        for line in _prom_hist(prefix + "_request_duration_seconds",
+                               'kind="%s",name="%s"' % (row[0], _esc(row[1])), row[6]):
+            yield line
+    # The timing histograms restart at reset(); this gauge tells a scraper when
+    yield "# HELP %s_timing_reset_age_seconds Time since the timing histograms were reset.\n" % prefix
+    yield "# TYPE %s_timing_reset_age_seconds gauge\n%s_timing_reset_age_seconds %d\n" % (
+        prefix, prefix, ticks_diff(ticks_ms(), _since) // 1000)
+    for name, h in _hists.items():
+        metric = "%s_%s_seconds" % (prefix, name)
+        yield "# TYPE %s histogram\n" % metric
+        for line in _prom_hist(metric, "", h):
+            yield line
+    mem = mem_report()
+    if mem["free"] is not None:
+        for field, value in (("heap_free_bytes", mem["free"]), ("heap_alloc_bytes", mem["alloc"]),
+                             ("heap_min_free_bytes", mem["min_free"]), ("low_memory", int(mem["low"]))):
+            yield "# TYPE %s_%s gauge\n%s_%s %d\n" % (prefix, field, prefix, field, value)
+    yield "# TYPE %s_memory_errors_total counter\n%s_memory_errors_total %d\n" % (prefix, prefix, mem["errors"])
@@ -0,0 +1,162 @@
+# bench_fileserver.py (CPython, host side)
+# Load test / benchmark for the PicoPiFileServer HTTP API.
+#
+#   python tools/bench_fileserver.py --host 192.168.4.1 --clients 4 --requests 50
+#   python tools/bench_fileserver.py --serve --clients 8    # local server under CPython
+#   python tools/bench_fileserver.py --keepalive both --path /api/list --path /api/status
+#   python tools/bench_fileserver.py --upload 300000 --requests 10
+import argparse
+import http.client
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+
+def start_local_server(port, max_clients):
+    """Run wifi_toggle.PicoPiFileServer.run_async() in a background thread.
+
+    The server serves (and cleans *.tmp files in) the current directory, so it
+    is started in a scratch one; returns the scratch directory to remove.
+    """
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import asyncio
+    from wifi_toggle import PicoPiFileServer
+
+    scratch = tempfile.mkdtemp(prefix="bench_fileserver")
+    os.chdir(scratch)
+    server = PicoPiFileServer(port=port, max_clients=max_clients)
+    t = threading.Thread(target=lambda: asyncio.run(server.run_async("127.0.0.1")), daemon=True)
+    t.start()
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        try:
+            c = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            c.request("GET", "/api/status")
+            c.getresponse().read()
+            c.close()
+            return scratch
+        except OSError:
+            time.sleep(0.05)
+    raise SystemExit("local server did not start")
+
+
+def _worker(host, port, paths, count, results, keepalive=False):
+    lat = []
+    errors = 0
+    nbytes = 0
+    c = None
+    for i in range(count):
+        path = paths[i % len(paths)]
+        t0 = time.perf_counter()
+        try:
+            if c is None:
+                c = http.client.HTTPConnection(host, port, timeout=30)
+            c.request("GET", path, headers={} if keepalive else {"Connection": "close"})
+            r = c.getresponse()
+            body = r.read()
+            if not keepalive or r.will_close:
+                c.close()
+                c = None
+            if r.status >= 400:
+                errors += 1
+            nbytes += len(body)
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            if c is not None:
+                c.close()
+                c = None
+        lat.append(time.perf_counter() - t0)
+    if c is not None:
+        c.close()
+    results.append((lat, errors, nbytes))
+
+
+def run_load(host, port, paths, clients, requests, keepalive=False):
+    results = []
+    threads = [threading.Thread(target=_worker, args=(host, port, paths, requests, results, keepalive))
+               for _ in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    lat = sorted(x for r in results for x in r[0])
+    errors = sum(r[1] for r in results)
+    nbytes = sum(r[2] for r in results)
+    n = len(lat)
+    mode = "keep-alive" if keepalive else "close"
+    print(f"[{mode}] {clients} clients x {requests} requests: {n / elapsed:.1f} req/s, "
+          f"{nbytes / elapsed / 1024:.1f} KiB/s, {errors} errors")
+    if n:
+        print(f"latency p50 {lat[n // 2] * 1000:.1f} ms, p95 {lat[int(n * 0.95) - 1] * 1000:.1f} ms, "
+              f"max {lat[-1] * 1000:.1f} ms")
+
+
+def run_upload(host, port, size, count, name="bench_upload.bin"):
+    """POST a size-byte file count times to /api/upload and report throughput;
+    the file is deleted from the target afterwards."""
+    payload = os.urandom(size)
+    total = 0.0
+    for _ in range(count):
+        c = http.client.HTTPConnection(host, port, timeout=60)
+        t0 = time.perf_counter()
+        c.request("POST", "/api/upload?name=" + name, body=payload,
+                  headers={"Content-Type": "application/octet-stream"})
+        r = c.getresponse()
+        r.read()
+        total += time.perf_counter() - t0
+        c.close()
+        if r.status != 200:
+            print("upload failed:", r.status)
+    try:
+        c = http.client.HTTPConnection(host, port, timeout=30)
+        c.request("DELETE", "/api/delete?name=" + name)
+        r = c.getresponse()
+        r.read()
+        c.close()
+        if r.status != 200:
+            print(f"could not delete {name}: HTTP {r.status}")
+    except (OSError, http.client.HTTPException) as e:
+        print(f"could not delete {name}: {e}")
+    print(f"[upload] {count} x {size} bytes: {size * count / total / 1024:.1f} KiB/s, "
+          f"{total / count * 1000:.1f} ms per upload")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--host", default="192.168.4.1")
+    ap.add_argument("--port", type=int, default=5001)
+    ap.add_argument("--serve", action="store_true", help="start a local CPython server first")
+    ap.add_argument("--clients", type=int, default=4)
+    ap.add_argument("--requests", type=int, default=25, help="requests per client")
+    ap.add_argument("--path", action="append", help="request path(s), default /api/status")
+    ap.add_argument("--keepalive", choices=("off", "on", "both"), default="off",
+                    help="reuse one HTTP/1.1 connection per client; 'both' compares the two")
+    ap.add_argument("--upload", type=int, metavar="BYTES",
+                    help="benchmark /api/upload with a BYTES-sized file instead of GETs")
+    args = ap.parse_args()
+
+    home = os.getcwd()
+    scratch = None
+    if args.serve:
+        args.host = "127.0.0.1"
+        scratch = start_local_server(args.port, max(args.clients, 4))
+    try:
+        if args.upload:
+            run_upload(args.host, args.port, args.upload, args.requests)
+            return
+        paths = args.path or ["/api/status"]
+        for keepalive in {"off": (False,), "on": (True,), "both": (False, True)}[args.keepalive]:
+            run_load(args.host, args.port, paths, args.clients, args.requests, keepalive)
+    finally:
+        if scratch:
+            os.chdir(home)
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# bench_resolve.py (MicroPython or CPython)
+# Microbenchmark of per-request path resolution in wifi_toggle (_Vfs): the
+# cost of turning a request's file name into a path, with the mount state
+# cached (the server's default) and re-checked on every call (ttl 0, which is
+# what every request used to pay).
+#
+#   python tools/bench_resolve.py                 # on a PC, in the repo
+#   mpremote cp tools/bench_resolve.py : && mpremote run tools/bench_resolve.py
+#   python tools/bench_resolve.py --n 5000
+import os
+import sys
+import time
+
+try:
+    ticks_us, ticks_diff = time.ticks_us, time.ticks_diff
+except AttributeError:
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+# wifi_toggle.py sits next to tools/ in the repo and at the flash root on the Pico
+try:
+    sys.path.insert(0, (__file__.rsplit("/", 1)[0] if "/" in __file__ else ".") + "/..")
+except NameError:
+    pass
+sys.path.insert(0, "")
+from wifi_toggle import _Vfs
+
+NAMES = (
+    ("find", "schedule.txt"),
+    ("find", "sd:logs/relay.csv"),
+    ("find", "missing.txt"),
+    ("target", "sd:logs/new.csv"),
+    ("target", "uploads/a.bin"),
+)
+
+
+def bench(vfs, kind, name, n):
+    call = vfs.find if kind == "find" else vfs.target
+    stats0 = vfs.stats + vfs.mount_checks
+    t0 = ticks_us()
+    for _ in range(n):
+        call(name)
+    us = ticks_diff(ticks_us(), t0)
+    return us / n, (vfs.stats + vfs.mount_checks - stats0) / n
+
+
+def _scratch_dir():
+    try:
+        import tempfile
+        return tempfile.mkdtemp(prefix="bench_resolve")
+    except ImportError:
+        # MicroPython: a directory under the current one, removed afterwards
+        d = os.getcwd().rstrip("/") + "/bench_resolve.tmp"
+        os.mkdir(d)
+        return d
+
+
+def main():
+    n = 1000
+    if "--n" in sys.argv:
+        n = int(sys.argv[sys.argv.index("--n") + 1])
+    # Internal-flash names resolve against the current directory: work in a
+    # scratch one so the real schedule.txt is never touched
+    home = os.getcwd()
+    scratch = _scratch_dir()
+    os.chdir(scratch)
+    try:
+        with open("schedule.txt", "w") as f:
+            f.write("2026-01-15 08:00 60\n")
+        print("%-8s %-20s %12s %8s %12s %8s" % ("call", "name", "cached us", "stats", "ttl 0 us", "stats"))
+        for kind, name in NAMES:
+            cached = bench(_Vfs(), kind, name, n)
+            uncached = bench(_Vfs(ttl_ms=0), kind, name, n)
+            print("%-8s %-20s %12.1f %8.2f %12.1f %8.2f" % (kind, name, cached[0], cached[1], uncached[0], uncached[1]))
+    finally:
+        os.chdir(home)
+        for name in os.listdir(scratch):
+            os.remove(scratch + "/" + name)
+        os.rmdir(scratch)
+
+
+if __name__ == "__main__":
+    main()
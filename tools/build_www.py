@@ -0,0 +1,50 @@
+# build_www.py (CPython, host side)
+# Copy the web UI into a www/ folder with precompressed .gz siblings for the
+# Pico's file server (PicoPiFileServer serves /www and prefers the .gz files).
+#
+#   python tools/build_www.py                  # -> ./www
+#   python tools/build_www.py --gz-only        # smaller on flash, needs gzip-capable clients
+#   mpremote cp -r www :                       # copy to the Pico
+import argparse
+import gzip
+import os
+import shutil
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+ASSETS = ("index.html", "manifest.json", "service-worker.js")
+
+
+def build(out_dir, gz_only=False, level=9):
+    os.makedirs(out_dir, exist_ok=True)
+    total_raw = total_gz = 0
+    for name in ASSETS:
+        src = os.path.join(ROOT, name)
+        with open(src, "rb") as f:
+            data = f.read()
+        # mtime=0 keeps the output identical between builds
+        packed = gzip.compress(data, compresslevel=level, mtime=0)
+        with open(os.path.join(out_dir, name + ".gz"), "wb") as f:
+            f.write(packed)
+        raw_path = os.path.join(out_dir, name)
+        if gz_only:
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+        else:
+            shutil.copyfile(src, raw_path)
+        total_raw += len(data)
+        total_gz += len(packed)
+        print(f"{name}: {len(data)} -> {len(packed)} bytes")
+    print(f"total: {total_raw} -> {total_gz} bytes ({total_raw / max(1, total_gz):.1f}x)")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Build the www/ folder served by the Pico")
+    ap.add_argument("--out", default="www", help="output directory (default ./www)")
+    ap.add_argument("--gz-only", action="store_true", help="write only the .gz files")
+    ap.add_argument("--level", type=int, default=9, help="gzip level (default 9)")
+    args = ap.parse_args()
+    build(args.out, args.gz_only, args.level)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# delta_push.py (CPython, host side)
+# Push a new version of a file to the Pico by sending only the blocks that
+# changed (rsync-style) through /api/blocks and /api/delta. Falls back to a full
+# /api/upload when the file is not on the device yet or the delta is refused.
+#
+#   python tools/delta_push.py water_main.py
+#   python tools/delta_push.py wifi_toggle.py --name wifi_toggle.py --block-size 256
+#   python tools/delta_push.py data.csv --name sd:logs/data.csv --host 192.168.4.1
+import argparse
+import http.client
+import json
+import struct
+import sys
+import urllib.parse
+import zlib
+
+
+def get_blocks(host, port, name, block_size):
+    c = http.client.HTTPConnection(host, port, timeout=30)
+    c.request("GET", "/api/blocks?" + urllib.parse.urlencode({"name": name, "block_size": block_size}))
+    r = c.getresponse()
+    body = r.read()
+    c.close()
+    if r.status == 404:
+        return None
+    if r.status != 200:
+        raise SystemExit(f"/api/blocks failed: {r.status} {body[:200]!r}")
+    return json.loads(body)
+
+
+def make_delta(data, blocks, block_size):
+    """Return the op stream turning the device's file (described by blocks)
+    into data, plus the number of literal bytes in it."""
+    index = {}
+    for i, (weak, strong) in enumerate(blocks):
+        index.setdefault(weak, []).append((strong, i))
+    ops = []
+    literal = bytearray()
+    run = None  # [first block, count] of the current copy run
+
+    def flush_literal():
+        if literal:
+            ops.append(b"D" + struct.pack(">I", len(literal)) + bytes(literal))
+            literal.clear()
+
+    def flush_run():
+        nonlocal run
+        if run:
+            ops.append(b"C" + struct.pack(">II", run[0], run[1]))
+            run = None
+
+    pos = 0
+    n = len(data)
+    weak = sum(data[0:block_size]) if n >= block_size else None
+    n_literal = 0
+    while pos < n:
+        match = None
+        if weak is not None and weak in index:
+            strong = "%08X" % (zlib.crc32(data[pos:pos + block_size]) & 0xFFFFFFFF)
+            for s, i in index[weak]:
+                if s == strong:
+                    match = i
+                    break
+        if match is not None:
+            flush_literal()
+            if run and run[0] + run[1] == match:
+                run[1] += 1
+            else:
+                flush_run()
+                run = [match, 1]
+            pos += block_size
+            weak = sum(data[pos:pos + block_size]) if pos + block_size <= n else None
+            continue
+        flush_run()
+        literal.append(data[pos])
+        n_literal += 1
+        # Roll the byte sum forward by one
+        if weak is not None and pos + block_size < n:
+            weak += data[pos + block_size] - data[pos]
+        else:
+            weak = None
+        pos += 1
+    flush_run()
+    flush_literal()
+    return b"".join(ops), n_literal
+
+
+def post(host, port, path, body):
+    c = http.client.HTTPConnection(host, port, timeout=60)
+    c.request("POST", path, body=body, headers={"Content-Type": "application/octet-stream"})
+    r = c.getresponse()
+    text = r.read()
+    c.close()
+    try:
+        return r.status, json.loads(text)
+    except ValueError:
+        return r.status, {"message": text[:200]}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Delta-sync a file to the Pico file server")
+    ap.add_argument("file")
+    ap.add_argument("--name", help="name on the device (default: the file's base name)")
+    ap.add_argument("--host", default="192.168.4.1")
+    ap.add_argument("--port", type=int, default=5001)
+    ap.add_argument("--block-size", type=int, default=512)
+    args = ap.parse_args()
+
+    with open(args.file, "rb") as f:
+        data = f.read()
+    name = args.name or args.file.replace("\\", "/").rsplit("/", 1)[-1]
+    crc = "%08X" % (zlib.crc32(data) & 0xFFFFFFFF)
+    query = urllib.parse.urlencode({"name": name, "size": len(data), "crc32": crc,
+                                    "block_size": args.block_size})
+
+    info = get_blocks(args.host, args.port, name, args.block_size)
+    if info is not None:
+        ops, n_literal = make_delta(data, info["blocks"], info["block_size"])
+        print(f"{name}: {len(data)} bytes, {n_literal} changed, sending {len(ops)} bytes")
+        status, resp = post(args.host, args.port, "/api/delta?" + query, ops)
+        if status == 200:
+            print(f"updated: {resp}")
+            return
+        print(f"delta refused ({status}: {resp.get('message')}), sending the whole file")
+    status, resp = post(args.host, args.port,
+                        "/api/upload?" + urllib.parse.urlencode({"name": name, "crc32": crc}), data)
+    print(f"upload {status}: {resp}")
+    if status != 200:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
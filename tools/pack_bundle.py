@@ -0,0 +1,74 @@
+# pack_bundle.py (CPython, host side)
+# Pack several files into one bundle and send it to POST /api/bundle. The Pico
+# checks every file's CRC32 before renaming any of them into place, so a set of
+# modules that depend on each other is updated all together or not at all.
+#
+#   python tools/pack_bundle.py water_main.py wifi_toggle.py
+#   python tools/pack_bundle.py www/index.html.gz=www/index.html.gz schedule.txt
+#   python tools/pack_bundle.py water_main.py wifi_toggle.py --ota      # into a code slot (ota.py)
+#   python tools/pack_bundle.py water_main.py wifi_toggle.py --out update.pwb
+#
+# Bundle format: b"PWB1", then per file: u16 name length, name (UTF-8),
+# u32 size, u32 CRC32, data; a zero name length ends the bundle (big-endian).
+import argparse
+import http.client
+import json
+import struct
+import sys
+import zlib
+
+MAGIC = b"PWB1"
+
+
+def pack(entries):
+    """entries: [(device name, data)] -> bundle bytes."""
+    parts = [MAGIC]
+    for name, data in entries:
+        raw = name.encode("utf-8")
+        parts.append(struct.pack(">H", len(raw)) + raw)
+        parts.append(struct.pack(">II", len(data), zlib.crc32(data) & 0xFFFFFFFF))
+        parts.append(data)
+    parts.append(struct.pack(">H", 0))
+    return b"".join(parts)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Send several files to the Pico as one all-or-nothing bundle")
+    ap.add_argument("files", nargs="+", help="local file, or file=name-on-device")
+    ap.add_argument("--host", default="192.168.4.1")
+    ap.add_argument("--port", type=int, default=5001)
+    ap.add_argument("--out", help="write the bundle to this file instead of sending it")
+    ap.add_argument("--ota", action="store_true",
+                    help="stage the files into the spare code slot; they boot as a trial at the next reset")
+    args = ap.parse_args()
+
+    entries = []
+    for spec in args.files:
+        path, _, name = spec.partition("=")
+        name = name or path.replace("\\", "/").rsplit("/", 1)[-1]
+        with open(path, "rb") as f:
+            entries.append((name, f.read()))
+        print(f"{name}: {len(entries[-1][1])} bytes")
+    body = pack(entries)
+
+    if args.out:
+        with open(args.out, "wb") as f:
+            f.write(body)
+        print(f"wrote {args.out} ({len(body)} bytes)")
+        return
+
+    c = http.client.HTTPConnection(args.host, args.port, timeout=120)
+    c.request("POST", "/api/bundle?ota=1" if args.ota else "/api/bundle", body=body, headers={"Content-Type": "application/octet-stream"})
+    r = c.getresponse()
+    text = r.read()
+    c.close()
+    try:
+        print(f"bundle {r.status}: {json.loads(text)}")
+    except ValueError:
+        print(f"bundle {r.status}: {text[:200]!r}")
+    if r.status != 200:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
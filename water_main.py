@@ -7,8 +7,20 @@ import utime
 from collections import namedtuple
 import os
 import machine
-from wifi_toggle import PicoPiFileServer
-from _thread import allocate_lock, start_new_thread
+from wifi_toggle import PicoPiFileServer, recover_bundle
+from blockwriter import open_writer
+import logstore
+import runstats
+import kvstore
+import telemetry
+try:
+    import ota
+except ImportError:
+    ota = None
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 
 # === LED Setup ===
 # Turn on built-in LED to indicate device is running
@@ -16,13 +28,45 @@ led = Pin("LED", Pin.OUT)
 led.on()
 
 # --- Configuration ---
-BASE_TRIGGER = {
+# Settings made with _setting() are defaults: values changed over BLE (SET:,
+# DURATION:) or HTTP (/api/settings) are kept in settings.kv (kvstore) and
+# override them from the next boot on.
+def _range(lo, hi):
+    def check(value):
+        if not lo <= value <= hi:
+            raise ValueError("must be {}..{}".format(lo, hi))
+    return check
+
+def _length(lo, hi):
+    def check(value):
+        if not lo <= len(value) <= hi:
+            raise ValueError("must be {}..{} characters".format(lo, hi))
+    return check
+
+def _check_trigger(value):
+    if sorted(value) != ["day", "hour", "minute", "month", "year"]:
+        raise ValueError("needs year, month, day, hour, minute")
+    for v in value.values():
+        if type(v) is not int:
+            raise ValueError("values must be integers")
+    if not (1 <= value["month"] <= 12 and 1 <= value["day"] <= 31 and
+            0 <= value["hour"] < 24 and 0 <= value["minute"] < 60):
+        raise ValueError("date/time out of range")
+
+def _setting(name, default, check=None, secret=False):
+    """The stored value of a runtime setting, or default; updates through
+    kvstore.update() replace the module global of the same name."""
+    def apply(value):
+        globals()[name] = value
+    return kvstore.define(name, default, check, apply, secret)
+
+BASE_TRIGGER = _setting("BASE_TRIGGER", {
     "year": 2035,
     "month": 8,
     "day": 5,
     "hour": 00,
     "minute": 00
-}
+}, _check_trigger)
 
 SCHEDULED_EVENTS = [
     # (2025, 8, 23, 11, 37),
@@ -30,13 +74,35 @@ SCHEDULED_EVENTS = [
     # (2025, 8, 1, 8, 0),
 ]
 
-INTERVAL_DAYS = 30
+INTERVAL_DAYS = _setting("INTERVAL_DAYS", 30, _range(1, 3650))
 
-RELAY_DURATION_MIN = 2
+RELAY_DURATION_MIN = _setting("RELAY_DURATION_MIN", 2, _range(1, 720))
 
 CHECK_INTERVAL_SEC = 5
 
 MAX_LOG_LINES = 100  # Maximum number of log lines to return
+HISTORY_BLE_LIMIT = 20  # Default records per HISTORY: query (BLE is slow)
+STATS_BLE_PERIODS = 7   # Default periods per STATS:day|week|month query
+
+# --- Runtime task cadence ---
+STATUS_INTERVAL_SEC = _setting("STATUS_INTERVAL_SEC", 5, _range(1, 3600))          # Status broadcast period (BLE + console)
+BLE_CHECK_INTERVAL_SEC = _setting("BLE_CHECK_INTERVAL_SEC", 60, _range(5, 3600))   # BLE health check period
+SCHEDULER_MAX_SLEEP_SEC = 30   # Upper bound on a scheduler sleep so RTC changes are picked up
+PERF_PROBE_MS = 1000           # Event-loop lag probe period (PERF "loop_lag")
+
+# --- Memory ---
+# Below this much free heap (after a collect) uploads and large log reads are
+# refused until memory recovers (telemetry's low-memory mode)
+def _apply_mem_floor(value):
+    globals()["MEM_FLOOR_KB"] = value
+    telemetry.mem_setup(value * 1024)
+
+MEM_FLOOR_KB = kvstore.define("MEM_FLOOR_KB", 24, _range(4, 128), _apply_mem_floor)
+
+# --- WiFi file server (used from the next wifi_on) ---
+WIFI_SSID = _setting("WIFI_SSID", "WaterPico-AP", _length(1, 32))
+WIFI_PASSWORD = _setting("WIFI_PASSWORD", "12345678", _length(8, 63), secret=True)
+WIFI_PORT = _setting("WIFI_PORT", 5001, _range(1, 65535))
 
 # --- Setup RTC and Relay ---
 i2c = I2C(0, scl=Pin(5), sda=Pin(4))
@@ -44,17 +110,29 @@ rtc = ds3231.DS3231(i2c)
 relay = Pin(14, Pin.OUT)
 
 def relay_on():
-    relay.value(0)
     global relay_is_on
+    relay.value(0)
+    if not relay_is_on:
+        _record_run(runstats.record_on)
     relay_is_on = True
 
 def relay_off():
-    relay.value(1)
     global relay_is_on
+    relay.value(1)
+    if relay_is_on:
+        # Every OFF path (schedule, manual, timeout, CLOSE_RELAY) ends here
+        _record_run(runstats.record_off)
     relay_is_on = False
 
+def _record_run(record):
+    try:
+        record(rtc_unix())
+    except Exception as e:
+        print(" Run stats update failed:", e)
+
 relay_is_on = False
 relay_off_time = None
+relay_off_ticks = None  # ticks_ms() deadline matching relay_off_time (PERF "off_overshoot")
 active_duration_sec = RELAY_DURATION_MIN * 60  # Tracks the duration of the current ON window
 settime_buffer = ""  # Accumulates partial SETTIME command chunks
 pending_date = None  # tuple (y,m,d)
@@ -62,55 +140,56 @@ pending_time = None  # tuple (h,m,s)
 
 # --- WiFi File Server Setup ---
 wifi_server = None
-wifi_thread_running = False
+wifi_server_running = False
 
-def _wifi_server_thread():
-    """Background thread for WiFi file server"""
-    global wifi_server, wifi_thread_running
+async def _wifi_server_task():
+    """Run the WiFi file server on the shared asyncio loop"""
+    global wifi_server_running
     try:
         if wifi_server:
-            wifi_server.run()
+            await wifi_server.run_async()
     except Exception as e:
-        print(f"WiFi server thread error: {e}")
+        print(f"WiFi server task error: {e}")
         sp.send(f"WiFi server error: {e}")
     finally:
-        wifi_thread_running = False
+        wifi_server_running = False
 
 def start_wifi_server():
-    """Start WiFi file server in background thread"""
-    global wifi_server, wifi_thread_running
+    """Start WiFi file server as an asyncio task"""
+    global wifi_server, wifi_server_running
     try:
-        if wifi_thread_running:
+        if wifi_server_running:
             sp.send("WiFi server already running")
             return
-        wifi_server = PicoPiFileServer(ssid="WaterPico-AP", password="12345678", port=5001)
-        wifi_thread_running = True
-        start_new_thread(_wifi_server_thread, ())
-        sp.send("WiFi server started on 192.168.4.1:5001")
+        wifi_server = PicoPiFileServer(ssid=WIFI_SSID, password=WIFI_PASSWORD, port=WIFI_PORT)
+        wifi_server_running = True
+        asyncio.create_task(_wifi_server_task())
+        sp.send("WiFi server started on 192.168.4.1:{}".format(WIFI_PORT))
         print("WiFi server started")
     except Exception as e:
-        sp.send(f"Failed to start WiFi: {e}")
+        wifi_server_running = False
+        reply_error(f"Failed to start WiFi: {e}")
         print(f"WiFi startup error: {e}")
 
 def stop_wifi_server():
     """Stop WiFi file server"""
-    global wifi_server, wifi_thread_running
+    global wifi_server, wifi_server_running
     try:
         if wifi_server:
             wifi_server.shutdown()
-        wifi_thread_running = False
+        wifi_server_running = False
         wifi_server = None
         sp.send("WiFi server stopped")
         print("WiFi server stopped")
     except Exception as e:
-        sp.send(f"Failed to stop WiFi: {e}")
+        reply_error(f"Failed to stop WiFi: {e}")
         print(f"WiFi shutdown error: {e}")
 
 def get_wifi_status():
     """Get current WiFi server status"""
     global wifi_server
     try:
-        if wifi_server and wifi_thread_running:
+        if wifi_server and wifi_server_running:
             status = wifi_server.status()
             sp.send(f"WiFi Status: {status}")
             return status
@@ -118,13 +197,29 @@ def get_wifi_status():
             sp.send("WiFi server not running")
             return None
     except Exception as e:
-        sp.send(f"WiFi status error: {e}")
+        reply_error(f"WiFi status error: {e}")
         return None
 
 # --- Setup BLE ---
 ble = bluetooth.BLE()
 ble.active(True)
 sp = BLESimplePeripheral(ble)
+
+# Count reply bytes and failed commands per BLE command (METRICS, /api/metrics)
+_ble_out = [0, 0]  # bytes sent, error replies
+_ble_send = sp.send
+
+def _counted_send(data):
+    _ble_out[0] += len(data)
+    _ble_send(data)
+
+sp.send = _counted_send
+
+def reply_error(text):
+    """Reply to a command that could not be carried out; counts as an error in METRICS."""
+    _ble_out[1] += 1
+    sp.send(text)
+
 print(" Pico W BLE initialized and advertising")
 print(" Device should be discoverable as 'mpy-uart'")
 
@@ -191,7 +286,8 @@ def is_nth_day_trigger(dt):
     return (days_elapsed % INTERVAL_DAYS == 0 and
             dt[4] == BASE_TRIGGER["hour"] and dt[5] == BASE_TRIGGER["minute"])
 
-def next_valid_trigger(now_unix):
+def next_trigger_unix(now_unix):
+    """Return (trigger_unix, duration) of the earliest future trigger, or None."""
     future_events = []
 
     # Check regular scheduled events
@@ -218,7 +314,13 @@ def next_valid_trigger(now_unix):
 
     # Return the earliest upcoming event
     if future_events:
-        next_trigger, duration = min(future_events, key=lambda x: x[0])
+        return min(future_events, key=lambda x: x[0])
+    return None
+
+def next_valid_trigger(now_unix):
+    nxt = next_trigger_unix(now_unix)
+    if nxt:
+        next_trigger, duration = nxt
         next_dt = utime.localtime(next_trigger)
         return (
             "{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(
@@ -248,15 +350,15 @@ def handle_ble_command():
                 else:
                     sp.send("Duplicate event ignored: {} {:02d}:{:02d}".format(parts[0], h, minute))
             except:
-                sp.send("Invalid ADD format. Use ADD:YYYY-MM-DD HH:MM [DURATION]")
+                reply_error("Invalid ADD format. Use ADD:YYYY-MM-DD HH:MM [DURATION]")
 
         elif msg.startswith("DURATION:"):
             try:
                 new_duration = int(msg.split(":")[1])
-                globals()["RELAY_DURATION_MIN"] = new_duration
+                kvstore.update("RELAY_DURATION_MIN", new_duration)
                 sp.send("Duration updated to: {} min".format(new_duration))
             except:
-                sp.send("Invalid DURATION format. Use DURATION:X")
+                reply_error("Invalid DURATION format. Use DURATION:X")
 
         elif msg == "NEXTTRIGGER":
             current_time = rtc.datetime()
@@ -313,8 +415,20 @@ upload_filename = None
 
 manual_override = False
 
+# BLE writes are queued by on_rx() and handled by the command task, so the
+# BLE callback returns immediately and long commands never stall the scheduler.
+_rx_queue = []
+_rx_flag = None      # asyncio.ThreadSafeFlag, created when the runtime starts
+_sched_wake = None   # asyncio.Event, set after each command to re-plan the scheduler
+
 def on_rx(msg):
+    _rx_queue.append(msg)
+    if _rx_flag is not None:
+        _rx_flag.set()
+
+def handle_rx(msg):
     global receiving_file, file_lines, uploading_file, upload_lines, upload_filename, manual_override, relay_is_on, relay_off_time, active_duration_sec
+    global relay_off_ticks
     global settime_buffer, pending_date, pending_time
     decoded_msg = msg.decode().strip()
     print("RX received:", decoded_msg)
@@ -323,23 +437,38 @@ def on_rx(msg):
     if uploading_file:
         if decoded_msg == "ENDUPLOAD":
             try:
-                # Write the file
-                with open(upload_filename, "w") as f:
+                # Write to a temp file and rename, so a reset mid-write never
+                # leaves a truncated file (e.g. main.py) behind
+                tmp_name = upload_filename + ".tmp"
+                with open_writer(tmp_name) as f:
                     for line in upload_lines:
                         if line:  # Skip empty lines
-                            f.write(line + "\n")
-                
-                sp.send(f" File '{upload_filename}' uploaded and saved.")
+                            f.write((line + "\n").encode())
+                if ota and ota.is_code(upload_filename):
+                    # Code goes into the spare slot and is only booted as a
+                    # trial, so a bad upload rolls back instead of boot-looping
+                    try:
+                        slot = ota.stage_file(upload_filename, tmp_name)
+                    finally:
+                        os.remove(tmp_name)
+                    sp.send(f" File '{upload_filename}' staged in slot {slot} and verified; it runs after the next RESET.")
+                else:
+                    try:
+                        os.rename(tmp_name, upload_filename)
+                    except OSError:
+                        os.remove(upload_filename)
+                        os.rename(tmp_name, upload_filename)
+                    sp.send(f" File '{upload_filename}' uploaded and saved.")
                 
                 # If this is main.py, schedule a reset after a short delay
                 if upload_filename == "main.py":
-                    sp.send(" Restarting in 1 second to load new main.py...")
+                    sp.send(" Restarting in 1 second to try the new code (rolls back if unhealthy)...")
                     time.sleep(1)  # Give time for the message to be sent
                     
                     machine.reset()
                 
             except Exception as e:
-                sp.send(f" Failed to write file: {e}")
+                reply_error(f" Failed to write file: {e}")
             finally:
                 # Always clean up, even if there was an error
                 uploading_file = False
@@ -353,6 +482,9 @@ def on_rx(msg):
             upload_lines.extend(chunk_lines)
             # Send progress update every 25 lines to reduce verbosity
             if len(upload_lines) % 25 == 0:
+                if telemetry.low_memory():
+                    abort_upload(" Upload aborted: low memory (the buffered lines were dropped)")
+                    return
                 sp.send(f"Upload progress: {len(upload_lines)} lines received")
         return
 
@@ -373,7 +505,7 @@ def on_rx(msg):
                 print(" Restarting to apply new schedule...")
                 machine.reset()
             except Exception as e:
-                sp.send(f" Failed to write schedule file: {e}")
+                reply_error(f" Failed to write schedule file: {e}")
             file_lines = []
         else:
             file_lines.append(decoded_msg)
@@ -382,6 +514,9 @@ def on_rx(msg):
 
     # --- Command Mode ---
     if decoded_msg.startswith("BEGINUPLOAD:"):
+        if telemetry.low_memory():
+            reply_error(" Low memory: upload refused, try again later (MEM for details)")
+            return
         uploading_file = True
         upload_lines = []
         upload_filename = decoded_msg.split(":", 1)[1].strip() or "main.py"
@@ -411,7 +546,7 @@ def on_rx(msg):
                 else:
                     sp.send(" Schedule file is empty")
         except Exception as e:
-            sp.send(" Failed to read schedule file")
+            reply_error(" Failed to read schedule file")
         return
 
 
@@ -429,39 +564,120 @@ def on_rx(msg):
             else:
                 sp.send("Duplicate event ignored: {} {:02d}:{:02d}".format(parts[0], h, minute))
         except Exception as e:
-            sp.send("Invalid ADD format. Use ADD:YYYY-MM-DD HH:MM [DURATION]")
+            reply_error("Invalid ADD format. Use ADD:YYYY-MM-DD HH:MM [DURATION]")
 
     elif decoded_msg.startswith("DURATION:"):
         try:
             new_duration = int(decoded_msg.split(":")[1])
-            globals()["RELAY_DURATION_MIN"] = new_duration
+            # Persisted in settings.kv, so it survives a reboot
+            kvstore.update("RELAY_DURATION_MIN", new_duration)
             sp.send("Duration updated to: {} min".format(new_duration))
             print(" Duration updated to:", new_duration)
         except Exception as e:
             print(" Error parsing DURATION:", e)
-            sp.send("Invalid DURATION format. Use DURATION:X")
+            reply_error("Invalid DURATION format. Use DURATION:X ({})".format(e))
+
+    elif decoded_msg == "SETTINGS":
+        for name, value in kvstore.settings().items():
+            sp.send("[SET] {}={}".format(name, value))
+        st = kvstore.stats()
+        sp.send("[SET] {} stored, {}/{} bytes".format(st["keys"], st["bytes"], st["max_bytes"]))
+
+    elif decoded_msg.startswith("SET:"):
+        # SET:NAME=value, value as JSON for numbers/BASE_TRIGGER, e.g.
+        # SET:INTERVAL_DAYS=14 or SET:BASE_TRIGGER={"year":2026,"month":5,"day":1,"hour":6,"minute":0}
+        try:
+            name, text = decoded_msg[4:].split("=", 1)
+            name = name.strip().upper()
+            kvstore.update(name, kvstore.parse(name, text.strip()))
+            sp.send(" Setting {} saved".format(name))
+        except Exception as e:
+            reply_error("Invalid SET. Use SET:NAME=VALUE, see SETTINGS ({})".format(e))
+
+    elif decoded_msg.startswith("UNSET:"):
+        try:
+            name = decoded_msg[6:].strip().upper()
+            kvstore.reset(name)
+            sp.send(" Setting {} back to default: {}".format(name, kvstore.settings()[name]))
+        except Exception as e:
+            reply_error(" Failed to reset setting: {}".format(e))
+
+    elif (decoded_msg == "GETLOG" or decoded_msg.startswith("HISTORY:")) and telemetry.low_memory():
+        reply_error("[LOG] Low memory: log reads refused, try again later (MEM for details)")
 
     elif decoded_msg == "GETLOG":
         try:
-            with open("relay_log.txt", "r") as f:
-                lines = f.readlines()[-MAX_LOG_LINES:]
-                if lines:
-                    for line in lines:
-                        sp.send("[LOG] " + line.strip())
-                else:
-                    sp.send("[LOG] No log entries found")
+            lines = logstore.tail(MAX_LOG_LINES)
+            if lines:
+                for line in lines:
+                    sp.send("[LOG] " + line.strip())
+            else:
+                sp.send("[LOG] No log entries found")
         except OSError:
-            sp.send("[LOG] Failed to read log file")
+            reply_error("[LOG] Failed to read log file")
             
+    elif decoded_msg.startswith("HISTORY:"):
+        # HISTORY:from[,to[,action[,limit]]] e.g. HISTORY:2026-03-01,2026-03-31,on,20
+        try:
+            parts = [p.strip() for p in decoded_msg[8:].split(",")]
+            start = parts[0] or None
+            end = parts[1] if len(parts) > 1 and parts[1] else None
+            action = parts[2] if len(parts) > 2 and parts[2] else None
+            limit = int(parts[3]) if len(parts) > 3 and parts[3] else HISTORY_BLE_LIMIT
+            count = 0
+            for ts, act, duration in logstore.history(start, end, action, limit):
+                sp.send("[HIST] {}|{}|{}".format(ts, act, duration if duration is not None else ""))
+                count += 1
+            sp.send("[HIST] {} records".format(count))
+        except Exception as e:
+            reply_error("Invalid HISTORY format. Use HISTORY:FROM[,TO[,ACTION[,LIMIT]]] ({})".format(e))
+            
+    elif decoded_msg == "STATS" or decoded_msg.startswith("STATS:"):
+        # STATS, or STATS:day|week|month[,N] for the last N periods
+        try:
+            if decoded_msg == "STATS":
+                st = runstats.summary()
+                for a, b in (("today", "yesterday"), ("this_week", "last_week"), ("this_month", "last_month")):
+                    sp.send(" {}: {} | {}: {}".format(
+                        a.replace("_", " ").capitalize(), _fmt_run(st[a]),
+                        b.replace("_", " ").capitalize(), _fmt_run(st[b])))
+                sp.send(" Total: {}".format(_fmt_run(st["total"])))
+                if st["running"] is not None:
+                    sp.send(" Running now: {:.1f} min (counted when it ends)".format(st["running"] / 60))
+            else:
+                parts = [p.strip() for p in decoded_msg[6:].split(",")]
+                n = int(parts[1]) if len(parts) > 1 and parts[1] else STATS_BLE_PERIODS
+                for rec in runstats.series(parts[0].lower(), n):
+                    sp.send("[STATS] {}|{:.1f}|{}".format(rec["start"], rec["seconds"] / 60, rec["runs"]))
+        except Exception as e:
+            reply_error("Invalid STATS format. Use STATS or STATS:DAY|WEEK|MONTH[,N] ({})".format(e))
+
+    elif decoded_msg == "PERF":
+        send_perf()
+
+    elif decoded_msg == "METRICS" or decoded_msg.startswith("METRICS:"):
+        # METRICS, METRICS:ble or METRICS:http
+        send_metrics(decoded_msg[8:].strip().lower() or None)
+
+    elif decoded_msg == "MEM":
+        m = telemetry.mem_report(probe=True)
+        sp.send("[MEM] free={} alloc={} min_free={} largest_block={} gc_threshold={}".format(
+            m["free"], m["alloc"], m["min_free"], m["largest_block"], m["threshold"]))
+        sp.send("[MEM] floor={} low={} (entered {}x) errors={} largest_failed={} last={}".format(
+            m["floor"], m["low"], m["low_entered"], m["errors"], m["largest_failed"], m["last_error"]))
+
+    elif decoded_msg == "PERF_RESET":
+        telemetry.reset()
+        sp.send(" Timing histograms cleared (request metrics count since boot)")
+
     elif decoded_msg == "CLEAR_LOG":
         try:
-            # Clear the log file by opening it in write mode with empty content
-            with open("relay_log.txt", "w") as f:
-                f.write("")
-            sp.send(" Log file cleared successfully")
+            # Empties the active log; rotated segments (logs/, /sd/logs) are kept
+            logstore.clear()
+            sp.send(" Log file cleared successfully (archived segments kept)")
             print(" Log file cleared by user command")
         except Exception as e:
-            sp.send(" Failed to clear log file: {}".format(str(e)))
+            reply_error(" Failed to clear log file: {}".format(str(e)))
             print(" Error clearing log file:", e)
         
     elif decoded_msg == "READ_SCHEDULE":
@@ -475,7 +691,7 @@ def on_rx(msg):
                 else:
                     sp.send(" No scheduled events found")
         except Exception as e:
-            sp.send(" Failed to read schedule file: {}".format(str(e)))
+            reply_error(" Failed to read schedule file: {}".format(str(e)))
             
     elif decoded_msg.startswith("SETTIME"):
         try:
@@ -526,12 +742,12 @@ def on_rx(msg):
         except Exception as e:
             # Provide debug context on failure
             try:
-                sp.send(" SETTIME parse failed. Received: '" + incoming + "'")
+                reply_error(" SETTIME parse failed. Received: '" + incoming + "'")
                 sp.send(" Parsed rest: '" + rest + "'")
                 sp.send(" Tokens: " + str(tokens))
             except Exception:
                 pass
-            sp.send(" Failed to set time: {}".format(e))
+            reply_error(" Failed to set time: {}".format(e))
         return
 
     elif decoded_msg.startswith("SETDATE "):
@@ -541,7 +757,7 @@ def on_rx(msg):
             pending_date = (y, m, d)
             sp.send(" Date received: {:04d}-{:02d}-{:02d}".format(y, m, d))
         except Exception as e:
-            sp.send(" Failed to parse SETDATE: {}".format(e))
+            reply_error(" Failed to parse SETDATE: {}".format(e))
         return
 
     elif decoded_msg.startswith("SETCLOCK "):
@@ -571,7 +787,7 @@ def on_rx(msg):
             else:
                 sp.send(" Waiting for SETDATE...")
         except Exception as e:
-            sp.send(" Failed to parse SETCLOCK: {}".format(e))
+            reply_error(" Failed to parse SETCLOCK: {}".format(e))
         return
 
     elif decoded_msg == "MANUAL_ON":
@@ -580,6 +796,7 @@ def on_rx(msg):
         manual_max_duration = 12 * 60 * 60  # 12 hours in seconds
         active_duration_sec = manual_max_duration
         relay_off_time = utime.time() + manual_max_duration
+        relay_off_ticks = time.ticks_add(time.ticks_ms(), manual_max_duration * 1000)
         relay_on()
         relay_is_on = True
         sp.send(" Relay forced ON (Manual mode, max 12 hours). Timers paused.")
@@ -605,6 +822,35 @@ def on_rx(msg):
         get_wifi_status()
         return
 
+    elif decoded_msg == "OTA_STATUS":
+        if ota is None:
+            reply_error(" OTA not available (ota.py missing)")
+            return
+        st = ota.status()
+        sp.send(" OTA: slot {} (previous {}), pending {}, trial {}".format(
+            st["active"] or "root", st["previous"] or "root", st["pending"] or "none", st["trial"]))
+        if st["last_rollback"]:
+            sp.send(" OTA last rollback: {}".format(st["last_rollback"]))
+        return
+
+    elif decoded_msg == "OTA_CANCEL":
+        if ota:
+            ota.cancel()
+        sp.send(" Staged update discarded")
+        return
+
+    elif decoded_msg == "OTA_ROLLBACK":
+        st = ota.status() if ota else None
+        if not st or not st["active"]:
+            reply_error(" Nothing to roll back to")
+            return
+        ota.rollback("requested over BLE")
+        sp.send(" Rolled back to {}, rebooting in 1 second...".format(
+            "slot " + st["previous"] if st["previous"] else "the root files"))
+        time.sleep(1)
+        machine.reset()
+        return
+
     elif decoded_msg == "RESET":
         sp.send(" Rebooting device in 1 second...")
         print(" Reboot command received, restarting...")
@@ -613,7 +859,16 @@ def on_rx(msg):
         return
 
     else:
-        sp.send(" Unknown command or unsupported format")
+        reply_error(" Unknown command or unsupported format")
+
+def abort_upload(reason):
+    """Drop a BLE upload in progress and its buffered lines."""
+    global uploading_file, upload_lines, upload_filename
+    if uploading_file:
+        uploading_file = False
+        upload_lines = []
+        upload_filename = None
+        reply_error(reason)
 
 def read_schedule():
     try:
@@ -643,32 +898,18 @@ def load_schedule(filename="schedule.txt"):
         print("Failed to load schedule:", e)
     return schedule
 
+def _fmt_run(rec):
+    return "{:.1f} min ({} runs)".format(rec["seconds"] / 60, rec["runs"])
+
 def log_event(action, timestamp, duration=None):
     log_entry = "{} — {}".format(timestamp, action)
     if duration:
         log_entry += " (Duration: {} min)".format(duration)
-    log_entry += "\n"
 
     try:
-        # Read existing lines
-        try:
-            with open("relay_log.txt", "r") as f:
-                lines = f.readlines()
-        except OSError:
-            lines = []
-
-        # Add new entry
-        lines.append(log_entry)
-
-        # Keep only last 50
-        if len(lines) > 50:
-            lines = lines[-50:]
-
-        # Overwrite file line-by-line
-        with open("relay_log.txt", "w") as f:
-            for line in lines:
-                f.write(line)
-
+        # Appended to the active segment; logstore rotates it by day/size and
+        # moves closed segments to /sd/logs
+        logstore.append(timestamp, log_entry)
     except Exception as e:
         print(" Log write failed:", e)
 
@@ -677,177 +918,316 @@ sp.on_write(on_rx)
 
 relay_off() # Ensure relay is OFF at startup (active-low relay)
 
-def main():
-    # --- Main Loop ---
-    global loop_counter, relay_is_on, relay_off_time, active_duration_sec, manual_override, i2c, rtc
-    loop_counter = 0
-    ble_status_check_interval = 60  # Check BLE status every 60 loops (60 seconds)
-    output_interval = 5  # Output status every 5 loops (5 seconds)
-
-    while True:
-        # Check BLE status periodically
-        if loop_counter % ble_status_check_interval == 0:
-            if not ble.active():
-                print(" BLE inactive, reactivating...")
-                ble.active(True)
-                time.sleep(0.5)  # Give BLE time to restart
-            if not sp.is_connected():
-                print(" BLE advertising, waiting for connection...")
-        
-        # Read RTC with error handling for I2C issues
+def read_current_time():
+    """Read the RTC, reinitialising I2C on errors and falling back to system time."""
+    global i2c, rtc
+    try:
+        return rtc.datetime()
+    except OSError as e:
+        print(f" RTC read error: {e}, retrying...")
+        time.sleep(0.1)
         try:
-            current_time = rtc.datetime()
-        except OSError as e:
-            print(f" RTC read error: {e}, retrying...")
-            time.sleep(0.1)
+            # Reinitialize I2C and RTC on error
+            i2c = I2C(0, scl=Pin(5), sda=Pin(4))
+            rtc = ds3231.DS3231(i2c)
+            return rtc.datetime()
+        except Exception as e2:
+            print(f" RTC reinit failed: {e2}, using fallback time")
+            # Use system time as fallback
+            lt = utime.localtime()
+            return (lt[0], lt[1], lt[2], lt[6], lt[3], lt[4], lt[5])
+
+def rtc_unix():
+    """The RTC time in seconds (run stats buckets follow the RTC date)."""
+    t = read_current_time()
+    return utime.mktime((t[0], t[1], t[2], t[4], t[5], t[6], 0, 0))
+
+runstats.clock = rtc_unix
+
+def scheduler_step(current_time):
+    """Apply relay transitions due at current_time; return seconds until the next deadline."""
+    global relay_is_on, relay_off_time, active_duration_sec, manual_override, relay_off_ticks
+    timestamp = format_time(current_time)
+
+    # Manual override mode: keep relay ON with 12-hour max timeout
+    if manual_override:
+        if not relay_is_on:
+            relay_on()
+            relay_is_on = True
+        if relay_off_time is None:
+            return SCHEDULER_MAX_SLEEP_SEC
+        remaining = relay_off_time - utime.time()
+        if remaining > 0:
+            return remaining
+        # Auto-turn off after 12 hours
+        manual_override = False
+        _record_overshoot()
+        relay_off()
+        relay_is_on = False
+        sp.send("Relay OFF — Manual mode auto-timeout (12 hours)")
+        print("Relay OFF (Manual timeout) at " + timestamp)
+        log_event("Relay OFF (Manual timeout)", timestamp)
+        return 1
+
+    if relay_is_on:
+        remaining = relay_off_time - utime.time()
+        if remaining > 0:
+            return remaining
+        _record_overshoot()
+        relay_off()
+        relay_is_on = False
+        sp.send("Relay OFF at " + timestamp)
+        print("Relay OFF at " + timestamp)
+        log_event("Relay OFF", timestamp)
+        return 1
+
+    for event in SCHEDULED_EVENTS:
+        if len(event) == 6:
+            y, m, d, h, minute, duration = event
+        else:
+            y, m, d, h, minute = event
+            duration = RELAY_DURATION_MIN
+
+        if (current_time[0] == y and current_time[1] == m and current_time[2] == d and
+            current_time[4] == h and current_time[5] == minute):
+            relay_on()
+            relay_is_on = True
+            active_duration_sec = duration * 60
+            relay_off_time = utime.time() + active_duration_sec
+            relay_off_ticks = time.ticks_add(time.ticks_ms(), active_duration_sec * 1000)
+            # How far into the trigger minute the relay actually switched
+            telemetry.record("trigger_late", utime.mktime((
+                current_time[0], current_time[1], current_time[2],
+                current_time[4], current_time[5], current_time[6], 0, 0)) - utime.mktime((y, m, d, h, minute, 0, 0, 0)))
+            sp.send("Current Time at " + timestamp)
+            sp.send("Relay ON at " + timestamp + " for {} min".format(duration))
+            print(" RELAY ACTIVATED: " + timestamp + " for {} min".format(duration))
+            log_event("Relay ON", timestamp, duration)
+
+            # Save updated schedule to disk
             try:
-                # Reinitialize I2C and RTC on error
-                i2c = I2C(0, scl=Pin(5), sda=Pin(4))
-                rtc = ds3231.DS3231(i2c)
-                current_time = rtc.datetime()
-            except Exception as e2:
-                print(f" RTC reinit failed: {e2}, using fallback time")
-                # Use system time as fallback
-                lt = utime.localtime()
-                current_time = (lt[0], lt[1], lt[2], lt[6], lt[3], lt[4], lt[5])
-        
-        timestamp = format_time(current_time)
-        loop_counter += 1
-        
-        # Only output status every 5 seconds for readability
-        should_output = (loop_counter % output_interval == 0)
-
-        # Manual override mode: keep relay ON with 12-hour max timeout
-        if manual_override:
-            if not relay_is_on:
-                relay_on()
-                relay_is_on = True
-            
-            # Check if manual mode has exceeded 12-hour limit
-            if relay_off_time is not None:
-                current_unix = utime.time()
-                remaining = relay_off_time - current_unix
-                
-                if remaining <= 0:
-                    # Auto-turn off after 12 hours
-                    manual_override = False
-                    relay_off()
-                    relay_is_on = False
-                    sp.send("Relay OFF — Manual mode auto-timeout (12 hours)")
-                    print("Relay OFF (Manual timeout) at " + timestamp)
-                    log_event("Relay OFF (Manual timeout)", timestamp)
-                    time.sleep(1)
-                    continue
-                
-                if should_output:
-                    hours_remain = remaining // 3600
-                    mins_remain = (remaining % 3600) // 60
-                    secs_remain = remaining % 60
-                    sp.send("Relay ON — Manual mode ({}h {}m {}s remaining (12h max))".format(hours_remain, mins_remain, secs_remain))
-                    print("Relay ON (Manual) at " + timestamp + " | Remaining: {}h {}m {}s".format(hours_remain, mins_remain, secs_remain))
-            else:
-                if should_output:
-                    sp.send("Relay ON — Manual mode (timers paused)")
-                    print("Relay ON (Manual) at " + timestamp)
-            
-            time.sleep(1)
-            continue
-
-        if relay_is_on:
-            current_unix = utime.time()
-            remaining = relay_off_time - current_unix
-
-            if remaining <= 0:
-                relay_off()
-                relay_is_on = False
-                sp.send("Relay OFF at " + timestamp)
-                print("Relay OFF at " + timestamp)
-                log_event("Relay OFF", timestamp)
-            else:
-                elapsed = active_duration_sec - remaining
-                mins_remain = remaining // 60
-                secs_remain = remaining % 60
-                mins_elapsed = elapsed // 60
-                secs_elapsed = elapsed % 60
-
-                # Send to BLE and print to console every 5 seconds for readability
-                if should_output:
-                    sp.send("Relay ON — Remaining: {:02d}m {:02d}s | Elapsed: {:02d}m {:02d}s".format(
-                        mins_remain, secs_remain, mins_elapsed, secs_elapsed))
-                    print("Relay ON at " + timestamp + " | Remaining: {:02d}m {:02d}s | Elapsed: {:02d}m {:02d}s".format(
-                        mins_remain, secs_remain, mins_elapsed, secs_elapsed))
+                with open("schedule.txt", "w") as f:
+                    for evt in SCHEDULED_EVENTS:
+                        if len(evt) == 6:
+                            y, m, d, h, minute, dur = evt
+                        else:
+                            y, m, d, h, minute = evt
+                            dur = RELAY_DURATION_MIN
+                        f.write(f"{y:04d}-{m:02d}-{d:02d} {h:02d}:{minute:02d} {dur}\n")
+                sp.send(" Schedule saved — {} total events".format(len(SCHEDULED_EVENTS)))
+            except Exception as e:
+                sp.send(f" Failed to write schedule file: {e}")
+            return active_duration_sec
+
+    # Nothing due: sleep until the start of the next trigger minute
+    current_unix = utime.mktime((
+        current_time[0], current_time[1], current_time[2],
+        current_time[4], current_time[5], current_time[6], 0, 0
+    ))
+    nxt = next_trigger_unix(current_unix)
+    if nxt is None:
+        return SCHEDULER_MAX_SLEEP_SEC
+    return max(1, nxt[0] - current_unix)
+
+def _record_overshoot():
+    """Milliseconds the relay stays ON past its planned OFF time."""
+    if relay_off_ticks is not None:
+        telemetry.record("off_overshoot", time.ticks_diff(time.ticks_ms(), relay_off_ticks))
+
+# Units differ from the default microseconds (scheduler_step, command, loop_lag)
+telemetry.histogram("trigger_late", telemetry.S_BOUNDS, "s")
+telemetry.histogram("off_overshoot", telemetry.MS_BOUNDS, "ms")
+
+def send_perf():
+    """PERF: one line per histogram, p50/p90/p99/max in its unit."""
+    rep = telemetry.report(buckets=False)
+    sp.send("[PERF] since reset: {} s".format(rep["since_ms"] // 1000))
+    for name, h in rep["histograms"].items():
+        if h["count"]:
+            sp.send("[PERF] {} n={} p50={} p90={} p99={} max={} {}".format(
+                name, h["count"], h["p50"], h["p90"], h["p99"], h["max"], h["unit"]))
         else:
-            current_triggered = False
-            for event in SCHEDULED_EVENTS:
-                if len(event) == 6:
-                    y, m, d, h, minute, duration = event
-                else:
-                    y, m, d, h, minute = event
-                    duration = RELAY_DURATION_MIN
+            sp.send("[PERF] {} n=0".format(name))
+
+def send_metrics(kind=None):
+    """METRICS: per BLE verb / HTTP route, requests/errors, bytes in>out and
+    p50/p99/max handling time, busiest first."""
+    rows = telemetry.metrics(kind)
+    for k, name, n, errors, b_in, b_out, h in rows:
+        sp.send("[MET] {} {} {}/{} {}>{}B p50 {:.1f} p99 {:.1f} max {:.1f} ms".format(
+            k, name, n, errors, b_in, b_out, h.percentile(50) / 1000, h.percentile(99) / 1000, h.max / 1000))
+    sp.send("[MET] {} entries".format(len(rows)))
+
+def _command_verb(msg):
+    # Upload/schedule lines are data, not commands
+    text = msg.decode().strip()
+    if uploading_file:
+        return "ENDUPLOAD" if text == "ENDUPLOAD" else "UPLOAD_DATA"
+    if receiving_file:
+        return "ENDFILE" if text == "ENDFILE" else "FILE_DATA"
+    words = text.split(":", 1)[0].split()
+    return words[0].upper()[:24] if words else "EMPTY"
+
+def send_status(current_time):
+    """Broadcast the periodic status line(s) over BLE and the console."""
+    timestamp = format_time(current_time)
+    if manual_override:
+        if relay_off_time is not None:
+            remaining = max(0, relay_off_time - utime.time())
+            hours_remain = remaining // 3600
+            mins_remain = (remaining % 3600) // 60
+            secs_remain = remaining % 60
+            sp.send("Relay ON — Manual mode ({}h {}m {}s remaining (12h max))".format(hours_remain, mins_remain, secs_remain))
+            print("Relay ON (Manual) at " + timestamp + " | Remaining: {}h {}m {}s".format(hours_remain, mins_remain, secs_remain))
+        else:
+            sp.send("Relay ON — Manual mode (timers paused)")
+            print("Relay ON (Manual) at " + timestamp)
+    elif relay_is_on:
+        remaining = max(0, relay_off_time - utime.time())
+        elapsed = active_duration_sec - remaining
+        mins_remain = remaining // 60
+        secs_remain = remaining % 60
+        mins_elapsed = elapsed // 60
+        secs_elapsed = elapsed % 60
+        sp.send("Relay ON — Remaining: {:02d}m {:02d}s | Elapsed: {:02d}m {:02d}s".format(
+            mins_remain, secs_remain, mins_elapsed, secs_elapsed))
+        print("Relay ON at " + timestamp + " | Remaining: {:02d}m {:02d}s | Elapsed: {:02d}m {:02d}s".format(
+            mins_remain, secs_remain, mins_elapsed, secs_elapsed))
+    else:
+        current_unix = utime.mktime((
+            current_time[0], current_time[1], current_time[2],
+            current_time[4], current_time[5], current_time[6], 0, 0
+        ))
+        next_dt, duration = next_valid_trigger(current_unix)
+        sp.send("Current Time at " + timestamp)
+        sp.send("Next scheduled change: {} (Relay Duration: {} min)".format(next_dt, duration))
+        print("Current Time at", timestamp)
+        print("Next scheduled change:", next_dt, "(Relay Duration: {} min)".format(duration))
+
+async def _sleep_or_wake(event, seconds):
+    """Sleep up to seconds, returning early if event is set."""
+    try:
+        await asyncio.wait_for(event.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
+    event.clear()
 
-                if (current_time[0] == y and current_time[1] == m and current_time[2] == d and
-                    current_time[4] == h and current_time[5] == minute and not current_triggered):
-                    relay_on()
-                    relay_is_on = True
-                    active_duration_sec = duration * 60
-                    relay_off_time = utime.time() + active_duration_sec
-                    sp.send("Current Time at " + timestamp)
-                    sp.send("Relay ON at " + timestamp + " for {} min".format(duration))
-                    # Print only once when relay actually turns on (not every loop)
-                    print(" RELAY ACTIVATED: " + timestamp + " for {} min".format(duration))
-                    log_event("Relay ON", timestamp, duration)
-                    current_triggered = True
-
-                    # Save updated schedule to disk
-                    try:
-                        with open("schedule.txt", "w") as f:
-                            for evt in SCHEDULED_EVENTS:
-                                if len(evt) == 6:
-                                    y, m, d, h, minute, dur = evt
-                                else:
-                                    y, m, d, h, minute = evt
-                                    dur = RELAY_DURATION_MIN
-                                f.write(f"{y:04d}-{m:02d}-{d:02d} {h:02d}:{minute:02d} {dur}\n")
-                        sp.send(" Schedule saved — {} total events".format(len(SCHEDULED_EVENTS)))
-                    except Exception as e:
-                        sp.send(f" Failed to write schedule file: {e}")
+_scheduler_ticks = 0  # Scheduler passes since boot (OTA health check)
 
-                    break
+async def scheduler_task():
+    # Wakes at the next relay deadline (trigger minute, OFF time, manual timeout),
+    # or early when a BLE command may have changed the plan.
+    global _scheduler_ticks
+    while True:
+        t0 = time.ticks_us()
+        delay = scheduler_step(read_current_time())
+        telemetry.record("scheduler_step", time.ticks_diff(time.ticks_us(), t0))
+        _scheduler_ticks += 1
+        await _sleep_or_wake(_sched_wake, min(delay, SCHEDULER_MAX_SLEEP_SEC))
 
-    #         if not current_triggered and is_nth_day_trigger(current_time):
-    #             duration = RELAY_DURATION_MIN  # or customize it if needed
-    #             relay_on()
-    #             relay_is_on = True
-    #             active_duration_sec = duration * 60
-    #             relay_off_time = utime.time() + active_duration_sec
-    #             sp.send("Current Time at " + timestamp)
-    #             sp.send("Relay ON at " + timestamp + " for {} min".format(duration))
-    #             # Print only once when relay actually turns on (not every loop)
-    #             print(" RELAY ACTIVATED (Nth Day): " + timestamp + " for {} min".format(duration))
-    #             log_event("Relay ON", timestamp, duration)
-
-    #         if not relay_is_on:
-            if not relay_is_on:
-                current_unix = utime.mktime((
-                    current_time[0], current_time[1], current_time[2],
-                    current_time[4], current_time[5], current_time[6], 0, 0
-                ))
-                next_dt, duration = next_valid_trigger(current_unix)
-                
-                # Send to BLE and print to console every 5 seconds for readability
-                if should_output:
-                    sp.send("Current Time at " + timestamp)
-                    sp.send("Next scheduled change: {} (Relay Duration: {} min)".format(next_dt, duration))
-                    print("Current Time at", timestamp)
-                    print("Next scheduled change:", next_dt, "(Relay Duration: {} min)".format(duration))
-        
-        # Give BLE time to process connections and advertising
-        # Use shorter sleep intervals to ensure BLE responsiveness
-        time.sleep(1)  # Sleep 1 second instead of 5
-        
-        # Additional BLE processing time every few loops
-        if loop_counter % 5 == 0:
-            time.sleep(0.1)  # Extra 100ms for BLE processing
+async def status_task():
+    while True:
+        await asyncio.sleep(STATUS_INTERVAL_SEC)
+        send_status(read_current_time())
+        # Heap low-water mark and low-memory mode, announced when they change
+        was_low = telemetry.low_memory(sample=False)
+        if telemetry.low_memory() != was_low:
+            sp.send(" Memory recovered" if was_low else " Low memory: uploads and log reads paused")
+
+async def ble_watchdog_task():
+    while True:
+        if not ble.active():
+            print(" BLE inactive, reactivating...")
+            ble.active(True)
+            await asyncio.sleep_ms(500)  # Give BLE time to restart
+        if not sp.is_connected():
+            print(" BLE advertising, waiting for connection...")
+        await asyncio.sleep(BLE_CHECK_INTERVAL_SEC)
+
+async def perf_probe_task():
+    # Oversleep of a fixed sleep = how long other work held the event loop
+    # (flash writes, WiFi transfers, long commands); every task waits that long
+    while True:
+        t0 = time.ticks_us()
+        await asyncio.sleep_ms(PERF_PROBE_MS)
+        telemetry.record("loop_lag", time.ticks_diff(time.ticks_us(), t0) - PERF_PROBE_MS * 1000)
+
+async def ota_health_task():
+    """Confirm a trial boot of new code once the scheduler runs and BLE is up;
+    roll back to the previous slot if that does not happen in time."""
+    if ota is None or not ota.in_trial():
+        return
+    deadline = time.ticks_add(time.ticks_ms(), ota.HEALTH_TIMEOUT_SEC * 1000)
+    while time.ticks_diff(deadline, time.ticks_ms()) > 0:
+        if _scheduler_ticks >= 2 and ble.active():
+            ota.confirm()
+            sp.send(" New code confirmed healthy")
+            return
+        await asyncio.sleep(1)
+    ota.rollback("health check failed (scheduler ticks {}, BLE {})".format(_scheduler_ticks, ble.active()))
+    sp.send(" New code failed its health check, rolling back...")
+    await asyncio.sleep(1)
+    machine.reset()
+
+async def command_task():
+    while True:
+        while _rx_queue:
+            msg = _rx_queue.pop(0)
+            try:
+                verb = _command_verb(msg)
+            except Exception:
+                verb = "UNDECODABLE"
+            sent0, errors0 = _ble_out
+            failed = False
+            t0 = time.ticks_us()
+            try:
+                handle_rx(msg)
+            except MemoryError as e:
+                # Usually a long BLE upload growing upload_lines: drop it to recover
+                print(" Out of memory handling command:", e)
+                abort_upload(" Upload aborted: out of memory")
+                telemetry.mem_error("ble", e)
+                failed = True
+            except Exception as e:
+                print(" Command handling error:", e)
+                failed = True
+            us = time.ticks_diff(time.ticks_us(), t0)
+            telemetry.record("command", us)
+            telemetry.observe("ble", verb, us, failed or _ble_out[1] != errors0, len(msg), _ble_out[0] - sent0)
+            _sched_wake.set()
+        await _rx_flag.wait()
+
+async def _runtime():
+    global _rx_flag, _sched_wake
+    _rx_flag = asyncio.ThreadSafeFlag()
+    _sched_wake = asyncio.Event()
+    asyncio.create_task(ble_watchdog_task())
+    asyncio.create_task(command_task())
+    asyncio.create_task(status_task())
+    asyncio.create_task(ota_health_task())
+    asyncio.create_task(perf_probe_task())
+    await scheduler_task()
+
+def main():
+    # --- Main Loop ---
+    # Cooperative tasks replace the old 1 s polling loop: each one sleeps until
+    # it has work, so idle wake-ups drop and BLE commands are handled at once.
+    # Finish (or undo) a bundle upload that a reset interrupted before any code runs.
+    try:
+        recover_bundle()
+    except Exception as e:
+        print(f"Bundle recovery failed: {e}")
+    # Tune gc.threshold for the heap left after imports; sets the low-memory floor
+    telemetry.mem_setup(MEM_FLOOR_KB * 1024)
+    # Log segments rotated while no SD card was inserted move to /sd/logs now
+    try:
+        logstore.offload()
+    except Exception as e:
+        print(f"Log offload failed: {e}")
+    try:
+        asyncio.run(_runtime())
+    finally:
+        asyncio.new_event_loop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,21 +1,819 @@
 # pico_pi_wifi.py (MicroPython)
-import network
 import socket
 import time
 import os
-from machine import Pin
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+# network/machine only exist on the Pico; under CPython the server runs on the
+# host's interfaces without an AP or cancel button (useful for load testing).
+try:
+    import network
+except ImportError:
+    network = None
+try:
+    from machine import Pin
+except ImportError:
+    Pin = None
+
+
+import gc
+from blockwriter import BlockWriter, BLOCK_SIZE_SD
+import blockwriter
+try:
+    import hashlib
+except ImportError:
+    hashlib = None
+try:
+    import ubinascii as binascii
+except ImportError:
+    try:
+        import binascii
+    except ImportError:
+        binascii = None
+# Optional A/B slot manager: /api/bundle?ota=1 stages code into a slot
+try:
+    import ota
+except ImportError:
+    ota = None
+# Relay log segments for /api/history (water_main's logstore)
+try:
+    import logstore
+except ImportError:
+    logstore = None
+# Relay ON-time counters for /api/stats (water_main's runstats)
+try:
+    import runstats
+except ImportError:
+    runstats = None
+# Runtime settings for /api/settings (water_main's kvstore)
+try:
+    import kvstore
+except ImportError:
+    kvstore = None
+# Control-loop timing histograms (/api/perf), heap monitor and request metrics (/api/metrics)
+try:
+    import telemetry
+except ImportError:
+    telemetry = None
+try:
+    from time import ticks_ms, ticks_us, ticks_diff
+except ImportError:
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_us():
+        return int(time.monotonic() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+# Adaptive send pacing: a send taking longer than SEND_BLOCKED_MS means the
+# network stack is backed up, so back off (up to SEND_MAX_PAUSE_MS) between chunks.
+SEND_BLOCKED_MS = 20
+SEND_MAX_PAUSE_MS = 16
+
+# A connection over max_clients is refused in its own protocol (HTTP 503 or a
+# TCP "ERROR" line), told apart by the first bytes it sends within this time
+REFUSE_PEEK_SEC = 2
+
+# Uploads: receive buffer size (a multiple of the 512-byte flash/SD sector) and
+# how often to run gc.collect() while receiving.
+UPLOAD_BUF_SIZE = 4096
+UPLOAD_GC_EVERY = 102400
+# Uploads land in <name>.tmp (single request, removed at startup if orphaned) or
+# <name>.part (resumable, kept) and are renamed over <name> once verified.
+UPLOAD_TMP_SUFFIX = ".tmp"
+UPLOAD_PART_SUFFIX = ".part"
+
+# Storage roots: (location, mount point) pairs searched in order for names
+# without a location prefix ("" is the flash root, i.e. the current directory),
+# and how long a mount point's presence is trusted before it is checked again.
+STORAGE_ROOTS = (("internal", ""), ("sd", "/sd"))
+VFS_MOUNT_TTL_MS = 10000
+
+# Directory index: directories cached at once, largest listing kept in RAM
+# (bigger directories are read with ilistdir on every request) and how long a
+# cached listing is trusted, since FAT/littlefs rarely update directory mtimes.
+DIR_INDEX_MAX_DIRS = 4
+DIR_INDEX_MAX_ENTRIES = 256
+DIR_INDEX_TTL_MS = 10000
+# /api/tree: default and maximum directory depth
+TREE_DEFAULT_DEPTH = 3
+TREE_MAX_DEPTH = 8
+
+# Digest cache: file (internal flash) and how many files it remembers
+DIGEST_CACHE_FILE = ".digests"
+DIGEST_CACHE_MAX = 64
+HASH_ALGOS = ("crc32", "sha256")
+
+# Delta sync (/api/blocks, /api/delta): default and allowed block sizes
+DELTA_BLOCK_SIZE = 512
+DELTA_MIN_BLOCK = 64
+DELTA_MAX_BLOCK = 8192
+
+# Bundle uploads (/api/bundle): stream magic and the journal that makes the
+# final renames all-or-nothing across a reset
+BUNDLE_MAGIC = b"PWB1"
+BUNDLE_JOURNAL = ".bundle_journal"
+BUNDLE_MAX_FILES = 32
+
+# /api/history: records returned when no limit is given
+HISTORY_DEFAULT_LIMIT = 1000
+
+# Static files from www_dir: content types, pages that must be revalidated on
+# every load, and how long everything else may be cached
+_STATIC_TYPES = {
+    "html": "text/html; charset=utf-8", "js": "application/javascript", "json": "application/json",
+    "css": "text/css", "txt": "text/plain", "svg": "image/svg+xml", "png": "image/png", "ico": "image/x-icon",
+}
+STATIC_NO_CACHE = ("index.html", "service-worker.js")
+STATIC_MAX_AGE = 86400
+
+_HTTP_METHODS = (b"GET ", b"HEAD ", b"POST ", b"PUT ", b"DELETE ", b"OPTIONS ")
+
+
+def _is_http(data):
+    for m in _HTTP_METHODS:
+        if data.startswith(m):
+            return True
+    return False
+
+
+def _route_name(method, path):
+    """Metrics name of a request: "GET /api/list"; static files share "GET /www"."""
+    path = path.split("?", 1)[0]
+    if not path.startswith("/api/"):
+        path = "/www"
+    return method + " " + path
+
+
+def _run_sync(coro):
+    """Drive a handler coroutine whose awaits never suspend (blocking socket I/O)."""
+    try:
+        while True:
+            coro.send(None)
+    except StopIteration as e:
+        return e.value
+
+
+class _Conn:
+    """Awaitable connection interface shared by the blocking and asyncio transports.
+
+    Bytes read past the end of an HTTP head can be pushed back with unread().
+    While body_left is set, recv() never reads beyond the current request body,
+    so pipelined requests stay in the stream for the next iteration.
+    """
+    pending = b""
+    body_left = None
+    keep_alive = False
+    chunked_ok = False
+    # Traffic and the last response status, for the per-route metrics
+    bytes_in = 0
+    bytes_out = 0
+    status = None
+
+    def unread(self, data):
+        if data:
+            self.pending = data + self.pending
+
+    async def recv(self, n):
+        if self.body_left is not None:
+            if self.body_left <= 0:
+                return b""
+            n = min(n, self.body_left)
+        if self.pending:
+            data = self.pending[:n]
+            self.pending = self.pending[n:]
+        else:
+            data = await self._recv(n)
+            self.bytes_in += len(data)
+        if self.body_left is not None:
+            self.body_left -= len(data)
+        return data
+
+    async def recv_into(self, mv):
+        """Read up to len(mv) bytes into mv; return the count (0 at EOF)."""
+        n = len(mv)
+        if self.body_left is not None:
+            if self.body_left <= 0:
+                return 0
+            n = min(n, self.body_left)
+        if self.pending:
+            n = min(n, len(self.pending))
+            mv[:n] = self.pending[:n]
+            self.pending = self.pending[n:]
+        else:
+            n = await self._recv_into(mv[:n])
+            self.bytes_in += n
+        if self.body_left is not None:
+            self.body_left -= n
+        return n
+
+
+class _UploadSink:
+    """Receive total bytes of an upload into f through a BlockWriter.
+
+    Data is read with recv_into() straight into the writer's buffer, the CRC32
+    is updated over memoryview slices, and the file is written only in whole,
+    aligned blocks of bufsize (the first one shortened when starting at an
+    unaligned offset for append/resume). close() flushes and syncs.
+    """
+
+    def __init__(self, f, total, bufsize=UPLOAD_BUF_SIZE, offset=0, crc=0, label="internal"):
+        self.w = BlockWriter(f, bufsize, offset, label)
+        self.total = total
+        self.received = 0
+        self.crc = crc
+        self.next_gc = UPLOAD_GC_EVERY
+
+    def _advance(self, view, n):
+        if binascii:
+            self.crc = binascii.crc32(view[:n], self.crc)
+        self.w.commit(n)
+        self.received += n
+        if self.received >= self.next_gc:
+            self.next_gc += UPLOAD_GC_EVERY
+            gc.collect()
+            print(f"Received {self.received}/{self.total} bytes...")
+
+    def feed(self, data):
+        """Accept bytes that were already read from the connection."""
+        data = memoryview(data)
+        while len(data):
+            view = self.w.space(len(data))
+            n = len(view)
+            view[:] = data[:n]
+            self._advance(view, n)
+            data = data[n:]
+
+    async def recv_from(self, conn, most=None):
+        """Read the next piece of the upload from conn (at most most bytes if
+        given); return bytes read (0 at EOF)."""
+        want = self.total - self.received
+        if most is not None:
+            want = min(want, most)
+        if want <= 0:
+            return 0
+        view = self.w.space(want)
+        n = await conn.recv_into(view)
+        if n:
+            self._advance(view, n)
+        return n
+
+    def flush(self):
+        self.w.flush()
+
+    def close(self):
+        """Write the rest and sync the file (the fsync point before a rename)."""
+        self.w.close()
+
+    def discard(self):
+        self.w.discard()
+
+
+def _scan_dir(path):
+    """Yield (name, size, is_dir) for each entry of path."""
+    if hasattr(os, 'ilistdir'):
+        for ent in os.ilistdir(path):
+            yield ent[0], (ent[3] if len(ent) > 3 else 0), ent[1] == 0x4000
+    else:
+        for name in os.listdir(path):
+            try:
+                st = os.stat(path.rstrip('/') + '/' + name)
+                is_dir = bool(st[0] & 0x4000)
+                yield name, 0 if is_dir else st[6], is_dir
+            except OSError:
+                yield name, 0, False
+
+
+class _DirIndex:
+    """Sorted, cached listings of the directories the server lists.
+
+    A cached listing is reused while the directory mtime is unchanged and it is
+    younger than ttl_ms; the server drops it after its own uploads and deletes.
+    Directories with more than max_entries entries are never held in RAM and
+    are streamed from the filesystem instead.
+    """
+
+    def __init__(self, max_dirs=DIR_INDEX_MAX_DIRS, max_entries=DIR_INDEX_MAX_ENTRIES, ttl_ms=DIR_INDEX_TTL_MS):
+        self.max_dirs = max_dirs
+        self.max_entries = max_entries
+        self.ttl_ms = ttl_ms
+        self._dirs = {}  # path -> [mtime, scanned_at, entries, crc]
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, path):
+        """Return the cache record for path (rescanning if stale), or None if
+        the directory is too large to cache. Raises OSError if it is missing."""
+        st = os.stat(path)
+        mtime = st[8] if len(st) > 8 else 0
+        now = ticks_ms()
+        rec = self._dirs.get(path)
+        if rec and rec[0] == mtime and ticks_diff(now, rec[1]) < self.ttl_ms:
+            self.hits += 1
+            return rec
+        self.misses += 1
+        self._dirs.pop(path, None)
+        entries = []
+        for ent in _scan_dir(path):
+            if len(entries) >= self.max_entries:
+                return None
+            entries.append(ent)
+        entries.sort()
+        crc = 0
+        if binascii:
+            for name, size, is_dir in entries:
+                crc = binascii.crc32(("%s %d\n" % (name, size)).encode(), crc)
+        if len(self._dirs) >= self.max_dirs:
+            self._dirs.pop(next(iter(self._dirs)))
+        rec = [mtime, now, entries, crc]
+        self._dirs[path] = rec
+        return rec
+
+    def version(self, path):
+        """CRC of the listing of path, None if it is not cacheable."""
+        rec = self._lookup(path)
+        return rec[3] if rec else None
+
+    def entries(self, path, prefix=None):
+        """Yield (name, size, is_dir) for path, sorted when served from the cache."""
+        rec = self._lookup(path)
+        for ent in (rec[2] if rec else _scan_dir(path)):
+            if not prefix or ent[0].startswith(prefix):
+                yield ent
+
+    def invalidate(self, path=None):
+        """Forget path (a directory or a file inside one), or everything."""
+        if path is None:
+            self._dirs.clear()
+            return
+        d = path.rpartition('/')[0] if '/' in path else '/'
+        self._dirs.pop(d or '/', None)
+
+
+class _Vfs:
+    """Maps storage names ("sd:logs/a.csv", "internal:x", "flash:x", "x") to paths.
+
+    Whether each root is mounted is cached for ttl_ms, and dropped as soon as a
+    filesystem call under it fails with anything but "not found", so resolving
+    a name costs one os.stat per location tried (none for write targets). stats
+    and mount_checks count the os.stat calls made, for benchmarking.
+    """
+
+    def __init__(self, roots=STORAGE_ROOTS, ttl_ms=VFS_MOUNT_TTL_MS):
+        self.roots = tuple(roots)
+        self.ttl_ms = ttl_ms
+        self._mounted = {}  # location -> [mounted, checked_at]
+        self.stats = 0
+        self.mount_checks = 0
+
+    def mount_point(self, loc):
+        for name, mp in self.roots:
+            if name == loc:
+                return mp
+        return None
+
+    def mounted(self, loc):
+        mp = self.mount_point(loc)
+        if mp is None:
+            return False
+        if not mp:
+            # The flash root is always there
+            return True
+        now = ticks_ms()
+        rec = self._mounted.get(loc)
+        if rec and ticks_diff(now, rec[1]) < self.ttl_ms:
+            return rec[0]
+        self.mount_checks += 1
+        try:
+            os.stat(mp)
+            ok = True
+        except OSError:
+            ok = False
+        self._mounted[loc] = [ok, now]
+        return ok
+
+    def invalidate(self, loc=None):
+        """Forget the mount state of loc (or all roots); call after mount errors."""
+        if loc is None:
+            self._mounted.clear()
+        else:
+            self._mounted.pop(loc, None)
+
+    def failed(self, loc, exc):
+        """Note an OSError from a file under loc; anything but ENOENT re-checks the mount."""
+        if not (exc.args and exc.args[0] == 2):
+            self.invalidate(loc)
+
+    def split(self, name):
+        """Split an optional location prefix: returns (location or None, rest)."""
+        if ':' in name:
+            location_part, rest = name.split(':', 1)
+            location_part = location_part.lower().strip()
+            if location_part == 'flash':
+                location_part = 'internal'
+            if self.mount_point(location_part) is not None:
+                return location_part, rest.strip()
+        return None, name
+
+    def clean(self, rel):
+        """Normalise a relative path ("a//b/./c" -> "a/b/c"); ValueError on ".." or empty."""
+        parts = [p for p in rel.replace('\\', '/').split('/') if p and p != '.']
+        if not parts or '..' in parts:
+            raise ValueError("invalid path: %s" % rel)
+        return '/'.join(parts)
+
+    def join(self, loc, rel):
+        mp = self.mount_point(loc)
+        return f"{mp}/{rel}" if mp else rel
+
+    def list_dir(self, loc, rel=None):
+        """Directory path to list for loc ("/" for the flash root)."""
+        mp = self.mount_point(loc)
+        if rel:
+            return self.join(loc, rel)
+        return mp or '/'
+
+    def location_of(self, path):
+        """Location whose mount point contains path (the flash root otherwise)."""
+        for loc, mp in self.roots:
+            if mp and (path == mp or path.startswith(mp + '/')):
+                return loc
+        return self.roots[0][0]
+
+    def is_mount(self, dirpath, name):
+        """True if dirpath/name is another root's mount point (e.g. "sd" in "/")."""
+        full = (dirpath.rstrip('/') + '/' + name)
+        for loc, mp in self.roots:
+            if mp and mp == full:
+                return True
+        return False
+
+    def target(self, name):
+        """Path to write for name: (full_path or None if unmounted, location, rel).
+        Raises ValueError for paths that try to leave the storage root."""
+        location, rel = self.split(name)
+        rel = self.clean(rel)
+        location = location or self.roots[0][0]
+        if not self.mounted(location):
+            return None, location, rel
+        return self.join(location, rel), location, rel
+
+    def find(self, name):
+        """Locate an existing file, trying the roots in order when name has no
+        prefix. Returns (full_path, location, rel, stat, error)."""
+        location, rel = self.split(name)
+        try:
+            rel = self.clean(rel)
+        except ValueError as e:
+            return None, None, rel, None, str(e)
+        if location:
+            locs = (location,)
+            where = "SD card storage" if location == 'sd' else (
+                "internal flash storage" if location == 'internal' else f"{location} storage")
+        else:
+            locs = [loc for loc, mp in self.roots]
+            where = "any storage location"
+        for loc in locs:
+            if not self.mounted(loc):
+                continue
+            full_path = self.join(loc, rel)
+            self.stats += 1
+            try:
+                return full_path, loc, rel, os.stat(full_path), None
+            except OSError as e:
+                self.failed(loc, e)
+        return None, None, rel, None, f"File '{rel}' not found in {where}"
+
+
+class _DigestCache:
+    """Hashes of files on flash/SD, persisted in a small JSON file.
+
+    Entries are keyed by path and only trusted while the file's size and mtime
+    are unchanged, so edits made outside the server simply miss the cache.
+    """
+
+    def __init__(self, path=DIGEST_CACHE_FILE, max_entries=DIGEST_CACHE_MAX):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = None  # path -> [size, mtime, {algo: hex}]
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                import ujson as json
+            except Exception:
+                import json
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        try:
+            import ujson as json
+        except Exception:
+            import json
+        tmp = self.path + UPLOAD_TMP_SUFFIX
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self._entries, f)
+            try:
+                os.rename(tmp, self.path)
+            except OSError:
+                os.remove(self.path)
+                os.rename(tmp, self.path)
+        except OSError as e:
+            print("Digest cache not saved:", e)
+
+    def _key(self, path):
+        st = os.stat(path)
+        return st[6], (st[8] if len(st) > 8 else 0)
+
+    def get(self, path, algo):
+        """Cached hex digest of path, or None if unknown or the file changed."""
+        ent = self._load().get(path)
+        if not ent:
+            return None
+        try:
+            if [ent[0], ent[1]] != list(self._key(path)):
+                return None
+        except OSError:
+            return None
+        return ent[2].get(algo)
+
+    def put(self, path, algo, digest):
+        """Remember digest for the current size/mtime of path."""
+        entries = self._load()
+        try:
+            size, mtime = self._key(path)
+        except OSError:
+            return
+        ent = entries.get(path)
+        if not ent or ent[0] != size or ent[1] != mtime:
+            ent = [size, mtime, {}]
+        if ent[2].get(algo) == digest and entries.get(path) is ent:
+            return
+        ent[2][algo] = digest
+        entries.pop(path, None)
+        while len(entries) >= self.max_entries:
+            entries.pop(next(iter(entries)))
+        entries[path] = ent
+        self._save()
+
+    def drop(self, path):
+        if self._load().pop(path, None) is not None:
+            self._save()
+
+
+class _BodyWriter:
+    """Stream a response body of unknown length: HTTP/1.1 chunked encoding, or
+    raw bytes up to connection close for HTTP/1.0 clients."""
+
+    def __init__(self, conn, chunked, bufsize=512):
+        self.conn = conn
+        self.chunked = chunked
+        self.bufsize = bufsize
+        self.buf = bytearray()
+
+    async def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.buf.extend(data)
+        if len(self.buf) >= self.bufsize:
+            await self.flush()
+
+    async def flush(self):
+        if not self.buf:
+            return
+        if self.chunked:
+            await self.conn.send(b"%x\r\n" % len(self.buf))
+            self.buf.extend(b"\r\n")
+        await self.conn.send(self.buf)
+        self.buf = bytearray()
+
+    async def close(self):
+        await self.flush()
+        if self.chunked:
+            await self.conn.send(b"0\r\n\r\n")
+
+
+class _SocketConn(_Conn):
+    """Blocking socket behind the awaitable interface the handlers use."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    async def _recv(self, n):
+        return self.sock.recv(n)
+
+    async def _recv_into(self, mv):
+        if hasattr(self.sock, 'recv_into'):
+            return self.sock.recv_into(mv)
+        # MicroPython sockets expose readinto() instead
+        return self.sock.readinto(mv) or 0
+
+    async def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.bytes_out += len(data)
+        mv = memoryview(data)
+        while len(mv):
+            n = self.sock.send(mv)
+            if n is None:
+                n = len(mv)
+            mv = mv[n:]
+
+    async def sleep_ms(self, ms):
+        time.sleep(ms / 1000)
+
+    def settimeout(self, t):
+        self.sock.settimeout(t)
+
+    def setsockopt(self, *args):
+        self.sock.setsockopt(*args)
+
+    def close(self):
+        self.sock.close()
+
+
+class _StreamConn(_Conn):
+    """asyncio stream pair behind the same interface, with a per-read timeout."""
+
+    def __init__(self, reader, writer, timeout):
+        self.reader = reader
+        self.writer = writer
+        self.default_timeout = timeout
+        self.timeout = timeout
+
+    async def _recv(self, n):
+        try:
+            return await asyncio.wait_for(self.reader.read(n), self.timeout)
+        except asyncio.TimeoutError:
+            raise OSError(110, "ETIMEDOUT")
+
+    async def _recv_into(self, mv):
+        if hasattr(self.reader, 'readinto'):
+            try:
+                return await asyncio.wait_for(self.reader.readinto(mv), self.timeout) or 0
+            except asyncio.TimeoutError:
+                raise OSError(110, "ETIMEDOUT")
+        # CPython streams have no readinto(); copy from read()
+        data = await self._recv(len(mv))
+        mv[:len(data)] = data
+        return len(data)
+
+    async def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.bytes_out += len(data)
+        if not isinstance(data, bytes) and hasattr(self.writer, 'transport'):
+            # A CPython transport can keep the view queued past drain() while
+            # the caller refills its buffer; uasyncio copies what it cannot send
+            data = bytes(data)
+        self.writer.write(data)
+        try:
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+        except asyncio.TimeoutError:
+            raise OSError(110, "ETIMEDOUT")
+
+    async def sleep_ms(self, ms):
+        await asyncio.sleep(ms / 1000)
+
+    def settimeout(self, t):
+        # None means "no explicit timeout": fall back to the connection timeout
+        self.timeout = self.default_timeout if t is None else t
+
+    def setsockopt(self, *args):
+        try:
+            sock = self.writer.get_extra_info('socket')
+        except KeyError:
+            # uasyncio streams only expose 'peername'; the socket is .s
+            sock = getattr(self.writer, 's', None)
+        if sock is not None:
+            sock.setsockopt(*args)
+
+    def close(self):
+        self.writer.close()
+
+
+def _replace_file(src, dst):
+    """Rename src over dst, also where the filesystem (FAT) refuses to overwrite."""
+    try:
+        os.rename(src, dst)
+    except OSError:
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        os.rename(src, dst)
+
+
+def _install_file(src, dst):
+    """Move a finished upload from src to dst. Code (ota.is_code) is staged
+    into the spare slot instead, as BLE ENDUPLOAD does, so it boots as a trial
+    that can roll back; returns the slot, or None for a plain rename."""
+    if ota is None or not ota.is_code(dst):
+        _replace_file(src, dst)
+        return None
+    try:
+        return ota.stage_file(dst, src)
+    finally:
+        os.remove(src)
+
+
+def _staged_message(slot, done):
+    return f"{done}; code staged in slot {slot}, runs after the next reset" if slot else done
+
+
+def _write_journal(state, files):
+    try:
+        import ujson as json
+    except Exception:
+        import json
+    tmp = BUNDLE_JOURNAL + UPLOAD_TMP_SUFFIX
+    with open(tmp, "w") as f:
+        json.dump({"state": state, "files": files}, f)
+    _replace_file(tmp, BUNDLE_JOURNAL)
+
+
+def recover_bundle():
+    """Finish or roll back a bundle upload interrupted by a reset.
+
+    Call early at boot (water_main does) and before cleaning temp files: a
+    journal in state "commit" means every file was verified, so the remaining
+    renames are replayed; any other state means the bundle never completed and
+    its temp files are removed. Returns the number of files committed.
+    """
+    try:
+        import ujson as json
+    except Exception:
+        import json
+    try:
+        with open(BUNDLE_JOURNAL) as f:
+            journal = json.load(f)
+    except OSError:
+        return 0
+    except ValueError:
+        journal = {"state": "broken", "files": []}
+    done = 0
+    for tmp, target in journal.get("files", []):
+        try:
+            os.stat(tmp)
+        except OSError:
+            # Already renamed (or never written)
+            continue
+        try:
+            if journal.get("state") == "commit":
+                _install_file(tmp, target)
+                done += 1
+            else:
+                os.remove(tmp)
+        except OSError as e:
+            print("Bundle recovery error:", e)
+    try:
+        os.remove(BUNDLE_JOURNAL)
+    except OSError:
+        pass
+    print(f"Bundle recovery: {journal.get('state')}, {done} files committed")
+    return done
 
 
 class PicoPiFileServer:
-    def __init__(self, ssid="PicoPi-AP", password="12345678", port=5001, button_pin=0):
+    def __init__(self, ssid="PicoPi-AP", password="12345678", port=5001, button_pin=0,
+                 max_clients=4, conn_timeout=30, keepalive_timeout=5, keepalive_max=100,
+                 upload_buf_size=UPLOAD_BUF_SIZE, www_dir="/www", storage_roots=STORAGE_ROOTS,
+                 sd_block_size=BLOCK_SIZE_SD):
         # Store config so this class can be reused when imported
         self.ssid = ssid
         self.password = password
         self.port = port
+        # Async mode: concurrent connection limit and idle timeout (seconds) per connection
+        self.max_clients = max_clients
+        self.conn_timeout = conn_timeout
+        # HTTP keep-alive: idle wait for the next request and requests per connection
+        self.keepalive_timeout = keepalive_timeout
+        self.keepalive_max = keepalive_max
+        # Upload receive buffers (bytes): writes to flash / SD happen in aligned blocks of these sizes
+        self.upload_buf_size = upload_buf_size
+        self.sd_block_size = sd_block_size
+        # Static web UI (index.html etc., optionally with precompressed .gz siblings)
+        self.www_dir = www_dir
+        # Cached directory listings for /api/list and the TCP list command
+        self.dir_index = _DirIndex()
+        # Persistent file hashes for /api/hash and upload resume
+        self.digests = _DigestCache()
+        # Name -> path resolution shared by every endpoint (cached mount state)
+        self.vfs = _Vfs(storage_roots)
 
-        self.ap = network.WLAN(network.AP_IF)
+        self.ap = network.WLAN(network.AP_IF) if network else None
         try:
-            self.button = Pin(button_pin, Pin.IN, Pin.PULL_UP)
+            self.button = Pin(button_pin, Pin.IN, Pin.PULL_UP) if Pin else None
         except Exception:
             # Button is optional; ignore if pin not available
             self.button = None
@@ -23,6 +821,11 @@ class PicoPiFileServer:
         self.file_path = "data_test.txt"
         self.server_socket = None
         self._running = False
+        self._async_server = None
+        self._stop_event = None
+        self.active_clients = 0
+        # Throughput of the last file sent (bytes, ms, bytes_per_sec)
+        self.tx_stats = None
         # Cooperative cancel flag (can be set by button or future commands)
         self.cancel_requested = False
         print("File server initialized")
@@ -44,6 +847,9 @@ class PicoPiFileServer:
         return False
 
     def start_ap(self):
+        if self.ap is None:
+            print("No WLAN interface; serving on host network")
+            return
         self.ap.active(True)
         # Use configured SSID/password instead of hardcoded values
         try:
@@ -54,7 +860,11 @@ class PicoPiFileServer:
         print("Access Point started")
         print("Network config:", self.ap.ifconfig())
 
-    def handle_client(self, conn):
+    def _handle_client_sync(self, sock):
+        """Serve one blocking socket connection to completion."""
+        _run_sync(self.handle_client(_SocketConn(sock)))
+
+    async def handle_client(self, conn):
         try:
             # Buffer to hold any bytes read beyond a command line (e.g., size header or initial file data)
             pending = b""
@@ -73,26 +883,26 @@ class PicoPiFileServer:
                         pending = pending[nl+1:]
                         break
                     # Need more bytes
-                    chunk = conn.recv(512)
+                    chunk = await conn.recv(512)
                     if not chunk:
                         print("Client disconnected.")
                         return
                     # Early HTTP detection
-                    if not pending and (chunk.startswith(b"GET ") or chunk.startswith(b"POST ") or chunk.startswith(b"DELETE ") or chunk.startswith(b"OPTIONS ")):
+                    if not pending and _is_http(chunk):
                         # Hand off to HTTP handler with everything we've seen
-                        self.handle_http_session(conn, first_chunk=chunk)
+                        await self.handle_http_session(conn, first_chunk=chunk)
                         return
                     pending += chunk
 
                 # Decode command line preserving case for filename; use lower() only for keyword checks
                 # But first, if this line is actually an HTTP request line, hand off to HTTP handler.
-                if line.startswith(b"GET ") or line.startswith(b"POST ") or line.startswith(b"DELETE ") or line.startswith(b"OPTIONS "):
+                if _is_http(line):
                     # Reconstruct the initial bytes we already consumed: the request line + newline + any pending
                     try:
                         first = line + b"\n" + pending
                     except Exception:
                         first = line + b"\n"
-                    self.handle_http_session(conn, first_chunk=first)
+                    await self.handle_http_session(conn, first_chunk=first)
                     return
 
                 try:
@@ -104,7 +914,7 @@ class PicoPiFileServer:
                 print(f"Received command: {cmd}")
 
                 if cmd_l == "send":
-                    self.send_file(conn)
+                    await self.send_file(conn)
 
                 elif cmd_l == "exit":
                     print("Exit command received. Closing connection.")
@@ -114,52 +924,42 @@ class PicoPiFileServer:
                     # Allow client to set a cancel flag (useful when sending a file to client)
                     self.cancel_requested = True
                     try:
-                        conn.send(b"Cancel acknowledged")
+                        await conn.send(b"Cancel acknowledged")
                     except Exception:
                         pass
                     print("Cancel flag set by client")
 
-                elif cmd_l == "list":
+                elif cmd_l == "list" or cmd_l.startswith("list "):
+                    # "list [prefix]": same directory index as /api/list, sent in pieces
+                    prefix = cmd[5:].strip() or None
                     try:
-                        # Enhanced dual-storage file listing
-                        file_list_lines = []
-                        
-                        # List internal flash files
-                        try:
-                            internal_files = os.listdir('/')
-                            if internal_files:
-                                file_list_lines.append("=== Internal Flash ===")
-                                for file in sorted(internal_files):
-                                    if file != "sd":  # Skip SD mount point
-                                        try:
-                                            size = os.stat(file)[6]
-                                            file_list_lines.append(f"{file} ({size} bytes)")
-                                        except:
-                                            file_list_lines.append(file)
-                        except Exception as e:
-                            file_list_lines.append(f"Internal flash error: {e}")
-                        
-                        # List SD card files if mounted
-                        try:
-                            sd_files = os.listdir('/sd')
-                            if sd_files:
-                                file_list_lines.append("=== SD Card ===")
-                                for file in sorted(sd_files):
-                                    try:
-                                        size = os.stat(f'/sd/{file}')[6]
-                                        file_list_lines.append(f"sd:{file} ({size} bytes)")
-                                    except:
-                                        file_list_lines.append(f"sd:{file}")
-                        except OSError:
-                            file_list_lines.append("=== SD Card: Not mounted ===")
-                        except Exception as e:
-                            file_list_lines.append(f"SD card error: {e}")
-                        
-                        file_list = "\n".join(file_list_lines)
-                        conn.send(file_list.encode())
+                        lines = []
+                        for d, loc, rel in self._list_roots('all'):
+                            try:
+                                first = True
+                                for name, size, is_dir in self.dir_index.entries(d, prefix):
+                                    if self.vfs.is_mount(d, name):
+                                        continue
+                                    if first:
+                                        lines.append("=== Internal Flash ===" if loc == 'internal' else "=== SD Card ===")
+                                        first = False
+                                    label = name if loc == 'internal' else f"{loc}:{name}"
+                                    lines.append(f"{label}/" if is_dir else f"{label} ({size} bytes)")
+                                    if len(lines) >= 32:
+                                        await conn.send(("\n".join(lines) + "\n").encode())
+                                        lines = []
+                            except OSError as e:
+                                self.vfs.failed(loc, e)
+                                if loc == 'sd':
+                                    lines.append("=== SD Card: Not mounted ===")
+                                else:
+                                    lines.append("Internal flash error")
+                        if not self.vfs.mounted('sd'):
+                            lines.append("=== SD Card: Not mounted ===")
+                        await conn.send("\n".join(lines).encode())
                         print("Sent enhanced dual-storage file list")
                     except Exception as e:
-                        conn.send(f"Error listing files: {e}".encode())
+                        await conn.send(f"Error listing files: {e}".encode())
 
                 elif cmd_l in ("space", "df"):
                     # Report free space for internal flash and SD (if mounted)
@@ -174,7 +974,7 @@ class PicoPiFileServer:
                                 return None
 
                         internal_free = _free_bytes('/')
-                        sd_free = _free_bytes('/sd')
+                        sd_free = _free_bytes(self.vfs.mount_point('sd')) if self.vfs.mounted('sd') else None
                         lines = []
                         if internal_free is None:
                             lines.append("Internal: statvfs not available or error")
@@ -185,10 +985,10 @@ class PicoPiFileServer:
                         else:
                             lines.append(f"SD free: {sd_free} bytes ({sd_free//1024} KiB)")
                         resp = "\n".join(lines)
-                        conn.send(resp.encode())
+                        await conn.send(resp.encode())
                     except Exception as e:
                         try:
-                            conn.send(f"Error reporting space: {e}".encode())
+                            await conn.send(f"Error reporting space: {e}".encode())
                         except Exception:
                             pass
 
@@ -197,64 +997,27 @@ class PicoPiFileServer:
                         filename = cmd[4:].strip()
                     else:
                         filename = cmd[9:].strip()
-                    
-                    # Enhanced file location detection - support location prefixes
-                    target_location = None
-                    actual_filename = filename
-                    full_path = None
-                    found_location = None
-                    
-                    # Check for location prefix (e.g., "sd:filename" or "internal:filename")
-                    if ':' in filename:
-                        parts = filename.split(':', 1)
-                        if len(parts) == 2:
-                            location_part = parts[0].lower().strip()
-                            if location_part in ['sd', 'internal', 'flash']:
-                                target_location = 'sd' if location_part == 'sd' else 'internal'
-                                actual_filename = parts[1].strip()
-                    
-                    # Smart file location detection
-                    if target_location:
-                        # User specified a location - try that location only
-                        if target_location == "sd":
-                            try:
-                                os.stat(f"/sd/{actual_filename}")
-                                full_path = f"/sd/{actual_filename}"
-                                found_location = "sd"
-                            except OSError:
-                                conn.send(f"File '{actual_filename}' not found in SD card storage.".encode())
-                                continue
-                        elif target_location == "internal":
-                            try:
-                                os.stat(actual_filename)
-                                full_path = actual_filename
-                                found_location = "internal"
-                            except OSError:
-                                conn.send(f"File '{actual_filename}' not found in internal flash storage.".encode())
-                                continue
-                    else:
-                        # No location specified - search both locations
-                        # Try internal flash first
+                    # Offset form "get <name> offset=<n>" resumes a partial download
+                    offset = 0
+                    head, _, tail = filename.rpartition(" ")
+                    if head and tail.lower().startswith("offset="):
                         try:
-                            os.stat(actual_filename)
-                            full_path = actual_filename
-                            found_location = "internal"
-                        except OSError:
-                            # Try SD card
-                            try:
-                                os.stat(f"/sd/{actual_filename}")
-                                full_path = f"/sd/{actual_filename}"
-                                found_location = "sd"
-                            except OSError:
-                                conn.send(f"File '{actual_filename}' not found in any storage location.".encode())
-                                continue
+                            offset = int(tail[7:])
+                            filename = head.strip()
+                        except ValueError:
+                            pass
+                    
+                    full_path, found_location, actual_filename, st, error = self._find_file(filename)
+                    if error:
+                        await conn.send(f"{error}.".encode())
+                        continue
                     
                     if full_path:
                         self.file_path = full_path
                         print(f"File found in {found_location} storage: {full_path}")
                         # Clear any previous cancel before starting a new transfer
                         self.cancel_requested = False
-                        self.send_file(conn)
+                        await self.send_file(conn, full_path, offset)
                         # After sending the file, try to receive a short ACK from the client
                         # This is more reliable than a blind sleep because it ensures the
                         # client actually received the data before we proceed.
@@ -271,7 +1034,7 @@ class PicoPiFileServer:
                                 pass
                             conn.settimeout(12.0)
                             try:
-                                ack = conn.recv(64)
+                                ack = await conn.recv(64)
                                 if ack:
                                     try:
                                         ack_s = ack.decode(errors='ignore')
@@ -297,7 +1060,7 @@ class PicoPiFileServer:
                                 pass
                         print("TCP transmission/ACK handling complete")
                     else:
-                        conn.send(f"File '{filename}' not found.".encode())
+                        await conn.send(f"File '{filename}' not found.".encode())
 
                 elif cmd_l.startswith("time "):
                     try:
@@ -308,44 +1071,30 @@ class PicoPiFileServer:
                         time_parts = [int(p) for p in parts[1].split(":")]
                         rtc.datetime((date_parts[0], date_parts[1], date_parts[2], 0,
                           time_parts[0], time_parts[1], time_parts[2], 0))
-                        conn.send(b"Time set successfully")
+                        await conn.send(b"Time set successfully")
                         print("RTC updated")
                     except Exception as e:
-                        conn.send(f"Error setting time: {e}".encode())
+                        await conn.send(f"Error setting time: {e}".encode())
+
+                elif (cmd_l.startswith("upload ") or cmd_l.startswith("resume ")) and self._low_memory():
+                    await conn.send(b"Error: low memory, try again later")
+                    break
 
                 elif cmd_l.startswith("upload "):
-                    import gc
-                    filename = cmd[7:].strip()
-                    
-                    # Enhanced upload location detection - support location prefixes
-                    target_location = None
-                    actual_filename = filename
-                    full_path = filename  # Default to internal flash
-                    
-                    # Check for location prefix (e.g., "sd:filename" or "internal:filename")
-                    if ':' in filename:
-                        parts = filename.split(':', 1)
-                        if len(parts) == 2:
-                            location_part = parts[0].lower().strip()
-                            if location_part in ['sd', 'internal', 'flash']:
-                                target_location = 'sd' if location_part == 'sd' else 'internal'
-                                actual_filename = parts[1].strip()
-                                
-                                if target_location == "sd":
-                                    # Check if SD card is mounted
-                                    try:
-                                        os.listdir('/sd')
-                                        full_path = f"/sd/{actual_filename}"
-                                        print(f"Upload target: SD card ({full_path})")
-                                    except OSError:
-                                        conn.send(b"Error: SD card not mounted")
-                                        continue
-                                else:
-                                    full_path = actual_filename
-                                    print(f"Upload target: Internal flash ({full_path})")
-                    
+                    # "upload <name> [crc=<hex>]"; data is staged in <name>.part and
+                    # only replaces <name> once length (and CRC, if given) match
+                    filename, expected_crc = self._split_crc(cmd[7:].strip())
+                    try:
+                        full_path = self._target_path(filename, mkdirs=True)
+                    except ValueError as e:
+                        await conn.send(f"Error: {e}".encode())
+                        continue
+                    if full_path is None:
+                        await conn.send(b"Error: SD card not mounted")
+                        continue
                     print(f"Upload request: {filename} -> {full_path}")
                     filename = full_path  # Update filename to use full path
+                    staged = filename + UPLOAD_PART_SUFFIX
                     try:
                         conn.settimeout(10)  # Prevent hanging
                         # Read exactly 10-byte size header, using any pending bytes first
@@ -358,7 +1107,7 @@ class PicoPiFileServer:
                             header = pending
                             pending = b""
                             while len(header) < needed:
-                                part = conn.recv(needed - len(header))
+                                part = await conn.recv(needed - len(header))
                                 if not part:
                                     raise Exception("connection closed while reading header")
                                 header += part
@@ -399,7 +1148,7 @@ class PicoPiFileServer:
                         if free_bytes is not None and free_bytes < file_size:
                             try:
                                 msg = f"ERROR No space: need {file_size} bytes, free {free_bytes} bytes"
-                                conn.send(msg.encode() + b"\n")
+                                await conn.send(msg.encode() + b"\n")
                             except Exception:
                                 pass
                             print(msg)
@@ -412,123 +1161,35 @@ class PicoPiFileServer:
                         else:
                             # Inform client we're ready to receive (handshake)
                             try:
-                                conn.send(b"READY")
+                                await conn.send(b"READY")
                             except Exception:
                                 pass
 
-                        received = 0
-                        # Compute CRC32 as we write
-                        try:
-                            import uhashlib as hashlib
-                        except Exception:
-                            hashlib = None
-                        crc = 0
                         # Clear cancel flag at start of operation
                         self.cancel_requested = False
-                        # Set a short recv timeout so we can check for idle timeouts periodically
+                        # A sender that stalls for 5 s ends the upload (recv raises OSError)
                         try:
                             conn.settimeout(5)
                         except Exception:
                             pass
 
-                        # Idle timeout: allow longer transfers for big files
-                        try:
-                            idle_timeout = max(15, file_size // 50000)
-                        except Exception:
-                            idle_timeout = 30
-                        last_activity = time.time()
-
-                        with open(filename, 'wb') as f:
+                        self.dir_index.invalidate(staged)
+                        with open(staged, 'wb') as f:
+                            sink = self._sink(f, staged, file_size)
                             # If we already have some file data in pending, write it first
                             if pending:
                                 to_write = pending[:file_size]
-                                f.write(to_write)
-                                received += len(to_write)
-                                if hashlib is None:
-                                    try:
-                                        import binascii
-                                        crc = binascii.crc32(to_write, crc)
-                                    except Exception:
-                                        pass
-                                else:
-                                    try:
-                                        crc = (crc ^ 0xFFFFFFFF)
-                                        h = hashlib.crc32()
-                                        h.update(to_write)
-                                        crc = (crc ^ 0xFFFFFFFF)  # Keep simple if uhashlib lacks crc32
-                                    except Exception:
-                                        pass
+                                sink.feed(to_write)
                                 pending = pending[len(to_write):]
-                            while received < file_size:
+                            while sink.received < file_size:
                                 try:
-                                    chunk = conn.recv(min(1024, file_size - received))
-                                    if not chunk:
-                                        # No data - check idle timeout
-                                        if time.time() - last_activity > idle_timeout:
-                                            msg = f"ERROR Upload timeout after {idle_timeout}s at {received}/{file_size} bytes"
-                                            try:
-                                                conn.send(msg.encode() + b"\n")
-                                            except Exception:
-                                                pass
-                                            print(msg)
-                                            # Delete partial file to avoid leaving incomplete uploads
-                                            try:
-                                                f.close()
-                                            except Exception:
-                                                pass
-                                            try:
-                                                os.remove(filename)
-                                            except Exception:
-                                                pass
-                                            # Close connection to stop further client traffic
-                                            try:
-                                                conn.close()
-                                            except Exception:
-                                                pass
-                                            break
-                                        # else just continue waiting
-                                        continue
-                                    # Reset last activity time on receiving data
-                                    last_activity = time.time()
-
-                                    # Before writing, optionally re-check free space periodically
-                                    if free_bytes is not None and (file_size - received) > free_bytes:
-                                        msg = f"ERROR No space during upload: need additional {file_size - received} bytes, free {free_bytes} bytes"
-                                        try:
-                                            conn.send(msg.encode() + b"\n")
-                                        except Exception:
-                                            pass
-                                        print(msg)
-                                        # Delete partial file
-                                        try:
-                                            f.close()
-                                        except Exception:
-                                            pass
-                                        try:
-                                            os.remove(filename)
-                                        except Exception:
-                                            pass
-                                        # Close connection to stop further client traffic
-                                        try:
-                                            conn.close()
-                                        except Exception:
-                                            pass
+                                    n = await sink.recv_from(conn)
+                                    if not n:
+                                        # Client closed the connection; the part file stays for "resume".
+                                        # (A stalled sender raises OSError from the 5 s recv timeout.)
+                                        print(f"Connection closed at {sink.received}/{file_size} bytes")
                                         break
 
-                                    f.write(chunk)
-                                    received += len(chunk)
-                                    # update CRC
-                                    try:
-                                        import binascii
-                                        crc = binascii.crc32(chunk, crc)
-                                    except Exception:
-                                        pass
-
-                                    if received % 102400 == 0:
-                                        f.flush()
-                                        gc.collect()
-                                        print(f"Received {received}/{file_size} bytes...")
-
                                     # Cooperative cancel (button or flag)
                                     if self._check_cancel():
                                         print("Upload canceled by user")
@@ -536,10 +1197,16 @@ class PicoPiFileServer:
                                 except OSError as e:
                                     print("Socket timeout or error:", e)
                                     break
+                            sink.close()
+                        received = sink.received
+                        crc = sink.crc
+                        if received < file_size:
+                            # Let a later "resume" continue the CRC without re-reading the part file
+                            self.digests.put(staged, "crc32", "%08X" % (crc & 0xFFFFFFFF))
 
                         if self.cancel_requested:
                             try:
-                                conn.send(b"Upload canceled")
+                                await conn.send(b"Upload canceled")
                             except Exception:
                                 pass
                             print(f"Upload canceled at {received}/{file_size} bytes")
@@ -550,30 +1217,49 @@ class PicoPiFileServer:
                                 crc_hex = "%08X" % crc_hex
                             except Exception:
                                 crc_hex = "00000000"
-                            conn.send(f"OK {filename} {received} CRC {crc_hex}".encode())
-                            print(f"Upload complete: {received} bytes")
+                            if expected_crc and expected_crc != crc_hex:
+                                try:
+                                    os.remove(staged)
+                                except OSError:
+                                    pass
+                                await conn.send(f"ERROR CRC mismatch: got {crc_hex}, expected {expected_crc}".encode())
+                                print(f"Upload CRC mismatch: {crc_hex} != {expected_crc}")
+                            else:
+                                self._commit_upload(staged, filename, crc_hex)
+                                await conn.send(f"OK {filename} {received} CRC {crc_hex}".encode())
+                                print(f"Upload complete: {received} bytes")
                         else:
-                            conn.send(f"Upload incomplete: received {received}/{file_size} bytes.".encode())
+                            await conn.send(f"Upload incomplete: received {received}/{file_size} bytes.".encode())
                             print(f"Upload incomplete: received {received}/{file_size} bytes")
 
                     except Exception as e:
                         print("Error during upload:", e)
                         try:
-                            conn.send(f"Error uploading file: {e}".encode())
+                            await conn.send(f"Error uploading file: {e}".encode())
                         except Exception:
                             pass
 
                 elif cmd_l.startswith("resume "):
-                    import gc
-                    filename = cmd[7:].strip()
+                    # "resume <name> [crc=<hex>]" continues the staged <name>.part
+                    filename, expected_crc = self._split_crc(cmd[7:].strip())
+                    try:
+                        full_path = self._target_path(filename, mkdirs=True)
+                    except ValueError as e:
+                        await conn.send(f"Error: {e}".encode())
+                        continue
+                    if full_path is None:
+                        await conn.send(b"Error: SD card not mounted")
+                        continue
+                    filename = full_path
+                    staged = filename + UPLOAD_PART_SUFFIX
                     try:
                         # Check how much of the file already exists
                         try:
-                            current_size = os.stat(filename)[6]
+                            current_size = os.stat(staged)[6]
                         except OSError:
                             current_size = 0
 
-                        conn.send(f"{current_size}".encode())
+                        await conn.send(f"{current_size}".encode())
                         print(f"Resuming upload for '{filename}' from byte {current_size}")
 
                         # Read 10-byte header for total file size
@@ -587,7 +1273,7 @@ class PicoPiFileServer:
                             header = pending
                             pending = b""
                             while len(header) < needed:
-                                part = conn.recv(needed - len(header))
+                                part = await conn.recv(needed - len(header))
                                 if not part:
                                     raise Exception("connection closed while reading header")
                                 header += part
@@ -597,58 +1283,30 @@ class PicoPiFileServer:
                             raise Exception("invalid size header: %r" % header)
                         print(f"Total file size: {total_size}")
 
-                        received = current_size
                         # Start CRC from existing file content
                         crc = 0
                         try:
-                            import binascii
-                            # Compute CRC over existing portion in small chunks
                             if current_size > 0:
-                                with open(filename, 'rb') as rf:
-                                    to_go = current_size
-                                    buf = bytearray(1024)
-                                    while to_go > 0:
-                                        n = rf.readinto(buf)
-                                        if not n:
-                                            break
-                                        crc = binascii.crc32(memoryview(buf)[:n], crc)
-                                        to_go -= n
+                                cached = self.digests.get(staged, "crc32")
+                                crc = int(cached, 16) if cached else self._file_crc32(staged, current_size)
                         except Exception:
                             pass
                         # Clear cancel flag at start of operation
                         self.cancel_requested = False
-                        with open(filename, 'ab') as f:
+                        self.dir_index.invalidate(staged)
+                        with open(staged, 'ab') as f:
+                            sink = self._sink(f, staged, max(0, total_size - current_size),
+                                             offset=current_size, crc=crc)
                             # Write any pending payload first
-                            if pending and received < total_size:
-                                to_write = pending[:(total_size - received)]
-                                f.write(to_write)
-                                received += len(to_write)
-                                try:
-                                    import binascii
-                                    crc = binascii.crc32(to_write, crc)
-                                except Exception:
-                                    pass
+                            if pending and current_size < total_size:
+                                to_write = pending[:(total_size - current_size)]
+                                sink.feed(to_write)
                                 pending = pending[len(to_write):]
-                            while received < total_size:
+                            while sink.received < sink.total:
                                 try:
-                                    chunk = conn.recv(min(1024, total_size - received))
-                                    if not chunk:
+                                    if not await sink.recv_from(conn):
                                         print("Connection closed or no data received")
                                         break
-                                    f.write(chunk)
-                                    received += len(chunk)
-                                    try:
-                                        import binascii
-                                        crc = binascii.crc32(chunk, crc)
-                                    except Exception:
-                                        pass
-
-                                    # Flush and collect garbage periodically
-                                    if received % 102400 == 0:
-                                        f.flush()
-                                        gc.collect()
-                                        print(f"Received {received}/{total_size} bytes...")
-
                                     # Cooperative cancel
                                     if self._check_cancel():
                                         print("Resume canceled by user")
@@ -657,29 +1315,50 @@ class PicoPiFileServer:
                                 except OSError as e:
                                     print("Socket timeout or error:", e)
                                     break
+                            sink.close()
+                        received = current_size + sink.received
+                        crc = sink.crc
+                        if received < total_size:
+                            self.digests.put(staged, "crc32", "%08X" % (crc & 0xFFFFFFFF))
 
                         if self.cancel_requested:
                             try:
-                                conn.send(b"Resume canceled")
+                                await conn.send(b"Resume canceled")
                             except Exception:
                                 pass
                             print(f"Resume canceled at {received}/{total_size} bytes")
+                        elif received != total_size:
+                            await conn.send(f"Upload incomplete: received {received}/{total_size} bytes.".encode())
+                            print(f"Resume incomplete: received {received}/{total_size} bytes")
                         else:
                             try:
                                 crc_hex = (crc & 0xFFFFFFFF)
                                 crc_hex = "%08X" % crc_hex
                             except Exception:
                                 crc_hex = "00000000"
-                            print(f"File '{filename}' resumed and completed ({received} bytes), CRC {crc_hex}")
-                            conn.send(f"OK {filename} {received} CRC {crc_hex}".encode())
+                            if expected_crc and expected_crc != crc_hex:
+                                try:
+                                    os.remove(staged)
+                                except OSError:
+                                    pass
+                                await conn.send(f"ERROR CRC mismatch: got {crc_hex}, expected {expected_crc}".encode())
+                                print(f"Resume CRC mismatch: {crc_hex} != {expected_crc}")
+                            else:
+                                self._commit_upload(staged, filename, crc_hex)
+                                print(f"File '{filename}' resumed and completed ({received} bytes), CRC {crc_hex}")
+                                await conn.send(f"OK {filename} {received} CRC {crc_hex}".encode())
 
                     except Exception as e:
                         print("Error during resume:", e)
-                        conn.send(f"Error resuming file: {e}".encode())
+                        await conn.send(f"Error resuming file: {e}".encode())
 
                 else:
                     print("Unknown command.")
-                    conn.send(b"Unknown command.")
+                    await conn.send(b"Unknown command.")
+        except MemoryError as e:
+            print("Out of memory handling client:", e)
+            if telemetry:
+                telemetry.mem_error("tcp", e)
         except Exception as e:
             print("Error handling client:", e)
         finally:
@@ -687,22 +1366,31 @@ class PicoPiFileServer:
             print("Connection closed\n")
 
     # ---------------- HTTP SERVER (no bridge) -----------------
-    def _http_send(self, conn, status_code=200, headers=None, body_bytes=b""):
-        reason = {200: "OK", 204: "No Content", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Server Error"}.get(status_code, "OK")
+    async def _http_send(self, conn, status_code=200, headers=None, body_bytes=b""):
+        reason = {200: "OK", 204: "No Content", 206: "Partial Content", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                  409: "Conflict", 416: "Range Not Satisfiable", 422: "Unprocessable Entity", 500: "Server Error",
+                  503: "Service Unavailable"}.get(status_code, "OK")
+        conn.status = status_code
         try:
-            conn.send(b"HTTP/1.1 %d %s\r\n" % (status_code, reason.encode()))
+            await conn.send(b"HTTP/1.1 %d %s\r\n" % (status_code, reason.encode()))
         except TypeError:
-            conn.send("HTTP/1.1 %d %s\r\n" % (status_code, reason))
+            await conn.send("HTTP/1.1 %d %s\r\n" % (status_code, reason))
         # Default headers + CORS
         base = {
-            "Connection": "close",
+            "Connection": "keep-alive" if conn.keep_alive else "close",
             "Cache-Control": "no-store",
             "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "GET, POST, DELETE, OPTIONS",
-            "Access-Control-Allow-Headers": "Content-Type, X-Mode, X-Offset",
+            "Access-Control-Allow-Methods": "GET, HEAD, POST, PUT, DELETE, OPTIONS",
+            "Access-Control-Allow-Headers": "Content-Type, X-Mode, X-Offset, X-CRC32, Range, If-None-Match, If-Modified-Since",
+            "Access-Control-Expose-Headers": "Content-Length, Content-Range, Accept-Ranges, ETag, Last-Modified, "
+                                             "X-File-Location, X-File-Path, X-Offset",
+            # Let browsers reuse a preflight across the chunks of a session upload
+            "Access-Control-Max-Age": "600",
             # Chrome Private Network Access (PNA) support when page is https and target is private http
             "Access-Control-Allow-Private-Network": "true",
         }
+        if conn.keep_alive:
+            base["Keep-Alive"] = "timeout=%d" % self.keepalive_timeout
         if headers:
             base.update(headers)
         if body_bytes is not None:
@@ -712,36 +1400,76 @@ class PicoPiFileServer:
                 line = b"%s: %s\r\n" % (str(k).encode(), str(v).encode())
             except Exception:
                 line = ("%s: %s\r\n" % (k, v))
-            conn.send(line)
-        conn.send(b"\r\n")
+            await conn.send(line)
+        await conn.send(b"\r\n")
         if body_bytes:
-            conn.send(body_bytes)
+            await conn.send(body_bytes)
 
-    def _http_json(self, conn, obj, status_code=200):
+    async def _http_json(self, conn, obj, status_code=200, headers=None, conditional=None):
+        """Send obj as JSON. With conditional (the request headers) the body gets a
+        CRC32 ETag and a matching If-None-Match is answered with 304."""
         try:
             import ujson as json
         except Exception:
             import json
-        body = json.dumps(obj)
-        self._http_send(conn, status_code, headers={"Content-Type": "application/json"}, body_bytes=body.encode())
+        body = json.dumps(obj).encode()
+        hdrs = {"Content-Type": "application/json"}
+        if headers:
+            hdrs.update(headers)
+        if conditional is not None and binascii:
+            etag = '"%08x"' % (binascii.crc32(body) & 0xFFFFFFFF)
+            hdrs["ETag"] = etag
+            hdrs["Cache-Control"] = "no-cache"
+            if self._not_modified(conditional, etag):
+                await self._http_send(conn, 304, headers={"ETag": etag, "Cache-Control": "no-cache"}, body_bytes=None)
+                return
+        await self._http_send(conn, status_code, headers=hdrs, body_bytes=body)
+
+    def _file_validators(self, st):
+        """ETag (size + mtime) and Last-Modified for an os.stat() result."""
+        size = st[6]
+        mtime = st[8] if len(st) > 8 else 0
+        etag = '"%x-%x"' % (size, int(mtime))
+        gmtime = getattr(time, "gmtime", time.localtime)
+        t = gmtime(int(mtime))
+        last_modified = "%s, %02d %s %04d %02d:%02d:%02d GMT" % (
+            ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")[t[6]], t[2],
+            ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")[t[1] - 1],
+            t[0], t[3], t[4], t[5])
+        return etag, last_modified
 
-    def _read_until(self, conn, delim=b"\r\n\r\n", max_bytes=4096, first_chunk=None):
+    def _not_modified(self, headers, etag, last_modified=None):
+        """True if the request's If-None-Match / If-Modified-Since still match."""
+        inm = headers.get('if-none-match')
+        if inm is not None:
+            # If-None-Match wins over If-Modified-Since; compare weakly
+            for tag in inm.split(','):
+                tag = tag.strip()
+                if tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == etag:
+                    return True
+            return False
+        # Clients echo Last-Modified back verbatim, so an exact match is enough
+        ims = headers.get('if-modified-since')
+        return last_modified is not None and ims is not None and ims.strip() == last_modified
+
+    async def _read_until(self, conn, delim=b"\r\n\r\n", max_bytes=4096, first_chunk=None, timeout=5):
+        """Read up to and including delim; anything after it is pushed back with unread()."""
         buf = bytearray()
         if first_chunk:
             buf.extend(first_chunk)
-            if delim in buf:
-                return bytes(buf)
         try:
-            conn.settimeout(5)
+            conn.settimeout(timeout)
         except Exception:
             pass
-        while len(buf) < max_bytes:
-            b = conn.recv(256)
+        while delim not in buf and len(buf) < max_bytes:
+            b = await conn.recv(256)
             if not b:
                 break
             buf.extend(b)
-            if delim in buf:
-                break
+        end = buf.find(delim)
+        if end != -1:
+            conn.unread(bytes(buf[end + len(delim):]))
+            del buf[end + len(delim):]
         return bytes(buf)
 
     def _parse_request(self, head_bytes):
@@ -756,7 +1484,7 @@ class PicoPiFileServer:
             return None
         req_line = lines[0]
         try:
-            method, path, _ = req_line.split(" ", 2)
+            method, path, version = req_line.split(" ", 2)
         except ValueError:
             return None
         headers = {}
@@ -766,7 +1494,7 @@ class PicoPiFileServer:
             kv = ln.split(":", 1)
             if len(kv) == 2:
                 headers[kv[0].strip().lower()] = kv[1].strip()
-        return method, path, headers
+        return method, path, version.strip(), headers
 
     def _qparam(self, path, key, default=None):
         qpos = path.find("?")
@@ -780,10 +1508,6 @@ class PicoPiFileServer:
             if len(kv) == 2 and kv[0] == key:
                 # Basic URL-decoding for spaces and %xx
                 val = kv[1].replace("+", " ")
-                try:
-                    import ubinascii as binascii
-                except Exception:
-                    import binascii
                 i = 0
                 out = ""
                 while i < len(val):
@@ -800,324 +1524,1166 @@ class PicoPiFileServer:
                 return out
         return default
 
-    def handle_http_session(self, conn, first_chunk=None):
-        head = self._read_until(conn, first_chunk=first_chunk)
-        req = self._parse_request(head)
-        if not req:
-            self._http_send(conn, 400)
-            return
-        method, path, headers = req
-        cl = int(headers.get('content-length', '0') or '0')
-        # Dispatch
-        if method == 'OPTIONS':
-            # Preflight OK (no body)
-            self._http_send(conn, 204)
-            return
-        if path.startswith('/api/status'):
-            st = self.status()
-            d = {"status": "ok"}
+    def _makedirs(self, path):
+        """Create the missing parent directories of path (mkdir -p)."""
+        idx = path.find('/', 1)
+        while idx != -1:
+            d = path[:idx]
             try:
-                d.update(st)
-            except Exception:
+                os.mkdir(d)
+                self.dir_index.invalidate(d)
+            except OSError:
+                # Already there; anything worse shows up when the file is opened
                 pass
-            self._http_json(conn, d)
-            return
-        if path.startswith('/api/list') and method == 'GET':
+            idx = path.find('/', idx + 1)
+
+    def _target_path(self, name, mkdirs=False):
+        """Map a name with an optional sd:/internal:/flash: prefix and subdirectories
+        to the path to write, creating its directories if mkdirs is set.
+
+        Returns None when the SD card is requested but not mounted; raises
+        ValueError for paths that try to leave the storage root.
+        """
+        full_path, location, rel = self.vfs.target(name)
+        if full_path is not None and mkdirs:
+            self._makedirs(full_path)
+        return full_path
+
+    async def _http_target(self, conn, name, mkdirs=False):
+        """_target_path() for HTTP routes: sends the error response and returns None on failure."""
+        if not name:
+            await self._http_json(conn, {"status": "error", "message": "missing name"}, status_code=400)
+            return None
+        try:
+            full_path = self._target_path(name, mkdirs)
+        except ValueError as e:
+            await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=400)
+            return None
+        if full_path is None:
+            await self._http_json(conn, {"status": "error", "message": "SD card not mounted"}, status_code=503)
+        return full_path
+
+    def _find_file(self, name):
+        """Locate an existing file. Without a location prefix internal flash is
+        tried before the SD card. Returns (full_path, location, rel_path, stat, error)."""
+        return self.vfs.find(name)
+
+    def _sink(self, f, path, total, offset=0, crc=0):
+        """_UploadSink writing f (open on path) in blocks sized for its storage."""
+        loc = self.vfs.location_of(path)
+        return _UploadSink(f, total, self.sd_block_size if loc == 'sd' else self.upload_buf_size,
+                           offset, crc, loc)
+
+    def _split_crc(self, arg):
+        """Split an optional trailing "crc=<hex>" off a TCP command argument."""
+        head, _, tail = arg.rpartition(" ")
+        if head and tail.lower().startswith("crc="):
+            return head.strip(), tail[4:].upper()
+        return arg, None
+
+    def _commit_upload(self, staged, target, crc_hex=None):
+        """Move a complete, verified upload from staged over target, recording
+        its CRC32 (as computed while receiving) in the digest cache. Returns the
+        code slot the file was staged into instead (see _install_file), or None."""
+        slot = _install_file(staged, target)
+        self.dir_index.invalidate(target)
+        self.digests.drop(staged)
+        if slot:
+            print(f"{target} staged in code slot {slot}, runs after the next reset")
+        elif crc_hex:
+            self.digests.put(target, "crc32", crc_hex)
+        else:
+            self.digests.drop(target)
+        return slot
+
+    def _clean_upload_temps(self):
+        """Remove temp files left by uploads that were cut off (e.g. by a reset)."""
+        for loc, d in self.vfs.roots:
+            if not self.vfs.mounted(loc):
+                continue
             try:
-                # Enhanced dual-storage file listing for HTTP API
-                internal_files = []
-                sd_files = []
-                
-                # List internal flash files
-                try:
-                    if hasattr(os, 'ilistdir'):
-                        for ent in os.ilistdir('/'):
-                            try:
-                                name = ent[0]
-                                ftype = ent[1]
-                                size = ent[3] if len(ent) > 3 else None
-                                if name != "sd" and (ftype == 0x8000 or size is not None):
-                                    internal_files.append({
-                                        "name": name, 
-                                        "size": size if size is not None else 0,
-                                        "location": "internal"
-                                    })
-                            except Exception:
-                                pass
-                    else:
-                        for name in os.listdir('/'):
-                            if name != "sd":
-                                try:
-                                    size = os.stat(name)[6]
-                                except Exception:
-                                    size = 0
-                                internal_files.append({
-                                    "name": name, 
-                                    "size": size,
-                                    "location": "internal"
-                                })
-                except Exception:
-                    pass
-                
-                # List SD card files if mounted
-                try:
-                    if hasattr(os, 'ilistdir'):
-                        for ent in os.ilistdir('/sd'):
-                            try:
-                                name = ent[0]
-                                ftype = ent[1]
-                                size = ent[3] if len(ent) > 3 else None
-                                if ftype == 0x8000 or size is not None:
-                                    sd_files.append({
-                                        "name": f"sd:{name}", 
-                                        "size": size if size is not None else 0,
-                                        "location": "sd",
-                                        "actual_name": name
-                                    })
-                            except Exception:
-                                pass
-                    else:
-                        for name in os.listdir('/sd'):
-                            try:
-                                size = os.stat(f'/sd/{name}')[6]
-                            except Exception:
-                                size = 0
-                            sd_files.append({
-                                "name": f"sd:{name}", 
-                                "size": size,
-                                "location": "sd",
-                                "actual_name": name
-                            })
+                names = os.listdir(d) if d else os.listdir()
+            except OSError:
+                continue
+            for n in names:
+                if n.endswith(UPLOAD_TMP_SUFFIX):
+                    try:
+                        os.remove(f"{d}/{n}" if d else n)
+                        print(f"Removed stale upload temp file {n}")
+                    except OSError:
+                        pass
+
+    def _file_digest(self, path, algo, fresh=False):
+        """Hex digest of path using the digest cache; returns (digest, cached)."""
+        if not fresh:
+            digest = self.digests.get(path, algo)
+            if digest:
+                return digest, True
+        if algo == "crc32":
+            digest = "%08X" % self._file_crc32(path)
+        else:
+            h = hashlib.sha256()
+            buf = bytearray(1024)
+            mv = memoryview(buf)
+            with open(path, 'rb') as f:
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    h.update(mv[:n])
+            digest = binascii.hexlify(h.digest()).decode()
+        self.digests.put(path, algo, digest)
+        return digest, False
+
+    def _file_crc32(self, path, length=None):
+        """CRC32 of the first length bytes of path (whole file if None)."""
+        crc = 0
+        buf = bytearray(1024)
+        mv = memoryview(buf)
+        with open(path, 'rb') as f:
+            while length is None or length > 0:
+                n = f.readinto(buf if length is None or length >= len(buf) else mv[:length])
+                if not n:
+                    break
+                crc = binascii.crc32(mv[:n], crc)
+                if length is not None:
+                    length -= n
+        return crc & 0xFFFFFFFF
+
+    async def _upload_session(self, conn, method, path, headers, mode):
+        """Resumable upload in chunks, staged in <target>.part.
+
+        HEAD/GET    report the committed size (X-Offset)
+        PUT         (or POST mode=chunk) append the body at X-Offset (or ?offset=);
+                    the offset must equal the committed size, 0 restarts
+        POST mode=commit&size=N&crc32=HEX
+                    verify the whole staged file and move it into place
+        DELETE      abandon the session
+        """
+        name = self._qparam(path, 'name')
+        full_path = await self._http_target(conn, name, mkdirs=method in ('PUT', 'POST'))
+        if full_path is None:
+            return
+        part = full_path + UPLOAD_PART_SUFFIX
+        if method != 'HEAD' and method != 'GET':
+            # Every other request creates, grows or removes the staged file
+            self.dir_index.invalidate(part)
+        try:
+            committed = os.stat(part)[6]
+        except OSError:
+            committed = 0
+
+        if method == 'HEAD':
+            await self._http_send(conn, 200, headers={"X-Offset": str(committed), "Content-Length": "0"})
+            return
+        if method == 'GET':
+            await self._http_json(conn, {"status": "ok", "name": name, "offset": committed},
+                                  headers={"X-Offset": str(committed)})
+            return
+        if method == 'DELETE':
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            await self._http_json(conn, {"status": "ok", "message": "upload session removed", "name": name})
+            return
+
+        if mode == 'commit':
+            expected_crc = self._qparam(path, 'crc32')
+            size = self._qparam(path, 'size')
+            if not expected_crc:
+                await self._http_json(conn, {"status": "error", "message": "missing crc32"}, status_code=400)
+                return
+            try:
+                if size is not None and int(size) != committed:
+                    await self._http_json(conn, {"status": "error", "message": "size mismatch",
+                                                 "offset": committed, "expected": int(size)}, status_code=409)
+                    return
+                crc_hex = "%08X" % self._file_crc32(part)
+            except (OSError, ValueError) as e:
+                await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=400)
+                return
+            if crc_hex != expected_crc.upper():
+                # Staged data is bad; drop it so the client starts over
+                try:
+                    os.remove(part)
                 except OSError:
-                    # SD card not mounted
-                    pass
-                except Exception:
                     pass
-                
-                # Combine files from both locations
-                all_files = internal_files + sd_files
-                
-                response = {
-                    "status": "ok", 
-                    "files": all_files,
-                    "internal_count": len(internal_files),
-                    "sd_count": len(sd_files),
-                    "total_count": len(all_files)
-                }
-                
-                self._http_json(conn, response)
+                await self._http_json(conn, {"status": "error", "message": "crc mismatch",
+                                             "crc32": crc_hex, "expected": expected_crc.upper()}, status_code=422)
+                return
+            try:
+                slot = self._commit_upload(part, full_path, crc_hex)
+            except OSError as e:
+                await self._http_json(conn, {"status": "error", "message": f"commit failed: {e}"}, status_code=500)
+                return
+            print(f"HTTP upload session committed: {full_path} ({committed} bytes, CRC {crc_hex})")
+            await self._http_json(conn, {"status": "ok", "message": _staged_message(slot, "uploaded"),
+                                         "bytes": committed, "crc32": crc_hex})
+            return
+
+        # Chunk: PUT, or POST with mode=chunk
+        offset = headers.get('x-offset') or self._qparam(path, 'offset')
+        try:
+            offset = int(offset)
+        except (TypeError, ValueError):
+            await self._http_json(conn, {"status": "error", "message": "missing offset"}, status_code=400)
+            return
+        if offset != 0 and offset != committed:
+            await self._http_json(conn, {"status": "error", "message": "offset mismatch", "offset": committed},
+                                  status_code=409, headers={"X-Offset": str(committed)})
+            return
+        cl = conn.body_left or 0
+        self.cancel_requested = False
+        try:
+            with open(part, 'wb' if offset == 0 else 'ab') as f:
+                sink = self._sink(f, part, cl, offset=offset)
+                while sink.received < cl:
+                    if not await sink.recv_from(conn):
+                        break
+                    if self._check_cancel():
+                        break
+                sink.close()
+        except OSError as e:
+            await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=500)
+            return
+        committed = offset + sink.received
+        hdrs = {"X-Offset": str(committed)}
+        if sink.received != cl:
+            # Whatever arrived is kept; the client resumes from the reported offset
+            await self._http_json(conn, {"status": "error", "message": "chunk incomplete", "offset": committed},
+                                  status_code=500, headers=hdrs)
+            return
+        await self._http_json(conn, {"status": "ok", "offset": committed, "bytes": sink.received,
+                                     "crc32": "%08X" % (sink.crc & 0xFFFFFFFF)}, headers=hdrs)
+
+    def _parse_range(self, value, size):
+        """Parse a single-range Range header into inclusive (start, end).
+
+        Returns None to serve the whole file (no header, multiple ranges or an
+        unknown unit) and -1 when the range can't be satisfied.
+        """
+        if not value or not value.startswith("bytes=") or "," in value:
+            return None
+        first, _, last = value[6:].strip().partition("-")
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+            else:
+                # Suffix range: the last N bytes
+                start = max(0, size - int(last))
+                end = size - 1
+        except ValueError:
+            return None
+        if start >= size or end < start:
+            return -1
+        return start, min(end, size - 1)
+
+    def _wants_keep_alive(self, version, headers):
+        token = headers.get('connection', '').lower()
+        if 'close' in token or 'transfer-encoding' in headers:
+            return False
+        if version == 'HTTP/1.1':
+            return True
+        return 'keep-alive' in token
+
+    async def handle_http_session(self, conn, first_chunk=None):
+        """Serve HTTP requests on conn until the client or a response closes it."""
+        conn.unread(first_chunk)
+        served = 0
+        while True:
+            try:
+                head = await self._read_until(conn, timeout=5 if served == 0 else self.keepalive_timeout)
+            except OSError:
+                # Idle keep-alive connection timed out
+                return
+            if not head.strip():
+                return
+            req = self._parse_request(head)
+            if not req:
+                conn.keep_alive = False
+                await self._http_send(conn, 400)
+                return
+            method, path, version, headers = req
+            served += 1
+            conn.keep_alive = served < self.keepalive_max and self._wants_keep_alive(version, headers)
+            conn.chunked_ok = version == 'HTTP/1.1'
+            cl = int(headers.get('content-length', '0') or '0')
+            conn.body_left = cl
+            conn.status = None
+            failed = True
+            t0 = ticks_us()
+            sent0 = conn.bytes_out
+            try:
+                await self._http_route(conn, method, path, headers, cl)
+                failed = conn.status is None or conn.status >= 400
+            except MemoryError as e:
+                print("Out of memory serving", path, e)
+                if telemetry:
+                    telemetry.mem_error(path.split("?")[0], e)
+                # The response may be half sent: give up on the connection
+                return
+            finally:
+                left = conn.body_left
+                conn.body_left = None
+                if telemetry:
+                    telemetry.observe("http", _route_name(method, path), ticks_diff(ticks_us(), t0), failed,
+                                      len(head) + cl - (left or 0), conn.bytes_out - sent0)
+            if not conn.keep_alive:
+                return
+            # Drain whatever the route left unread so the next request starts cleanly
+            if left:
+                if left > 65536:
+                    return
+                try:
+                    while left > 0:
+                        b = await conn.recv(min(512, left))
+                        if not b:
+                            return
+                        left -= len(b)
+                except OSError:
+                    return
+
+    async def _http_route(self, conn, method, path, headers, cl):
+        # Dispatch
+        if method == 'OPTIONS':
+            # Preflight OK (no body)
+            await self._http_send(conn, 204)
+            return
+        if path.startswith('/api/status'):
+            st = self.status()
+            d = {"status": "ok"}
+            try:
+                d.update(st)
+            except Exception:
+                pass
+            await self._http_json(conn, d)
+            return
+        if (path.startswith('/api/history') or (method in ('POST', 'PUT') and (
+                path.startswith('/api/upload') or path.startswith('/api/delta') or path.startswith('/api/bundle')))) \
+                and self._low_memory():
+            # The body is not read: close instead of draining it
+            conn.keep_alive = False
+            await self._http_json(conn, {"status": "error", "message": "low memory, try again later",
+                                         "memory": telemetry.mem_report()},
+                                  status_code=503, headers={"Retry-After": "30"})
+            return
+        if path.startswith('/api/list') and method == 'GET':
+            try:
+                await self._http_list(conn, path, headers)
+            except Exception as e:
+                await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=500)
+            return
+        if path.startswith('/api/tree') and method == 'GET':
+            try:
+                await self._http_tree(conn, path, headers)
             except Exception as e:
-                self._http_json(conn, {"status": "error", "message": str(e)}, status_code=500)
+                # Part of the body may be out already; closing ends it
+                conn.keep_alive = False
+                print("Error streaming tree:", e)
+            return
+        if path.startswith('/api/hash') and method == 'GET':
+            # /api/hash?name=F&algo=crc32|sha256[&fresh=1]
+            name = self._qparam(path, 'name')
+            algo = (self._qparam(path, 'algo', 'crc32') or 'crc32').lower()
+            if not name:
+                await self._http_json(conn, {"status": "error", "message": "missing name"}, status_code=400)
+                return
+            if algo not in HASH_ALGOS or (algo == "sha256" and not hashlib) or not binascii:
+                await self._http_json(conn, {"status": "error", "message": f"unsupported algo: {algo}"}, status_code=400)
+                return
+            full_path, found_location, actual_filename, st, error = self._find_file(name)
+            if error:
+                await self._http_json(conn, {"status": "error", "message": error},
+                                      status_code=400 if error.startswith("invalid path") else 404)
+                return
+            try:
+                digest, cached = self._file_digest(full_path, algo, fresh=self._qparam(path, 'fresh') == '1')
+                await self._http_json(conn, {"status": "ok", "name": name, "path": full_path, "algo": algo,
+                                             "hash": digest, "size": st[6], "cached": cached})
+            except Exception as e:
+                await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=500)
+            return
+        if path.startswith('/api/history') and method == 'GET':
+            await self._http_history(conn, path)
+            return
+        if path.startswith('/api/settings') and method in ('GET', 'POST', 'DELETE'):
+            await self._http_settings(conn, method, path)
+            return
+        if path.startswith('/api/metrics') and method == 'GET':
+            await self._http_metrics(conn)
+            return
+        if path.startswith('/api/perf') and method in ('GET', 'DELETE'):
+            # GET: timing histograms (water_main's control loop); DELETE: reset them
+            if telemetry is None:
+                await self._http_json(conn, {"status": "error", "message": "telemetry.py not installed"}, status_code=404)
+                return
+            if method == 'DELETE':
+                telemetry.reset()
+            await self._http_json(conn, {"status": "ok", "perf": telemetry.report(self._qparam(path, 'buckets') != '0')},
+                                  headers={"Cache-Control": "no-cache"})
+            return
+        if path.startswith('/api/stats') and method == 'GET':
+            await self._http_stats(conn, path)
+            return
+        if path.startswith('/api/blocks') and method == 'GET':
+            await self._http_blocks(conn, path)
+            return
+        if path.startswith('/api/delta') and method == 'POST':
+            await self._http_delta(conn, path, headers)
+            return
+        if path.startswith('/api/bundle') and method == 'POST':
+            await self._http_bundle(conn, path)
+            return
+        if path.startswith('/api/ota') and method == 'GET':
+            if ota is None:
+                await self._http_json(conn, {"status": "error", "message": "ota.py not installed"}, status_code=404)
+                return
+            await self._http_json(conn, {"status": "ok", "ota": ota.status()})
             return
         if path.startswith('/api/get') and method == 'GET':
             name = self._qparam(path, 'name')
             if not name:
-                self._http_json(conn, {"status": "error", "message": "missing name"}, status_code=400)
+                await self._http_json(conn, {"status": "error", "message": "missing name"}, status_code=400)
                 return
             
-            # Enhanced file location detection - support location prefixes
-            target_location = None
-            actual_filename = name
-            full_path = None
-            found_location = None
-            
-            # Check for location prefix (e.g., "sd:filename" or "internal:filename")
-            if ':' in name:
-                parts = name.split(':', 1)
-                if len(parts) == 2:
-                    location_part = parts[0].lower().strip()
-                    if location_part in ['sd', 'internal', 'flash']:
-                        target_location = 'sd' if location_part == 'sd' else 'internal'
-                        actual_filename = parts[1].strip()
-            
-            # Smart file location detection
-            if target_location:
-                # User specified a location - try that location only
-                if target_location == "sd":
-                    try:
-                        os.stat(f"/sd/{actual_filename}")
-                        full_path = f"/sd/{actual_filename}"
-                        found_location = "sd"
-                    except OSError:
-                        self._http_json(conn, {"status": "error", "message": f"File '{actual_filename}' not found in SD card storage"}, status_code=404)
-                        return
-                elif target_location == "internal":
-                    try:
-                        os.stat(actual_filename)
-                        full_path = actual_filename
-                        found_location = "internal"
-                    except OSError:
-                        self._http_json(conn, {"status": "error", "message": f"File '{actual_filename}' not found in internal flash storage"}, status_code=404)
-                        return
-            else:
-                # No location specified - search both locations
-                # Try internal flash first
-                try:
-                    os.stat(actual_filename)
-                    full_path = actual_filename
-                    found_location = "internal"
-                except OSError:
-                    # Try SD card
-                    try:
-                        os.stat(f"/sd/{actual_filename}")
-                        full_path = f"/sd/{actual_filename}"
-                        found_location = "sd"
-                    except OSError:
-                        self._http_json(conn, {"status": "error", "message": f"File '{actual_filename}' not found in any storage location"}, status_code=404)
-                        return
+            full_path, found_location, actual_filename, st, error = self._find_file(name)
+            if error:
+                await self._http_json(conn, {"status": "error", "message": error},
+                                      status_code=400 if error.startswith("invalid path") else 404)
+                return
             
             try:
-                st = os.stat(full_path)
-                total = st[6] if isinstance(st, tuple) and len(st) > 6 else st[0]
+                size = st[6] if isinstance(st, tuple) and len(st) > 6 else st[0]
+                etag, last_modified = self._file_validators(st)
                 hdrs = {
                     "Content-Type": "application/octet-stream",
-                    "Content-Length": str(total),
-                    "Content-Disposition": "attachment; filename=%s" % actual_filename,
+                    "Content-Disposition": "attachment; filename=%s" % actual_filename.rsplit('/', 1)[-1],
+                    "Accept-Ranges": "bytes",
+                    "Cache-Control": "no-cache",
+                    "ETag": etag,
+                    "Last-Modified": last_modified,
                     "X-File-Location": found_location,
                     "X-File-Path": full_path,
                 }
-                self._http_send(conn, 200, headers=hdrs, body_bytes=b"")
+                # Unchanged since the client's copy: headers only
+                if self._not_modified(headers, etag, last_modified):
+                    await self._http_send(conn, 304, headers={"Cache-Control": "no-cache", "ETag": etag,
+                                                              "Last-Modified": last_modified}, body_bytes=None)
+                    return
+                # Range: bytes=start-end lets an interrupted download resume
+                start, total, status = 0, size, 200
+                rng = self._parse_range(headers.get('range'), size)
+                if rng == -1:
+                    await self._http_send(conn, 416, headers={"Content-Range": "bytes */%d" % size})
+                    return
+                if rng:
+                    start, end = rng
+                    total = end - start + 1
+                    status = 206
+                    hdrs["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+                hdrs["Content-Length"] = str(total)
+                await self._http_send(conn, status, headers=hdrs, body_bytes=b"")
                 # Stream file
                 self.cancel_requested = False
-                buf = bytearray(4096)
                 with open(full_path, 'rb') as f:
-                    while True:
-                        n = f.readinto(buf)
-                        if not n:
-                            break
-                        try:
-                            conn.send(buf[:n])
-                        except Exception:
-                            break
-                        if self._check_cancel():
-                            break
+                    if start:
+                        f.seek(start)
+                    try:
+                        sent = await self._stream_file(conn, f, total, bufsize=4096)
+                    except OSError:
+                        sent = -1
+                if sent != total:
+                    # Body is short; the connection can't carry another response
+                    conn.keep_alive = False
+                    print(f"HTTP file download aborted: {full_path}")
+                    return
                 print(f"HTTP file download complete: {full_path} from {found_location} storage")
             except Exception as e:
-                self._http_json(conn, {"status": "error", "message": str(e)}, status_code=404)
+                await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=404)
             return
+        if path.startswith('/api/upload'):
+            mode = headers.get('x-mode') or self._qparam(path, 'mode', 'truncate')
+            if method in ('HEAD', 'GET', 'PUT', 'DELETE') or mode in ('chunk', 'commit'):
+                await self._upload_session(conn, method, path, headers, mode)
+                return
         if path.startswith('/api/upload') and method == 'POST':
             name = self._qparam(path, 'name')
-            mode = self._qparam(path, 'mode', 'truncate')
-            if not name:
-                self._http_json(conn, {"status": "error", "message": "missing name"}, status_code=400)
+            full_path = await self._http_target(conn, name, mkdirs=True)
+            if full_path is None:
                 return
-            
-            # Enhanced upload location detection - support location prefixes
-            target_location = None
-            actual_filename = name
-            full_path = name  # Default to internal flash
-            
-            # Check for location prefix (e.g., "sd:filename" or "internal:filename")
-            if ':' in name:
-                parts = name.split(':', 1)
-                if len(parts) == 2:
-                    location_part = parts[0].lower().strip()
-                    if location_part in ['sd', 'internal', 'flash']:
-                        target_location = 'sd' if location_part == 'sd' else 'internal'
-                        actual_filename = parts[1].strip()
-                        
-                        if target_location == "sd":
-                            # Check if SD card is mounted
-                            try:
-                                os.listdir('/sd')
-                                full_path = f"/sd/{actual_filename}"
-                                print(f"HTTP upload target: SD card ({full_path})")
-                            except OSError:
-                                self._http_json(conn, {"status": "error", "message": "SD card not mounted"}, status_code=503)
-                                return
-                        else:
-                            full_path = actual_filename
-                            print(f"HTTP upload target: Internal flash ({full_path})")
-            
             print(f"HTTP upload request: {name} -> {full_path}")
             name = full_path  # Update name to use full path
+            expected_crc = headers.get('x-crc32') or self._qparam(path, 'crc32')
+            # Write to a temp file and rename over name only once the body is complete
+            tmp = name + UPLOAD_TMP_SUFFIX
+            committed = False
             try:
-                # Prepare file
-                fmode = 'wb' if mode != 'append' else 'ab'
-                received = 0
                 self.cancel_requested = False
-                # Initialize CRC32
-                try:
-                    import ubinascii as binascii
-                except Exception:
-                    try:
-                        import binascii  # type: ignore
-                    except Exception:
-                        binascii = None
-                import gc
-                crc = 0
-                with open(name, fmode) as f:
-                    remaining = cl
-                    while remaining > 0:
-                        chunk = conn.recv(min(2048, remaining))
-                        if not chunk:
+                with open(tmp, 'wb') as f:
+                    sink = self._sink(f, tmp, cl)
+                    if mode == 'append':
+                        # Appending still goes through the temp file: copy what is there first,
+                        # through the same block writer (not counted in the upload's CRC)
+                        try:
+                            with open(name, 'rb') as src:
+                                while True:
+                                    n = src.readinto(sink.w.space())
+                                    if not n:
+                                        break
+                                    sink.w.commit(n)
+                        except OSError:
+                            pass
+                    while sink.received < cl:
+                        if not await sink.recv_from(conn):
                             break
-                        f.write(chunk)
-                        received += len(chunk)
-                        remaining -= len(chunk)
-                        if binascii:
-                            try:
-                                crc = binascii.crc32(chunk, crc)
-                            except Exception:
-                                pass
-                        if received % 102400 == 0:
-                            f.flush()
-                            gc.collect()
-                            print(f"HTTP upload: Received {received}/{cl} bytes...")
                         if self._check_cancel():
                             break
+                    sink.close()
+                received = sink.received
+                crc = sink.crc
+                crc_hex = "%08X" % ((crc & 0xFFFFFFFF)) if binascii else "00000000"
                 if self.cancel_requested:
-                    self._http_json(conn, {"status": "error", "message": "upload canceled", "received": received}, status_code=500)
-                elif received == cl:
-                    crc_hex = "%08X" % ((crc & 0xFFFFFFFF)) if binascii else "00000000"
-                    self._http_json(conn, {"status": "ok", "message": "uploaded", "bytes": received, "crc32": crc_hex})
+                    await self._http_json(conn, {"status": "error", "message": "upload canceled", "received": received}, status_code=500)
+                elif received != cl:
+                    await self._http_json(conn, {"status": "error", "message": "upload incomplete", "received": received, "expected": cl}, status_code=500)
+                elif expected_crc and expected_crc.upper() != crc_hex:
+                    await self._http_json(conn, {"status": "error", "message": "crc mismatch", "crc32": crc_hex,
+                                                 "expected": expected_crc.upper()}, status_code=422)
                 else:
-                    self._http_json(conn, {"status": "error", "message": "upload incomplete", "received": received, "expected": cl}, status_code=500)
+                    # In append mode the CRC only covers the new bytes
+                    slot = self._commit_upload(tmp, name, crc_hex if mode != 'append' else None)
+                    committed = True
+                    await self._http_json(conn, {"status": "ok", "message": _staged_message(slot, "uploaded"),
+                                                 "bytes": received, "crc32": crc_hex})
             except Exception as e:
-                self._http_json(conn, {"status": "error", "message": str(e)}, status_code=500)
+                await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=500)
+            finally:
+                if not committed:
+                    try:
+                        os.remove(tmp)
+                    except OSError:
+                        pass
             return
         if path.startswith('/api/delete') and method == 'DELETE':
             name = self._qparam(path, 'name')
-            if not name:
-                self._http_json(conn, {"status": "error", "message": "missing name"}, status_code=400)
+            full_path = await self._http_target(conn, name)
+            if full_path is None:
                 return
-            
-            # Enhanced delete location detection - support location prefixes
-            target_location = None
-            actual_filename = name
-            full_path = name  # Default to internal flash
-            
-            # Check for location prefix (e.g., "sd:filename" or "internal:filename")
-            if ':' in name:
-                parts = name.split(':', 1)
-                if len(parts) == 2:
-                    location_part = parts[0].lower().strip()
-                    if location_part in ['sd', 'internal', 'flash']:
-                        target_location = 'sd' if location_part == 'sd' else 'internal'
-                        actual_filename = parts[1].strip()
-                        
-                        if target_location == "sd":
-                            # Check if SD card is mounted
-                            try:
-                                os.listdir('/sd')
-                                full_path = f"/sd/{actual_filename}"
-                                print(f"HTTP delete target: SD card ({full_path})")
-                            except OSError:
-                                self._http_json(conn, {"status": "error", "message": "SD card not mounted"}, status_code=503)
-                                return
-                        else:
-                            full_path = actual_filename
-                            print(f"HTTP delete target: Internal flash ({full_path})")
-            
             print(f"HTTP delete request: {name} -> {full_path}")
+            self.dir_index.invalidate(full_path)
             try:
-                os.remove(full_path)
-                self._http_json(conn, {"status": "ok", "message": "deleted", "file": name})
+                if os.stat(full_path)[0] & 0x4000:
+                    # Directories can be removed once empty
+                    os.rmdir(full_path)
+                    self.dir_index.invalidate(full_path + '/')
+                else:
+                    os.remove(full_path)
+                    self.digests.drop(full_path)
+                await self._http_json(conn, {"status": "ok", "message": "deleted", "file": name})
             except OSError as e:
-                self._http_json(conn, {"status": "error", "message": f"delete failed: {e}"}, status_code=404)
+                await self._http_json(conn, {"status": "error", "message": f"delete failed: {e}"}, status_code=404)
             return
+        if method in ('GET', 'HEAD') and not path.startswith('/api/'):
+            if await self._serve_static(conn, method, path, headers):
+                return
         # Fallback
-        self._http_send(conn, 404)
+        await self._http_send(conn, 404)
+
+    async def _http_stream(self, conn, headers):
+        """Send a 200 head for a body of unknown length; returns a _BodyWriter."""
+        if conn.chunked_ok:
+            headers["Transfer-Encoding"] = "chunked"
+        else:
+            # HTTP/1.0: the body ends when the connection closes
+            conn.keep_alive = False
+        await self._http_send(conn, 200, headers=headers, body_bytes=None)
+        return _BodyWriter(conn, conn.chunked_ok)
+
+    def _list_roots(self, location, subdir=None):
+        """Directories to list as (path, location, relative dir prefix for names)."""
+        roots = []
+        for loc, mp in self.vfs.roots:
+            if location in ('all', loc) and self.vfs.mounted(loc):
+                roots.append((self.vfs.list_dir(loc, subdir), loc, subdir + '/' if subdir else ''))
+        return roots
+
+    def _http_roots(self, path):
+        """Roots for /api/list and /api/tree from ?dir= and ?location=; ValueError on a bad dir."""
+        location = self._qparam(path, 'location', 'all')
+        subdir = self._qparam(path, 'dir')
+        if subdir:
+            loc, subdir = self.vfs.split(subdir)
+            location = loc or location
+            subdir = self.vfs.clean(subdir)
+        return self._list_roots(location, subdir)
+
+    def _entry_json(self, loc, rel, name, size, is_dir):
+        item = {"name": f"{rel}{name}" if loc == 'internal' else f"{loc}:{rel}{name}", "size": size, "location": loc}
+        if loc != 'internal':
+            item["actual_name"] = rel + name
+        if is_dir:
+            item["type"] = "dir"
+        return item
+
+    async def _http_list(self, conn, path, headers):
+        """/api/list[?dir=D&offset=N&limit=N&prefix=P&location=internal|sd]
+
+        Entries come from the directory index and are streamed, so memory use
+        does not grow with the number of files. A "sd:" or "internal:" prefix on
+        prefix or dir also selects the location. "next" is the offset of the
+        following page.
+        """
+        try:
+            import ujson as json
+        except Exception:
+            import json
+        try:
+            offset = int(self._qparam(path, 'offset', '0') or 0)
+            limit = self._qparam(path, 'limit')
+            limit = int(limit) if limit else None
+            if offset < 0 or (limit is not None and limit < 0):
+                raise ValueError
+        except ValueError:
+            await self._http_json(conn, {"status": "error", "message": "bad offset or limit"}, status_code=400)
+            return
+        prefix = self._qparam(path, 'prefix')
+        try:
+            all_roots = self._http_roots(path)
+        except ValueError as e:
+            await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=400)
+            return
+        if prefix:
+            loc, prefix = self.vfs.split(prefix)
+            if loc:
+                all_roots = [r for r in all_roots if r[1] == loc]
+        roots = []
+        versions = []
+        for root in all_roots:
+            try:
+                versions.append(self.dir_index.version(root[0]))
+                roots.append(root)
+            except OSError as e:
+                # SD card not mounted, or no such directory
+                self.vfs.failed(root[1], e)
+        hdrs = {"Content-Type": "application/json", "Cache-Control": "no-cache"}
+        if binascii and None not in versions:
+            # Listing CRCs are cached with the index, so this costs no directory walk
+            etag = '"%08x"' % (binascii.crc32(("%s %s" % (path, versions)).encode()) & 0xFFFFFFFF)
+            hdrs["ETag"] = etag
+            if self._not_modified(headers, etag):
+                await self._http_send(conn, 304, headers=hdrs, body_bytes=None)
+                return
+        out = await self._http_stream(conn, hdrs)
+        await out.write('{"status": "ok", "files": [')
+        counts = dict((loc, 0) for loc, mp in self.vfs.roots)
+        matched = returned = 0
+        for d, loc, rel in roots:
+            for name, size, is_dir in self.dir_index.entries(d, prefix):
+                if self.vfs.is_mount(d, name):
+                    continue
+                matched += 1
+                counts[loc] += 1
+                if matched <= offset or (limit is not None and returned >= limit):
+                    continue
+                await out.write((", " if returned else "") + json.dumps(self._entry_json(loc, rel, name, size, is_dir)))
+                returned += 1
+        nxt = offset + returned if offset + returned < matched else None
+        await out.write('], "internal_count": %d, "sd_count": %d, "total_count": %d, "offset": %d, '
+                        '"returned": %d, "next": %s}' % (counts.get("internal", 0), counts.get("sd", 0), matched, offset,
+                                                       returned, json.dumps(nxt)))
+        await out.close()
+
+    async def _http_tree(self, conn, path, headers):
+        """/api/tree[?dir=D&depth=N&location=internal|sd]
+
+        Recursive listing, streamed while the directories are walked (depth 1
+        lists only dir itself). Each entry carries its "depth"; "truncated" is
+        true when directories below the depth limit were not entered.
+        """
+        try:
+            import ujson as json
+        except Exception:
+            import json
+        try:
+            max_depth = max(1, min(int(self._qparam(path, 'depth', TREE_DEFAULT_DEPTH)), TREE_MAX_DEPTH))
+            roots = self._http_roots(path)
+        except ValueError as e:
+            await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=400)
+            return
+        out = await self._http_stream(conn, {"Content-Type": "application/json", "Cache-Control": "no-cache"})
+        await out.write('{"status": "ok", "entries": [')
+        count = 0
+        truncated = False
+        for d, loc, rel in roots:
+            # One open directory iterator per level, so memory grows with depth only
+            stack = [(d, rel, _scan_dir(d))]
+            while stack:
+                dpath, drel, it = stack[-1]
+                try:
+                    name, size, is_dir = next(it)
+                except (StopIteration, OSError):
+                    stack.pop()
+                    continue
+                if self.vfs.is_mount(dpath, name):
+                    continue
+                item = self._entry_json(loc, drel, name, size, is_dir)
+                item["depth"] = len(stack)
+                await out.write((", " if count else "") + json.dumps(item))
+                count += 1
+                if is_dir:
+                    if len(stack) < max_depth:
+                        child = ('/' + name) if dpath == '/' else f"{dpath}/{name}"
+                        stack.append((child, f"{drel}{name}/", _scan_dir(child)))
+                    else:
+                        truncated = True
+        await out.write('], "count": %d, "depth": %d, "truncated": %s}' % (count, max_depth, json.dumps(truncated)))
+        await out.close()
+
+    def _delta_block_size(self, path):
+        bs = int(self._qparam(path, 'block_size', DELTA_BLOCK_SIZE) or DELTA_BLOCK_SIZE)
+        if not DELTA_MIN_BLOCK <= bs <= DELTA_MAX_BLOCK:
+            raise ValueError("block_size must be %d..%d" % (DELTA_MIN_BLOCK, DELTA_MAX_BLOCK))
+        return bs
+
+    async def _http_blocks(self, conn, path):
+        """/api/blocks?name=F[&block_size=N]: per-block checksums of an existing file
+        for delta sync. Each block is [weak, strong]: weak is the byte sum (cheap to
+        roll on the client), strong the CRC32 in hex."""
+        name = self._qparam(path, 'name')
+        if not name:
+            await self._http_json(conn, {"status": "error", "message": "missing name"}, status_code=400)
+            return
+        try:
+            bs = self._delta_block_size(path)
+        except ValueError as e:
+            await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=400)
+            return
+        full_path, found_location, actual_filename, st, error = self._find_file(name)
+        if error:
+            await self._http_json(conn, {"status": "error", "message": error},
+                                  status_code=400 if error.startswith("invalid path") else 404)
+            return
+        try:
+            import ujson as json
+        except Exception:
+            import json
+        size = st[6]
+        out = await self._http_stream(conn, {"Content-Type": "application/json", "Cache-Control": "no-cache"})
+        await out.write('{"status": "ok", "path": %s, "size": %d, "block_size": %d, "blocks": ['
+                        % (json.dumps(full_path), size, bs))
+        buf = bytearray(bs)
+        mv = memoryview(buf)
+        first = True
+        with open(full_path, 'rb') as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                await out.write('%s[%d, "%08X"]' % ("" if first else ", ", sum(mv[:n]),
+                                                     binascii.crc32(mv[:n]) & 0xFFFFFFFF))
+                first = False
+        await out.write(']}')
+        await out.close()
+
+    async def _recv_exact(self, conn, n):
+        """Read exactly n bytes from conn, or fewer if the stream ends."""
+        data = b""
+        while len(data) < n:
+            part = await conn.recv(n - len(data))
+            if not part:
+                break
+            data += part
+        return data
+
+    async def _http_delta(self, conn, path, headers):
+        """/api/delta?name=F&size=S&crc32=HEX[&block_size=N]
+
+        Rebuilds F from the current F plus an op stream in the body:
+          b"C" + block index (u32 BE) + block count (u32 BE)  copy old blocks
+          b"D" + length (u32 BE) + bytes                       literal data
+        The result is assembled in a temp file and only replaces F when its size
+        and CRC32 match, like every other upload.
+        """
+        name = self._qparam(path, 'name')
+        full_path = await self._http_target(conn, name, mkdirs=True)
+        if full_path is None:
+            return
+        try:
+            bs = self._delta_block_size(path)
+            size = int(self._qparam(path, 'size'))
+            expected_crc = self._qparam(path, 'crc32').upper()
+        except (TypeError, ValueError, AttributeError) as e:
+            await self._http_json(conn, {"status": "error", "message": "need size, crc32 (%s)" % e}, status_code=400)
+            return
+        tmp = full_path + UPLOAD_TMP_SUFFIX
+        copied = literal = 0
+        error = None
+        try:
+            try:
+                old = open(full_path, 'rb')
+            except OSError:
+                old = None
+            try:
+                with open(tmp, 'wb') as f:
+                    sink = self._sink(f, tmp, size)
+                    block = bytearray(bs)
+                    bmv = memoryview(block)
+                    while error is None:
+                        op = await self._recv_exact(conn, 1)
+                        if not op:
+                            break
+                        if op == b"C":
+                            hdr = await self._recv_exact(conn, 8)
+                            if len(hdr) < 8 or old is None:
+                                error = "bad copy op"
+                                break
+                            index = int.from_bytes(hdr[:4], 'big')
+                            count = int.from_bytes(hdr[4:], 'big')
+                            old.seek(index * bs)
+                            for _ in range(count):
+                                n = old.readinto(block)
+                                if not n or sink.received + n > size:
+                                    error = "copy past end of file"
+                                    break
+                                sink.feed(bmv[:n])
+                                copied += n
+                        elif op == b"D":
+                            hdr = await self._recv_exact(conn, 4)
+                            left = int.from_bytes(hdr, 'big') if len(hdr) == 4 else -1
+                            if left < 0 or sink.received + left > size:
+                                error = "bad data op"
+                                break
+                            while left > 0:
+                                n = await sink.recv_from(conn, left)
+                                if not n:
+                                    error = "body ended inside data op"
+                                    break
+                                left -= n
+                                literal += n
+                        else:
+                            error = "unknown op %r" % op
+                        if self._check_cancel():
+                            error = "canceled"
+                    sink.close()
+            finally:
+                if old:
+                    old.close()
+            crc_hex = "%08X" % (sink.crc & 0xFFFFFFFF)
+            if error is None and sink.received != size:
+                error = "size mismatch: built %d of %d bytes" % (sink.received, size)
+            if error is None and crc_hex != expected_crc:
+                error = "crc mismatch: built %s, expected %s" % (crc_hex, expected_crc)
+            if error:
+                await self._http_json(conn, {"status": "error", "message": error}, status_code=422)
+                return
+            slot = self._commit_upload(tmp, full_path, crc_hex)
+            print(f"Delta update {full_path}: {copied} bytes copied, {literal} bytes received")
+            await self._http_json(conn, {"status": "ok", "message": _staged_message(slot, "updated"),
+                                         "bytes": size, "crc32": crc_hex,
+                                         "copied": copied, "received": literal})
+        except Exception as e:
+            await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=500)
+        finally:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    async def _http_history(self, conn, path):
+        """/api/history?from=T&to=T&action=A&limit=N: relay log records as
+        ["YYYY-MM-DD HH:MM:SS", action, duration minutes or null], oldest first.
+
+        from/to are dates or date-times ("2026-03-01", "2026-03-01T08:00"); a
+        partial "to" covers the month/day/minute it names ("to=2026-03").
+        action keeps records whose action has all its words ("on", "off",
+        "manual timeout"). The log index finds the start of the range with a
+        binary search, so only the matching segments are read; records are
+        streamed as they are found.
+        """
+        if logstore is None:
+            await self._http_json(conn, {"status": "error", "message": "logstore.py not installed"}, status_code=404)
+            return
+        try:
+            import ujson as json
+        except Exception:
+            import json
+        try:
+            limit = int(self._qparam(path, 'limit', HISTORY_DEFAULT_LIMIT) or HISTORY_DEFAULT_LIMIT)
+        except ValueError:
+            await self._http_json(conn, {"status": "error", "message": "bad limit"}, status_code=400)
+            return
+        start = self._qparam(path, 'from')
+        end = self._qparam(path, 'to')
+        out = await self._http_stream(conn, {"Content-Type": "application/json", "Cache-Control": "no-cache"})
+        await out.write('{"status": "ok", "fields": ["time", "action", "duration"], "records": [')
+        count = 0
+        try:
+            for rec in logstore.history(start, end, self._qparam(path, 'action'), limit):
+                await out.write((", " if count else "") + json.dumps(rec))
+                count += 1
+        except Exception as e:
+            # Too late for an error status: report it in the body
+            print("History query error:", e)
+            await out.write('], "count": %d, "error": %s}' % (count, json.dumps(str(e))))
+            await out.close()
+            return
+        await out.write('], "count": %d, "limit": %d}' % (count, limit))
+        await out.close()
+
+    async def _http_settings(self, conn, method, path):
+        """/api/settings: runtime settings kept in settings.kv.
+
+        GET lists the value in effect of every setting (passwords masked) and
+        the store's size; POST ?name=N&value=V validates and saves one (value
+        as JSON, except for text settings); DELETE ?name=N returns it to its
+        default. Changes take effect at once and persist across reboots.
+        """
+        if kvstore is None:
+            await self._http_json(conn, {"status": "error", "message": "kvstore.py not installed"}, status_code=404)
+            return
+        name = self._qparam(path, 'name')
+        if method != 'GET':
+            if not name:
+                await self._http_json(conn, {"status": "error", "message": "missing name"}, status_code=400)
+                return
+            try:
+                if method == 'DELETE':
+                    kvstore.reset(name)
+                else:
+                    value = self._qparam(path, 'value')
+                    if value is None:
+                        await self._http_json(conn, {"status": "error", "message": "missing value"}, status_code=400)
+                        return
+                    kvstore.update(name, kvstore.parse(name, value))
+            except ValueError as e:
+                await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=400)
+                return
+            except Exception as e:
+                await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=500)
+                return
+        await self._http_json(conn, {"status": "ok", "settings": kvstore.settings(), "store": kvstore.stats()},
+                              headers={"Cache-Control": "no-cache"})
+
+    async def _http_metrics(self, conn):
+        """/api/metrics: Prometheus text exposition of the request metrics (per
+        BLE command verb and HTTP route), the control-loop histograms and the
+        heap, streamed line by line so a fleet collector can scrape each unit.
+        """
+        if telemetry is None:
+            await self._http_json(conn, {"status": "error", "message": "telemetry.py not installed"}, status_code=404)
+            return
+        out = await self._http_stream(conn, {"Content-Type": "text/plain; version=0.0.4"})
+        for line in telemetry.prometheus():
+            await out.write(line)
+        await out.close()
+
+    async def _http_stats(self, conn, path):
+        """/api/stats[?period=day|week|month&n=N]: cumulative relay ON time.
+
+        Always returns the runstats summary (today, yesterday, this/last week
+        and month, total, and the seconds of a run in progress); with period,
+        also "series", the last n periods newest first. The counters are
+        updated at each relay transition, so this reads a few fixed records.
+        """
+        if runstats is None:
+            await self._http_json(conn, {"status": "error", "message": "runstats.py not installed"}, status_code=404)
+            return
+        period = self._qparam(path, 'period')
+        if period and period not in runstats.PERIODS:
+            await self._http_json(conn, {"status": "error", "message": "period must be day, week or month"},
+                                  status_code=400)
+            return
+        try:
+            n = int(self._qparam(path, 'n', 7) or 7)
+        except ValueError:
+            await self._http_json(conn, {"status": "error", "message": "bad n"}, status_code=400)
+            return
+        try:
+            out = {"status": "ok", "stats": runstats.summary()}
+            if period:
+                out["period"] = period
+                out["series"] = runstats.series(period, n)
+        except Exception as e:
+            await self._http_json(conn, {"status": "error", "message": str(e)}, status_code=500)
+            return
+        await self._http_json(conn, out, headers={"Cache-Control": "no-cache"})
+
+    async def _http_bundle(self, conn, path):
+        """POST /api/bundle: several files in one request, committed all-or-nothing.
+
+        Body: BUNDLE_MAGIC, then per file: name length (u16 BE), UTF-8 name (with
+        optional sd:/subdir prefix), size (u32 BE), CRC32 (u32 BE), data; a zero
+        name length ends the bundle. Each file streams into <target>.tmp; only
+        when every CRC matches are they renamed into place, under a journal that
+        recover_bundle() replays if the board resets half way.
+
+        With ?ota=1 the files (flat code files) go into the spare code slot
+        instead, which ota.py verifies and boots as a trial at the next reset.
+        """
+        files = []      # [tmp, target] in arrival order (the journal's format)
+        results = []
+        error = None
+        status = 422
+        committing = False
+        slot = None
+        try:
+            if self._qparam(path, 'ota') == '1':
+                if ota is None:
+                    error = "ota.py not installed"
+                else:
+                    try:
+                        slot = ota.stage_begin()
+                    except OSError as e:
+                        error, status = str(e), 409
+            if error is None and await self._recv_exact(conn, len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+                error = "not a bundle"
+            while error is None:
+                hdr = await self._recv_exact(conn, 2)
+                if len(hdr) < 2:
+                    error = "bundle truncated"
+                    break
+                name_len = int.from_bytes(hdr, 'big')
+                if name_len == 0:
+                    break
+                hdr = await self._recv_exact(conn, name_len + 8)
+                if len(hdr) < name_len + 8:
+                    error = "bundle truncated"
+                    break
+                name = hdr[:name_len].decode()
+                size = int.from_bytes(hdr[name_len:name_len + 4], 'big')
+                crc_hex = "%08X" % int.from_bytes(hdr[name_len + 4:], 'big')
+                try:
+                    if slot:
+                        ota.check_name(name)
+                        target = f"{ota.slot_dir(slot)}/{name}"
+                    else:
+                        target = self._target_path(name, mkdirs=True)
+                except ValueError as e:
+                    error = str(e)
+                    break
+                if target is None:
+                    error, status = "SD card not mounted", 503
+                    break
+                tmp = target + UPLOAD_TMP_SUFFIX
+                if len(files) >= BUNDLE_MAX_FILES or [tmp, target] in files:
+                    error = f"too many or duplicate entries at {name}"
+                    break
+                files.append([tmp, target])
+                # Record the temp file before creating it so a reset cannot orphan it
+                _write_journal("receiving", files)
+                with open(tmp, 'wb') as f:
+                    sink = self._sink(f, tmp, size)
+                    while sink.received < size:
+                        if not await sink.recv_from(conn):
+                            break
+                        if self._check_cancel():
+                            break
+                    sink.close()
+                got = "%08X" % (sink.crc & 0xFFFFFFFF)
+                if sink.received != size:
+                    error = f"{name}: received {sink.received} of {size} bytes"
+                elif got != crc_hex:
+                    error = f"{name}: crc mismatch, got {got}, expected {crc_hex}"
+                results.append({"name": name, "bytes": sink.received, "crc32": got})
+                print(f"Bundle entry {name}: {sink.received} bytes, CRC {got}")
+            if error is None and not files:
+                error = "empty bundle"
+            if error is None:
+                # Point of no return: from here a reset finishes the renames at boot
+                _write_journal("commit", files)
+                committing = True
+                staged = None
+                for (tmp, target), res in zip(files, results):
+                    staged = self._commit_upload(tmp, target, res["crc32"]) or staged
+                os.remove(BUNDLE_JOURNAL)
+                print(f"Bundle committed: {len(files)} files")
+                if slot:
+                    # Hash the slot into its manifest and verify before marking it bootable
+                    ota.stage_finish(slot)
+                    await self._http_json(conn, {"status": "ok", "message": f"staged in slot {slot}, boots on next reset",
+                                                 "slot": slot, "files": results})
+                    return
+                await self._http_json(conn, {"status": "ok", "message": _staged_message(staged, "bundle committed"),
+                                             "files": results})
+                return
+        except Exception as e:
+            error, status = str(e), 500
+            if committing:
+                # Every file was verified; finish the renames rather than leave a mix
+                recover_bundle()
+                self.dir_index.invalidate()
+                await self._http_json(conn, {"status": "error", "message": f"commit interrupted, recovered: {error}",
+                                             "files": results}, status_code=500)
+                return
+        # Roll back: nothing was renamed, so only the temp files go
+        for tmp, target in files:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        try:
+            os.remove(BUNDLE_JOURNAL)
+        except OSError:
+            pass
+        print("Bundle rejected:", error)
+        await self._http_json(conn, {"status": "error", "message": error, "files": results}, status_code=status)
+
+    async def _serve_static(self, conn, method, path, headers):
+        """Serve path from www_dir, preferring a precompressed <file>.gz when the
+        client accepts gzip. Returns False if there is no such file."""
+        rel = path.split('?', 1)[0].lstrip('/')
+        if not rel or rel.endswith('/'):
+            rel += "index.html"
+        if '..' in rel.split('/'):
+            return False
+        full = f"{self.www_dir}/{rel}"
+        send_path, encoding, st = full, None, None
+        if 'gzip' in (headers.get('accept-encoding') or ''):
+            try:
+                st = os.stat(full + ".gz")
+                send_path, encoding = full + ".gz", "gzip"
+            except OSError:
+                pass
+        if st is None:
+            try:
+                st = os.stat(full)
+            except OSError:
+                return False
+        if st[0] & 0x4000:
+            # Directory
+            return False
+        etag, last_modified = self._file_validators(st)
+        if encoding:
+            etag = etag[:-1] + '-gz"'
+        name = rel.rsplit('/', 1)[-1]
+        ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+        hdrs = {
+            "Cache-Control": "no-cache" if name in STATIC_NO_CACHE else "public, max-age=%d" % STATIC_MAX_AGE,
+            "ETag": etag,
+            "Last-Modified": last_modified,
+            "Vary": "Accept-Encoding",
+        }
+        if self._not_modified(headers, etag, last_modified):
+            await self._http_send(conn, 304, headers=hdrs, body_bytes=None)
+            return True
+        hdrs["Content-Type"] = _STATIC_TYPES.get(ext, "application/octet-stream")
+        if encoding:
+            hdrs["Content-Encoding"] = encoding
+        size = st[6]
+        hdrs["Content-Length"] = str(size)
+        await self._http_send(conn, 200, headers=hdrs, body_bytes=b"")
+        if method == 'HEAD':
+            return True
+        with open(send_path, 'rb') as f:
+            try:
+                sent = await self._stream_file(conn, f, size, bufsize=4096)
+            except OSError:
+                sent = -1
+        if sent != size:
+            conn.keep_alive = False
+        return True
 
     def start_server(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -1128,17 +2694,25 @@ class PicoPiFileServer:
         print(f"TCP Server listening on port {self.port}")
         return s
 
-    def send_file(self, conn):
+    async def send_file(self, conn, path=None, offset=0):
+        """Send path (default self.file_path) from offset, after a 10-byte header
+        giving the number of bytes that follow."""
+        if path is None:
+            path = self.file_path
         try:
-            st = os.stat(self.file_path)
+            st = os.stat(path)
             file_size = st[6] if isinstance(st, tuple) and len(st) > 6 else st[0]
             if file_size == 0:
                 print("File is empty")
                 return False
+            file_size = max(0, file_size - offset)
 
             # Send 10-byte file size header
             header = ("{:010d}".format(file_size))
-            conn.send(header.encode())
+            await conn.send(header.encode())
+            if file_size == 0:
+                print("Nothing to send past offset", offset)
+                return True
 
             print(f"Sending file ({file_size} bytes)...")
             # Clear cancel flag at start of operation
@@ -1154,54 +2728,71 @@ class PicoPiFileServer:
                     conn.settimeout(10)  # Standard timeout for smaller files
             except Exception:
                 pass
-            # Use slightly smaller chunks and sendall to improve delivery reliability
-            buf = bytearray(2048)
-            sent_bytes = 0
-            next_progress = file_size // 10  # Show progress every 10%
-            
-            with open(self.file_path, "rb") as f:
-                while True:
-                    n = f.readinto(buf)
-                    if not n:
-                        break
-                    try:
-                        # Use sendall so MicroPython will block until the buffer is accepted
-                        try:
-                            conn.sendall(buf[:n])
-                        except Exception:
-                            # Fall back to send() if sendall isn't available on this port
-                            conn.send(buf[:n])
-                        # Small cooperative delay to avoid overwhelming the network stack
-                        try:
-                            time.sleep(0.002)
-                        except Exception:
-                            pass
-                        sent_bytes += n
-                        
-                        # Progress reporting for large files
-                        if file_size > 100000 and sent_bytes >= next_progress:
-                            percent = (sent_bytes / file_size) * 100
-                            print(f"Sent {sent_bytes}/{file_size} bytes ({percent:.1f}%)")
-                            next_progress += file_size // 10
-                            
-                    except OSError as e:
-                        print(f"Send error after {sent_bytes}/{file_size} bytes:", e)
-                        if hasattr(e, 'errno'):
-                            print(f"Error code: {e.errno}")
-                        return False
-                    # Cooperative cancel
-                    if self._check_cancel():
-                        print("Send canceled by user")
-                        return False
+            with open(path, "rb") as f:
+                if offset:
+                    f.seek(offset)
+                try:
+                    sent_bytes = await self._stream_file(conn, f, file_size, bufsize=2048)
+                except OSError as e:
+                    print("Send error:", e)
+                    if hasattr(e, 'errno'):
+                        print(f"Error code: {e.errno}")
+                    return False
+            if sent_bytes < file_size:
+                print("Send canceled by user")
+                return False
             print("File sent successfully")
             return True
         except Exception as e:
             print("Error sending file:", e)
             return False
 
-    def run(self):
+    async def _stream_file(self, conn, f, length, bufsize=2048):
+        """Send length bytes from f through one reusable buffer; return bytes sent.
+
+        Chunks go out as memoryview slices, so nothing is copied per chunk. Instead
+        of a fixed delay, a pause is added only while sends are observed to block
+        (the stack's buffers are full) and decays again once they drain quickly.
+        Stops early on cancel; socket errors propagate.
+        """
+        buf = bytearray(bufsize)
+        mv = memoryview(buf)
+        sent = 0
+        pause = 0
+        next_progress = length // 10  # Show progress every 10%
+        start = ticks_ms()
+        while sent < length:
+            n = f.readinto(mv[:min(bufsize, length - sent)])
+            if not n:
+                break
+            t = ticks_ms()
+            await conn.send(mv[:n])
+            if ticks_diff(ticks_ms(), t) > SEND_BLOCKED_MS:
+                pause = min(pause * 2 or 1, SEND_MAX_PAUSE_MS)
+            else:
+                pause >>= 1
+            if pause:
+                await conn.sleep_ms(pause)
+            sent += n
+
+            # Progress reporting for large files
+            if length > 100000 and sent >= next_progress:
+                print(f"Sent {sent}/{length} bytes ({sent * 100 // length}%)")
+                next_progress += length // 10
+            # Cooperative cancel
+            if self._check_cancel():
+                break
+        elapsed = max(1, ticks_diff(ticks_ms(), start))
+        self.tx_stats = {"bytes": sent, "ms": elapsed, "bytes_per_sec": sent * 1000 // elapsed}
+        print(f"Sent {sent} bytes in {elapsed} ms ({sent * 1000 // elapsed} B/s)")
+        return sent
+
+    def _prepare(self):
         self._running = True
         self.start_ap()
+        # A half-committed bundle owns some .tmp files; settle it before cleaning
+        recover_bundle()
+        self._clean_upload_temps()
 
         # Create test file if it doesn't exist
         try:
@@ -1210,6 +2801,9 @@ class PicoPiFileServer:
             with open(self.file_path, 'w') as f:
                 f.write("Hello, this is a test file from PICO\n")
 
+    def run(self):
+        self._prepare()
+
         # Start and retain server socket
         if not self.server_socket:
             self.start_server()
@@ -1223,7 +2817,51 @@ class PicoPiFileServer:
                 print("Accept failed or server stopped:", e)
                 break
             print("Client connected from", addr)
-            self.handle_client(conn)
+            self._handle_client_sync(conn)
+
+    async def run_async(self, host="0.0.0.0"):
+        """Serve clients concurrently on the asyncio loop until shutdown()."""
+        self._prepare()
+        self._stop_event = asyncio.Event()
+        self._async_server = await asyncio.start_server(self._serve_stream, host, self.port,
+                                                        backlog=self.max_clients)
+        print(f"Async server listening on port {self.port} (max {self.max_clients} clients)")
+        try:
+            await self._stop_event.wait()
+        finally:
+            server = self._async_server
+            self._async_server = None
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+
+    async def _serve_stream(self, reader, writer):
+        conn = _StreamConn(reader, writer, self.conn_timeout)
+        if self.active_clients >= self.max_clients:
+            print("Connection refused: client limit reached")
+            try:
+                conn.settimeout(REFUSE_PEEK_SEC)
+                try:
+                    first = await conn.recv(512)
+                except OSError:
+                    first = b""
+                if _is_http(first):
+                    await self._http_send(conn, 503, headers={"Retry-After": "1"})
+                else:
+                    await conn.send(b"ERROR Busy: client limit reached, try again later\n")
+            except Exception:
+                pass
+            conn.close()
+            return
+        self.active_clients += 1
+        try:
+            print("Client connected from", writer.get_extra_info('peername'))
+            await self.handle_client(conn)
+        finally:
+            self.active_clients -= 1
+
+    def _low_memory(self):
+        return telemetry is not None and telemetry.low_memory()
 
     def status(self):
         try:
@@ -1237,14 +2875,24 @@ class PicoPiFileServer:
                 "port": self.port,
                 "ap_active": bool(self.ap.active()) if self.ap else False,
                 "ip": ip,
-                "listening": self.server_socket is not None,
+                "listening": self.server_socket is not None or self._async_server is not None,
+                "mode": "async" if self._async_server is not None else "blocking",
+                "clients": self.active_clients,
+                "last_send": self.tx_stats,
+                # Measured block write throughput per storage (uploads and logs)
+                "storage_writes": blockwriter.summary(),
+                # Heap, low-water mark, low-memory mode and MemoryErrors (telemetry.py)
+                "memory": telemetry.mem_report() if telemetry else None,
             }
         except Exception as e:
             return {"error": str(e)}
 
 
     def shutdown(self):
-        import micropython, time
+        try:
+            import micropython
+        except ImportError:
+            micropython = None
         print("Shutting down network services...")
         try:
             micropython.kbd_intr(-1)  # best-effort ignore Ctrl‑C during cleanup
@@ -1252,6 +2900,8 @@ class PicoPiFileServer:
             pass
         try:
             self._running = False
+            if self._stop_event is not None:
+                self._stop_event.set()
             if getattr(self, 'server_socket', None):
                 try:
                     self.server_socket.settimeout(0)
@@ -1272,7 +2922,7 @@ class PicoPiFileServer:
                 except Exception as e:
                     print("Error shutting down Wi‑Fi:", e)
 
-            time.sleep_ms(150)
+            time.sleep(0.15)
         finally:
             try:
                 micropython.kbd_intr(3)